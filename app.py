@@ -1,21 +1,114 @@
+import time
+_inicio_importaciones = time.perf_counter() # Para informar el tiempo de arranque del proceso
 import streamlit as st
 import pandas as pd
-from docx import Document
-from docx.shared import Pt
 import os
-from datetime import datetime, date
+import sys
+from datetime import datetime, date, timedelta
 import re
-import zipfile
+import unicodedata
 import io
+import contextlib
+import sqlite3
+import threading
+import queue
+import importlib
+import uuid
+import logging
+from collections import Counter
+from concurrent.futures import Future
+
+import motor_documentos as motor
+import metricas
+import trabajos
+from cie10 import extraer_codigos, normalizar_codigos, obtener_catalogo_cie10
+
+_segundos_importaciones = time.perf_counter() - _inicio_importaciones
+
+logger = logging.getLogger("hcl.app")
 
 # --- Configuración de la página de Streamlit ---
 st.set_page_config(layout="wide", page_title="Sistema de Gestión de Documentos Médicos")
 
+# Columnas del historial de pacientes, en el orden en que se exportan
+COLUMNAS_HISTORIAL = [
+    'Fecha_Registro', 'Nombre_Completo', 'Num_Historia', 'Num_Registro',
+    'Edad', 'Servicio', 'Diagnostico', 'Fecha_Internacion',
+    'Ocupacion', 'Estado_Civil', 'Genero', 'Residencia', 'Procedencia',
+    'Domicilio',
+    'Residente_La_Paz',
+    'Nombre_Referencia1', 'Relacion_Referencia1', 'Telefono_Referencia1',
+    'Nombre_Referencia2', 'Relacion_Referencia2', 'Telefono_Referencia2',
+    'Ruta_Carpeta',
+    # Campos agregados para poder reconstruir el formulario en un reingreso
+    'Nombres', 'Apellido_Paterno', 'Apellido_Materno', 'Fecha_Nacimiento',
+    'Diagnostico_Recetas_Labs', 'CIE10',
+    # Clave de la generación en el archivo de documentos, para volver a descargarla
+    'Archivo_Documentos'
+]
+# Versión del esquema de la base del historial (PRAGMA user_version)
+HISTORIAL_VERSION_ESQUEMA = 5
+# Columnas cuyas palabras se indexan para la búsqueda de pacientes
+COLUMNAS_BUSQUEDA = ['Nombre_Completo', 'Diagnostico', 'CIE10']
+# Formato con el que se muestra y exporta Fecha_Registro (en la base se guarda como ISO para poder ordenar)
+FORMATO_FECHA_REGISTRO = "%d/%m/%Y %H:%M"
+FORMATO_FECHA_REGISTRO_ISO = "%Y-%m-%d %H:%M"
+
+# Columnas aceptadas en el archivo de generación por lotes (las del historial) -> campo del formulario
+COLUMNAS_LOTE = {
+    'Nombres': 'nombres', 'Apellido_Paterno': 'apellido_paterno', 'Apellido_Materno': 'apellido_materno',
+    'Fecha_Nacimiento': 'fecha_nacimiento_str', 'Num_Historia': 'num_historia',
+    'Ocupacion': 'ocupacion', 'Estado_Civil': 'estado_civil', 'Residencia': 'residencia',
+    'Genero': 'genero', 'Procedencia': 'procedencia', 'Domicilio': 'domicilio',
+    'Nombre_Referencia1': 'n_referencia1', 'Relacion_Referencia1': 'referencia1',
+    'Telefono_Referencia1': 'telefono_referencia1',
+    'Nombre_Referencia2': 'n_referencia2', 'Relacion_Referencia2': 'referencia2',
+    'Telefono_Referencia2': 'telefono_referencia2',
+    'Diagnostico': 'diagnosticos', 'Diagnostico_Recetas_Labs': 'diag_recetas_labs', 'CIE10': 'cie10',
+    'Servicio': 'servicio', 'Observaciones': 'observaciones', 'Indicaciones': 'indicaciones'
+}
+# Filas del archivo de lote que se procesan a la vez (acota la memoria en lotes grandes)
+LOTE_FILAS_POR_BLOQUE = 200
+
+# Rangos de edad del censo: (desde, hasta) inclusive; el último queda abierto
+RANGOS_EDAD_CENSO = [(0, 14), (15, 29), (30, 44), (45, 59), (60, 74), (75, None)]
+# Diagnósticos y códigos CIE-10 que se muestran por mes en el censo
+CENSO_TOP_DIAGNOSTICOS = 10
+
+# Columnas del historial que se muestran en pantalla (las únicas que guarda la vista compartida)
+COLUMNAS_VISTA_HISTORIAL = [
+    'Fecha_Registro', 'Nombre_Completo', 'Num_Historia', 'Edad', 'Servicio', 'Diagnostico', 'CIE10',
+    'Fecha_Internacion', 'Residente_La_Paz', 'Ruta_Carpeta', 'Archivo_Documentos'
+]
+# Columnas con pocos valores distintos: en la vista se guardan como categorías
+COLUMNAS_CATEGORICAS_HISTORIAL = ['Edad', 'Servicio', 'Residente_La_Paz']
+# Filas máximas en la vista compartida (las más recientes); el resto sigue disponible al exportar
+HISTORIAL_VISTA_MAX_FILAS = 500_000
+TAMAÑOS_PAGINA_HISTORIAL = [25, 50, 100, 250]
+
+# Formatos de exportación del historial -> (extensión, tipo MIME)
+FORMATOS_EXPORTACION = {
+    "Excel": ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet"),
+}
+
+SERVICIOS = ["Hematología", "Medicina Interna", "Oncología Clínica", "Oncología Quirúrgica"]
+GENEROS = ["Masculino", "Femenino", "Otro"]
+
+# Escritura del historial: filas máximas por transacción y reintentos si la base está bloqueada
+HISTORIAL_LOTE_MAX = 500
+HISTORIAL_REINTENTOS = 5
+
+# Trabajos de generación: cuántos se muestran y cada cuánto se refresca la página mientras corren
+TRABAJOS_VISIBLES = 5
+TRABAJOS_SEGUNDOS_REFRESCO = 1.0
+
 # --- Funciones Auxiliares ---
 
 @st.cache_resource # Usa st.cache_resource para que esta función se ejecute una sola vez
-def _crear_estructura_directorios(directorio_base, plantillas_dir, excel_file):
-    """Crea las carpetas de plantillas y el archivo Excel si no existen."""
+def _crear_estructura_directorios(directorio_base, plantillas_dir, excel_file, historial_db):
+    """Crea las carpetas de plantillas y la base del historial si no existen."""
     try:
         subdirs = [
             "Consulta", "Interconsulta", "Recetas",
@@ -24,124 +117,761 @@ def _crear_estructura_directorios(directorio_base, plantillas_dir, excel_file):
         for sub in subdirs:
             os.makedirs(os.path.join(plantillas_dir, sub), exist_ok=True)
 
-        if not os.path.exists(excel_file):
-            df = pd.DataFrame(columns=[
-                'Fecha_Registro', 'Nombre_Completo', 'Num_Historia', 'Num_Registro',
-                'Edad', 'Servicio', 'Diagnostico', 'Fecha_Internacion',
-                'Ocupacion', 'Estado_Civil', 'Genero', 'Residencia', 'Procedencia',
-                'Domicilio', # Nueva columna para el historial
-                'Residente_La_Paz',
-                'Nombre_Referencia1', 'Relacion_Referencia1', 'Telefono_Referencia1', # Nuevas columnas para el historial
-                'Nombre_Referencia2', 'Relacion_Referencia2', 'Telefono_Referencia2', # Nuevas columnas para el historial
-                'Ruta_Carpeta'
-            ])
-            df.to_excel(excel_file, index=False)
+        _inicializar_historial(historial_db, excel_file)
         return True
     except Exception as e:
         st.error(f"Error creando estructura de directorios: {e}")
         return False
 
-def _actualizar_edad(fecha_nacimiento_str):
-    """Calcula edad a partir de la fecha de nacimiento y actualiza el estado de la sesión."""
+@st.cache_resource # Una vez por proceso, en segundo plano: el primer usuario no espera el precalentamiento
+def _precalentar(plantillas_dir, historial_db, directorio_base, _segundos_importaciones):
+    """
+    Parsea las plantillas, crea el pool de render, lee el índice del historial y carga
+    openpyxl mientras el primer usuario completa el formulario. Devuelve el dict de tiempos
+    de arranque por etapa, que el hilo completa al avanzar.
+    """
+    tiempos = {'importaciones': _segundos_importaciones}
+
+    def _ejecutar():
+        try:
+            tiempos.update(motor.precalentar(plantillas_dir))
+
+            inicio = time.perf_counter()
+            with _conectar_historial(historial_db) as conn:
+                # Recorre el índice de búsqueda para que sus páginas queden en la caché del sistema
+                conn.execute("SELECT COUNT(*) FROM historial_terminos").fetchone()
+                conn.execute("SELECT MAX(id) FROM historial").fetchone()
+            _archivo_documentos(directorio_base)
+            tiempos['historial'] = time.perf_counter() - inicio
+
+            inicio = time.perf_counter()
+            importlib.import_module("openpyxl") # Lo usan la exportación a Excel y los lotes .xlsx
+            tiempos['openpyxl'] = time.perf_counter() - inicio
+
+            for etapa in ('importaciones', 'historial', 'openpyxl'):
+                metricas.registrar("arranque", tiempos[etapa], etapa)
+            detalle = ", ".join(f"{etapa} {segundos * 1000:.0f} ms" for etapa, segundos in tiempos.items())
+            print(f"Arranque de la aplicación: {detalle}", file=sys.stderr)
+        except Exception as e:
+            # Sin precalentar, cada etapa se completa en la primera solicitud que la necesita
+            logger.warning("Precalentamiento interrumpido: %s", e, exc_info=True)
+
+    threading.Thread(target=_ejecutar, name="precalentamiento", daemon=True).start()
+    return tiempos
+
+# --- Historial de pacientes (SQLite) ---
+
+@contextlib.contextmanager
+def _conectar_historial(historial_db):
+    """Abre una conexión al historial que confirma (o revierte) y se cierra al salir."""
+    conn = sqlite3.connect(historial_db, timeout=30)
     try:
-        if fecha_nacimiento_str and '/' in fecha_nacimiento_str:
-            d, m, y = fecha_nacimiento_str.split('/')
-            dia, mes = int(d), int(m)
-            año = int(y)
-            if año < 100: # Asume años de 2 dígitos (ej. 98 -> 1998, 05 -> 2005)
-                año_actual_2_dig = date.today().year % 100
-                año += 1900 if año > año_actual_2_dig else 2000
-            nac = date(año, mes, dia)
-            hoy = date.today()
-            edad = hoy.year - nac.year - ((hoy.month, hoy.day) < (nac.month, nac.day))
-            st.session_state.edad = str(edad)
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def _inicializar_historial(historial_db, excel_file):
+    """
+    Crea o actualiza el esquema del historial con sus índices y, la primera vez,
+    migra los registros del antiguo pacientes.xlsx (el archivo original no se modifica).
+    """
+    with _conectar_historial(historial_db) as conn:
+        # WAL: los lectores ven una instantánea consistente y no bloquean al escritor
+        conn.execute("PRAGMA journal_mode=WAL")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= HISTORIAL_VERSION_ESQUEMA:
             return
-        st.session_state.edad = ""
-    except:
-        st.session_state.edad = ""
+        existentes = {fila[1] for fila in conn.execute("PRAGMA table_info(historial)")}
+        if not existentes:
+            columnas = ", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in COLUMNAS_HISTORIAL)
+            conn.execute(f"CREATE TABLE historial (id INTEGER PRIMARY KEY AUTOINCREMENT, {columnas})")
+        else:
+            for c in COLUMNAS_HISTORIAL:
+                if c not in existentes:
+                    conn.execute(f"ALTER TABLE historial ADD COLUMN {c} TEXT NOT NULL DEFAULT ''")
+        for col in ('Num_Historia', 'Num_Registro', 'Fecha_Registro'):
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_historial_{col.lower()} ON historial ({col})")
+        # Índice invertido de palabras normalizadas (sin acentos, minúsculas) para la búsqueda
+        conn.execute("CREATE TABLE IF NOT EXISTS historial_terminos (termino TEXT NOT NULL, id INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_historial_terminos ON historial_terminos (termino, id)")
+        # Censo preagregado: ingresos por mes y por valor de cada dimensión
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS censo (dimension TEXT NOT NULL, mes TEXT NOT NULL, valor TEXT NOT NULL, "
+            "cantidad INTEGER NOT NULL, PRIMARY KEY (dimension, mes, valor))"
+        )
+
+        if version < 1 and os.path.exists(excel_file):
+            df = pd.read_excel(excel_file, dtype=str, keep_default_na=False)
+            _insertar_historial(conn, _normalizar_historial_excel(df))
+        elif version < 2:
+            conn.execute("DELETE FROM historial_terminos")
+            filas = conn.execute(f"SELECT id, {', '.join(COLUMNAS_BUSQUEDA)} FROM historial")
+            conn.executemany(
+                "INSERT INTO historial_terminos (termino, id) VALUES (?, ?)",
+                ((termino, fila[0]) for fila in filas for termino in _terminos_busqueda(*fila[1:]))
+            )
+        if version < 5: # En la versión 5 el censo cuenta cada código y diagnóstico por separado
+            conn.execute("DELETE FROM censo")
+            _sumar_censo(conn, _censo_desde_historial(
+                pd.read_sql_query(f"SELECT {', '.join(COLUMNAS_CENSO)} FROM historial", conn)
+            ))
+        conn.execute(f"PRAGMA user_version = {HISTORIAL_VERSION_ESQUEMA}")
+
+def _normalizar_historial_excel(df):
+    """Adapta un DataFrame leído de Excel al esquema de la base (columnas y fechas ISO)."""
+    df = df.reindex(columns=COLUMNAS_HISTORIAL, fill_value="").fillna("").astype(str)
+    fechas = pd.to_datetime(df['Fecha_Registro'], format=FORMATO_FECHA_REGISTRO, errors='coerce')
+    # Las celdas de fecha de Excel llegan como "2025-02-03 08:00:00": se leen como ISO, y
+    # dayfirst solo se usa con el resto (texto D/M/A, cada valor con su formato), para no
+    # invertir día y mes en las ISO
+    iso = pd.to_datetime(df['Fecha_Registro'].where(fechas.isna()), format="ISO8601", errors='coerce')
+    otras = pd.to_datetime(df['Fecha_Registro'].where(fechas.isna() & iso.isna()),
+                           format="mixed", errors='coerce', dayfirst=True)
+    iso = fechas.fillna(iso).fillna(otras).dt.strftime(FORMATO_FECHA_REGISTRO_ISO)
+    df['Fecha_Registro'] = iso.fillna(df['Fecha_Registro']) # Valores no reconocidos se conservan tal cual
+    return df.to_dict('records')
+
+def _insertar_historial(conn, filas):
+    """
+    Agrega filas al historial (cada fila es un dict con las columnas de COLUMNAS_HISTORIAL),
+    las indexa y suma sus ingresos al censo, todo en la misma transacción.
+    """
+    columnas = ", ".join(COLUMNAS_HISTORIAL)
+    marcadores = ", ".join("?" for _ in COLUMNAS_HISTORIAL)
+    sql = f"INSERT INTO historial ({columnas}) VALUES ({marcadores})"
+    terminos, censo = [], Counter()
+    for fila in filas:
+        valores = [str(fila.get(c, "")) for c in COLUMNAS_HISTORIAL]
+        fila_id = conn.execute(sql, valores).lastrowid
+        terminos.extend((t, fila_id) for t in _terminos_busqueda(*(fila.get(c, "") for c in COLUMNAS_BUSQUEDA)))
+        censo.update(_claves_censo(*(str(fila.get(c, "")) for c in COLUMNAS_CENSO)))
+    conn.executemany("INSERT INTO historial_terminos (termino, id) VALUES (?, ?)", terminos)
+    _sumar_censo(conn, censo)
+
+# --- Censo (agregados por mes del historial) ---
+
+# Columnas del historial que alimentan el censo, en el orden que recibe _claves_censo
+COLUMNAS_CENSO = ['Fecha_Internacion', 'Fecha_Registro', 'Servicio', 'Diagnostico', 'CIE10', 'Edad', 'Residente_La_Paz']
+
+def _mes_censo(fecha_internacion, fecha_registro):
+    """Mes del ingreso (AAAA-MM): el de la internación (DD/MM/AAAA) o, si falta, el del registro."""
+    if re.fullmatch(r"\d{2}/\d{2}/\d{4}", fecha_internacion):
+        return f"{fecha_internacion[6:]}-{fecha_internacion[3:5]}"
+    return fecha_registro[:7] or "Sin fecha"
+
+def _valor_censo(texto):
+    """Diagnóstico o código comparable: sin espacios de más y en mayúsculas."""
+    return " ".join(texto.split()).upper() or "SIN DATO"
+
+def _codigos_censo(cie10):
+    """Códigos CIE-10 del campo, cada uno por separado ("D50.9, C91.0" suma a los dos)."""
+    return extraer_codigos(cie10) or [_valor_censo(cie10)]
+
+def _diagnosticos_censo(diagnostico):
+    """Diagnósticos del campo, separados por ";" como los junta "Agregar diagnóstico"."""
+    return list(dict.fromkeys(_valor_censo(d) for d in diagnostico.split(";") if d.strip())) or [_valor_censo("")]
+
+def _rango_edad(edad):
+    try:
+        edad = int(edad)
+    except (TypeError, ValueError):
+        return "Sin dato"
+    for desde, hasta in RANGOS_EDAD_CENSO:
+        if hasta is None or edad <= hasta:
+            return f"{desde}+" if hasta is None else f"{desde}-{hasta}"
+    return "Sin dato"
+
+def _residencia_censo(residente_la_paz):
+    return "La Paz" if residente_la_paz == "Sí" else "Otros"
+
+def _claves_censo(fecha_internacion, fecha_registro, servicio, diagnostico, cie10, edad, residente_la_paz):
+    """Claves (dimensión, mes, valor) que suma un ingreso al censo."""
+    mes = _mes_censo(fecha_internacion, fecha_registro)
+    return [
+        ('servicio', mes, servicio.strip() or "Sin dato"),
+        *(('diagnostico', mes, valor) for valor in _diagnosticos_censo(diagnostico)),
+        *(('cie10', mes, valor) for valor in _codigos_censo(cie10)),
+        ('edad', mes, _rango_edad(edad)),
+        ('residencia', mes, _residencia_censo(residente_la_paz)),
+    ]
+
+def _censo_desde_historial(df):
+    """
+    Censo completo de un DataFrame con COLUMNAS_CENSO, para recalcularlo de una vez.
+    Cuenta con groupby y solo aplica las funciones de _claves_censo a los valores distintos,
+    así el resultado coincide con el de la suma fila por fila.
+    """
+    df = df.fillna("").astype(str)
+    fi = df['Fecha_Internacion']
+    mes = (fi.str[6:] + "-" + fi.str[3:5]).where(fi.str.fullmatch(r"\d{2}/\d{2}/\d{4}"), df['Fecha_Registro'].str[:7])
+    mes = mes.replace("", "Sin fecha")
+    dimensiones = {
+        'servicio': df['Servicio'].str.strip().replace("", "Sin dato"),
+        'diagnostico': df['Diagnostico'],
+        'cie10': df['CIE10'],
+        'edad': df['Edad'],
+        'residencia': df['Residente_La_Paz'],
+    }
+    transformar = {'diagnostico': _diagnosticos_censo, 'cie10': _codigos_censo,
+                   'edad': _rango_edad, 'residencia': _residencia_censo}
+    censo = Counter()
+    for dimension, valores in dimensiones.items():
+        conteos = pd.DataFrame({'mes': mes, 'valor': valores}).value_counts()
+        if dimension in transformar:
+            # Diagnósticos y códigos dan una lista por campo: explode suma el ingreso a cada uno
+            equivalencias = {v: transformar[dimension](v) for v in conteos.index.unique(level='valor')}
+            conteos = conteos.rename('cantidad').reset_index()
+            conteos['valor'] = conteos['valor'].map(equivalencias)
+            conteos = conteos.explode('valor').groupby(['mes', 'valor'])['cantidad'].sum()
+        censo.update({(dimension, m, v): int(n) for (m, v), n in conteos.items()})
+    return censo
+
+def _sumar_censo(conn, censo):
+    """Suma los conteos {(dimensión, mes, valor): cantidad} a la tabla del censo."""
+    conn.executemany(
+        "INSERT INTO censo (dimension, mes, valor, cantidad) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (dimension, mes, valor) DO UPDATE SET cantidad = cantidad + excluded.cantidad",
+        ((dimension, mes, valor, cantidad) for (dimension, mes, valor), cantidad in censo.items())
+    )
+
+def _leer_censo(historial_db, desde=None, hasta=None):
+    """Filas del censo (dimension, mes, valor, cantidad) entre los meses AAAA-MM indicados."""
+    condiciones, parametros = [], []
+    if desde:
+        condiciones.append("mes >= ?")
+        parametros.append(desde)
+    if hasta:
+        condiciones.append("mes <= ?")
+        parametros.append(hasta)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    with _conectar_historial(historial_db) as conn:
+        return pd.read_sql_query(f"SELECT dimension, mes, valor, cantidad FROM censo {where}", conn, params=parametros)
+
+def _normalizar_texto(texto):
+    """Minúsculas y sin acentos, para comparar 'Pérez' con 'perez'."""
+    descompuesto = unicodedata.normalize("NFKD", str(texto))
+    return "".join(c for c in descompuesto if not unicodedata.combining(c)).lower()
+
+def _terminos_busqueda(*textos):
+    """Palabras normalizadas y sin repetir de los textos dados."""
+    return {t for texto in textos for t in re.findall(r"\w+", _normalizar_texto(texto))}
+
+def _buscar_pacientes(historial_db, consulta, limite=20):
+    """
+    Busca en el historial por N° de historia exacto, o por prefijos de palabras del nombre
+    y del diagnóstico (sin distinguir acentos ni mayúsculas). Devuelve el ingreso más
+    reciente de cada paciente, como lista de dicts.
+    """
+    consulta = consulta.strip()
+    if not consulta:
+        return []
+    terminos = sorted(_terminos_busqueda(consulta))
+    columnas = ", ".join(COLUMNAS_HISTORIAL)
+    with _conectar_historial(historial_db) as conn:
+        conn.row_factory = sqlite3.Row
+        filas = conn.execute(
+            f"SELECT id, {columnas} FROM historial WHERE Num_Historia = ? ORDER BY id DESC LIMIT ?",
+            (consulta, limite)
+        ).fetchall()
+        if terminos:
+            # Un rango por palabra (prefijo) sobre el índice; los ids deben cumplir todas
+            subconsultas = " INTERSECT ".join(
+                "SELECT id FROM historial_terminos WHERE termino >= ? AND termino < ?" for _ in terminos
+            )
+            parametros = [v for t in terminos for v in (t, t + "\U0010ffff")]
+            filas += conn.execute(
+                f"SELECT id, {columnas} FROM historial WHERE id IN ({subconsultas}) ORDER BY id DESC LIMIT ?",
+                (*parametros, limite * 5)
+            ).fetchall()
+
+    resultados, vistos = [], set()
+    for fila in filas:
+        clave = fila['Num_Historia'] or fila['Nombre_Completo']
+        if fila['id'] in vistos or clave in vistos:
+            continue
+        vistos.update((fila['id'], clave))
+        resultados.append(dict(fila))
+        if len(resultados) >= limite:
+            break
+    return resultados
+
+class _EscritorHistorial:
+    """
+    Único escritor del historial por proceso. Las sesiones encolan filas y un hilo
+    en segundo plano las agrupa en lotes, cada uno en una transacción con fsync.
+    Si el lote combinado falla, cada envío se reintenta por separado, así una fila
+    inválida no hace perder las de otras sesiones. Si el hilo no puede seguir (por
+    ejemplo, no abre la base), los envíos pendientes y los nuevos fallan enseguida.
+    """
+
+    def __init__(self, historial_db):
+        self.historial_db = historial_db
+        self._cola = queue.Queue()
+        self._error = None  # Motivo por el que se detuvo el hilo escritor
+        self._lock = threading.Lock()
+        self._hilo = threading.Thread(target=self._ejecutar, name="escritor-historial", daemon=True)
+        self._hilo.start()
+
+    @property
+    def activo(self):
+        return self._error is None
+
+    def agregar(self, filas):
+        """Encola filas para el historial. Devuelve un Future que se resuelve al quedar guardadas."""
+        futuro = Future()
+        with self._lock:
+            if self._error is not None:
+                futuro.set_exception(self._error)
+            else:
+                self._cola.put((list(filas), futuro))
+        return futuro
+
+    def _ejecutar(self):
+        lote = []
+        try:
+            conn = sqlite3.connect(self.historial_db, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=FULL")
+            while True:
+                lote = [self._cola.get()]
+                total = len(lote[0][0])
+                while total < HISTORIAL_LOTE_MAX:
+                    try:
+                        pendiente = self._cola.get_nowait()
+                    except queue.Empty:
+                        break
+                    lote.append(pendiente)
+                    total += len(pendiente[0])
+                self._escribir_lote(conn, lote)
+        except Exception as e:
+            self._detener(e, lote)
+
+    def _detener(self, error, lote):
+        """Marca el escritor como detenido y hace fallar todo lo que espera, sin esperar el timeout."""
+        with self._lock:
+            self._error = error
+            while True:
+                try:
+                    lote.append(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+        for _, futuro in lote:
+            if not futuro.done():
+                futuro.set_exception(error)
+
+    def _escribir_lote(self, conn, lote):
+        error = self._insertar_con_reintentos(conn, [fila for filas, _ in lote for fila in filas])
+        if error is None:
+            for filas, futuro in lote:
+                futuro.set_result(len(filas))
+        elif len(lote) == 1 or (isinstance(error, sqlite3.OperationalError) and "locked" in str(error)):
+            for _, futuro in lote: # La base sigue bloqueada: separar el lote no ayudaría
+                futuro.set_exception(error)
+        else:
+            for envio in lote: # Cada sesión recibe solo su propio error
+                self._escribir_lote(conn, [envio])
+
+    def _insertar_con_reintentos(self, conn, filas):
+        """Inserta las filas en una transacción. Devuelve None si quedaron guardadas, o la excepción."""
+        for intento in range(HISTORIAL_REINTENTOS):
+            try:
+                with conn:
+                    _insertar_historial(conn, filas)
+                return None
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or intento == HISTORIAL_REINTENTOS - 1:
+                    return e
+                time.sleep(0.1 * 2 ** intento) # Otro proceso tiene la base bloqueada
+            except Exception as e:
+                return e
+
+# Un solo escritor por base y por proceso; si se detuvo, la próxima sesión crea otro
+@st.cache_resource(validate=lambda escritor: escritor.activo)
+def _obtener_escritor_historial(historial_db):
+    return _EscritorHistorial(historial_db)
+
+class _VistaHistorial:
+    """
+    Vista de solo lectura del historial, compartida por todas las sesiones del proceso.
+    Guarda solo COLUMNAS_VISTA_HISTORIAL y, al consultarla, trae únicamente las filas
+    agregadas desde la última vez (el historial solo crece). Ordena y pagina en el
+    servidor: cada sesión recibe solo la página visible.
+    """
+
+    def __init__(self, historial_db):
+        self.historial_db = historial_db
+        self._df = pd.DataFrame(columns=['id', *COLUMNAS_VISTA_HISTORIAL])
+        self._ultimo_id = 0
+        self._ordenes = {}  # (columna, descendente) -> posiciones de las filas en ese orden
+        self._lock = threading.Lock()
+
+    def _actualizar(self):
+        with _conectar_historial(self.historial_db) as conn:
+            ultimo_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM historial").fetchone()[0]
+            if ultimo_id == self._ultimo_id:
+                return
+            nuevas = pd.read_sql_query(
+                f"SELECT id, {', '.join(COLUMNAS_VISTA_HISTORIAL)} FROM historial WHERE id > ? ORDER BY id",
+                conn, params=(self._ultimo_id,)
+            )
+        df = pd.concat([self._df, nuevas], ignore_index=True) if len(self._df) else nuevas
+        if len(df) > HISTORIAL_VISTA_MAX_FILAS:
+            df = df.iloc[-HISTORIAL_VISTA_MAX_FILAS:].reset_index(drop=True)
+        for col in COLUMNAS_CATEGORICAS_HISTORIAL:
+            df[col] = df[col].astype(str).astype('category')
+        self._df, self._ultimo_id = df, ultimo_id # Las páginas ya entregadas siguen usando la anterior
+        self._ordenes.clear()
+
+    def _posiciones(self, df, columna, descendente):
+        """Orden de las filas según la columna, calculado una vez por versión de la vista."""
+        posiciones = self._ordenes.get((columna, descendente))
+        if posiciones is None:
+            if columna == 'Edad':
+                clave = pd.to_numeric(df[columna].astype(str), errors='coerce')
+            elif columna == 'Fecha_Internacion':
+                clave = pd.to_datetime(df[columna], format="%d/%m/%Y", errors='coerce')
+            else:
+                clave = df[columna].astype(str) # Fecha_Registro está en ISO: ordena como fecha
+            posiciones = clave.reset_index(drop=True).sort_values(
+                ascending=not descendente, kind='stable', na_position='last'
+            ).index.to_numpy()
+            self._ordenes[(columna, descendente)] = posiciones
+        return posiciones
+
+    def total(self):
+        """Cantidad de filas en la vista, incluidas las recién agregadas."""
+        with self._lock:
+            self._actualizar()
+            return len(self._df)
+
+    def pagina(self, numero, tamaño, columna=None, descendente=True):
+        """
+        Devuelve (DataFrame con la página `numero` (desde 1), total de filas). Sin columna,
+        el orden es el de registro. Fecha_Registro se devuelve en formato de visualización.
+        """
+        with self._lock:
+            self._actualizar()
+            df = self._df
+            inicio = (numero - 1) * tamaño
+            if columna:
+                filas = df.iloc[self._posiciones(df, columna, descendente)[inicio:inicio + tamaño]]
+            elif descendente:
+                filas = df.iloc[::-1].iloc[inicio:inicio + tamaño]
+            else:
+                filas = df.iloc[inicio:inicio + tamaño]
+        pagina = filas.drop(columns='id').astype(str).reset_index(drop=True)
+        fechas = pd.to_datetime(pagina['Fecha_Registro'], format=FORMATO_FECHA_REGISTRO_ISO, errors='coerce')
+        pagina['Fecha_Registro'] = fechas.dt.strftime(FORMATO_FECHA_REGISTRO).fillna(pagina['Fecha_Registro'])
+        return pagina, len(df)
+
+@st.cache_resource # Una sola vista por base y por proceso
+def _obtener_vista_historial(historial_db):
+    return _VistaHistorial(historial_db)
+
+def _leer_historial(historial_db, desde=None, hasta=None, servicios=()):
+    """
+    Devuelve el historial como DataFrame, con las fechas en formato de visualización.
+    Los filtros (rango de Fecha_Registro y servicios) se aplican en la consulta.
+    """
+    condiciones, parametros = [], []
+    if desde:
+        condiciones.append("Fecha_Registro >= ?")
+        parametros.append(desde.strftime("%Y-%m-%d"))
+    if hasta:
+        condiciones.append("Fecha_Registro < ?") # Hasta el final del día indicado
+        parametros.append((hasta + timedelta(days=1)).strftime("%Y-%m-%d"))
+    if servicios:
+        condiciones.append(f"Servicio IN ({', '.join('?' for _ in servicios)})")
+        parametros.extend(servicios)
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    with _conectar_historial(historial_db) as conn:
+        df = pd.read_sql_query(
+            f"SELECT {', '.join(COLUMNAS_HISTORIAL)} FROM historial {where} ORDER BY id", conn, params=parametros
+        )
+    fechas = pd.to_datetime(df['Fecha_Registro'], format=FORMATO_FECHA_REGISTRO_ISO, errors='coerce')
+    df['Fecha_Registro'] = fechas.dt.strftime(FORMATO_FECHA_REGISTRO).fillna(df['Fecha_Registro'])
+    return df
+
+def _version_historial(historial_db):
+    """Último id del historial. Como solo se agregan filas, cambia cada vez que cambia el contenido."""
+    with _conectar_historial(historial_db) as conn:
+        return conn.execute("SELECT COALESCE(MAX(id), 0) FROM historial").fetchone()[0]
+
+@st.cache_data(max_entries=8, show_spinner=False)
+def _exportar_historial(historial_db, version, formato, desde, hasta, servicios):
+    """
+    Serializa el historial filtrado en el formato pedido y devuelve (bytes, filas).
+    `version` solo forma parte de la clave del caché: una fila nueva invalida la exportación.
+    """
+    df = _leer_historial(historial_db, desde, hasta, servicios)
+    buffer = io.BytesIO()
+    if formato == "CSV":
+        df.to_csv(buffer, index=False, encoding="utf-8-sig") # Con BOM para que Excel respete los acentos
+    elif formato == "Parquet":
+        df.to_parquet(buffer, index=False)
+    else:
+        df.to_excel(buffer, index=False)
+    return buffer.getvalue(), len(df)
+
+def _clave_exportacion(historial_db):
+    """Parámetros de la exportación según los filtros elegidos y el contenido actual del historial."""
+    return (
+        historial_db, _version_historial(historial_db), st.session_state.formato_exportacion,
+        st.session_state.exportar_desde, st.session_state.exportar_hasta,
+        tuple(st.session_state.exportar_servicios)
+    )
+
+def _preparar_exportacion_callback(historial_db):
+    """Genera la exportación solo cuando se pide; la descarga queda disponible mientras nada cambie."""
+    clave = _clave_exportacion(historial_db)
+    try:
+        _exportar_historial(*clave)
+    except ImportError:
+        st.error("La exportación a Parquet requiere el paquete pyarrow.")
+        return
+    except Exception as e:
+        st.error(f"Error exportando historial: {e}")
+        return
+    st.session_state.exportacion_historial = clave
+
+def _actualizar_edad(fecha_nacimiento_str):
+    """Calcula edad a partir de la fecha de nacimiento y actualiza el estado de la sesión."""
+    st.session_state.edad = motor.calcular_edad(fecha_nacimiento_str)
 
 def _actualizar_num_registro(fecha_nacimiento_str):
     """Genera el número de registro (DDMMAA) y actualiza el estado de la sesión."""
+    st.session_state.num_registro = motor.calcular_num_registro(fecha_nacimiento_str)
+
+def _leer_zip_generado(archivo):
+    """Lee y cierra el ZIP temporal. Es la única copia completa: la que guarda Streamlit."""
+    with archivo:
+        archivo.seek(0)
+        return archivo.read()
+
+# --- Datos del paciente ---
+
+def _paciente_desde_sesion():
+    """Datos del paciente tal como están cargados en el formulario."""
+    return {campo: st.session_state[campo] for campo in motor.CAMPOS_PACIENTE}
+
+def _fila_historial(paciente, ruta_carpeta_simulada, clave_archivo=""):
+    """Registro del historial correspondiente a una generación para este paciente."""
+    return {
+        'Fecha_Registro': datetime.now().strftime(FORMATO_FECHA_REGISTRO_ISO),
+        'Nombre_Completo': motor.nombre_completo(paciente),
+        'Num_Historia': paciente['num_historia'],
+        'Num_Registro': paciente['num_registro'],
+        'Edad': paciente['edad'],
+        'Servicio': paciente['servicio'],
+        'Diagnostico': paciente['diagnosticos'],
+        'Fecha_Internacion': paciente['fecha_internacion'].strftime("%d/%m/%Y"),
+        'Ocupacion': paciente['ocupacion'],
+        'Estado_Civil': paciente['estado_civil'],
+        'Genero': paciente['genero'],
+        'Residencia': paciente['residencia'],
+        'Procedencia': paciente['procedencia'],
+        'Domicilio': paciente['domicilio'], # NUEVO
+        'Residente_La_Paz': "Sí" if paciente['es_residente_la_paz'] else "No",
+        'Nombre_Referencia1': paciente['n_referencia1'], # NUEVO
+        'Relacion_Referencia1': paciente['referencia1'],
+        'Telefono_Referencia1': paciente['telefono_referencia1'], # NUEVO
+        'Nombre_Referencia2': paciente['n_referencia2'], # NUEVO
+        'Relacion_Referencia2': paciente['referencia2'],
+        'Telefono_Referencia2': paciente['telefono_referencia2'], # NUEVO
+        'Ruta_Carpeta': ruta_carpeta_simulada,
+        'Nombres': paciente['nombres'].strip(),
+        'Apellido_Paterno': paciente['apellido_paterno'].strip(),
+        'Apellido_Materno': paciente['apellido_materno'].strip(),
+        'Fecha_Nacimiento': paciente['fecha_nacimiento_str'],
+        'Diagnostico_Recetas_Labs': paciente['diag_recetas_labs'],
+        'CIE10': paciente['cie10'],
+        'Archivo_Documentos': clave_archivo or ""
+    }
+
+# --- Generación por lotes ---
+
+def _calcular_edad_y_registro(fechas):
+    """
+    Versión vectorizada de _actualizar_edad y _actualizar_num_registro para una Serie
+    de fechas DD/MM/AA o DD/MM/AAAA. Devuelve (edades, numeros_registro) como texto.
+    """
+    partes = fechas.fillna("").astype(str).str.strip().str.extract(r"^(\d{1,2})/(\d{1,2})/(\d{2}|\d{4})$")
+    hoy = date.today()
+    anio = pd.to_numeric(partes[2])
+    siglo = (anio > hoy.year % 100).map({True: 1900, False: 2000}) # Años de 2 dígitos (98 -> 1998, 05 -> 2005)
+    anio = anio.where(partes[2].str.len() != 2, anio + siglo)
+    nac = pd.to_datetime(
+        pd.DataFrame({'year': anio, 'month': pd.to_numeric(partes[1]), 'day': pd.to_numeric(partes[0])}),
+        errors='coerce'
+    )
+    cumple_pendiente = (nac.dt.month > hoy.month) | ((nac.dt.month == hoy.month) & (nac.dt.day > hoy.day))
+    edades = (hoy.year - nac.dt.year - cumple_pendiente.astype(int)).astype('Int64').astype(str)
+    edades = edades.where(nac.notna(), "")
+    registros = (partes[0].str.zfill(2) + partes[1].str.zfill(2) + partes[2].str[-2:]).fillna("")
+    return edades, registros
+
+def _pacientes_desde_tabla(df):
+    """Convierte un bloque del archivo de lote (columnas del historial) en datos de paciente."""
+    df = df.fillna("").astype(str)
+    vacia = pd.Series("", index=df.index)
+    tabla = pd.DataFrame({campo: df.get(col, vacia).str.strip() for col, campo in COLUMNAS_LOTE.items()})
+
+    sin_nombre = (tabla['nombres'] == "") & (tabla['apellido_paterno'] == "")
+    if sin_nombre.any() and 'Nombre_Completo' in df:
+        separados = df.loc[sin_nombre, 'Nombre_Completo'].map(motor.separar_nombre_completo)
+        tabla.loc[sin_nombre, ['nombres', 'apellido_paterno', 'apellido_materno']] = separados.tolist()
+
+    edades, registros = _calcular_edad_y_registro(tabla['fecha_nacimiento_str'])
+    tabla['edad'] = edades.where(edades != "", df.get('Edad', vacia))
+    tabla['num_registro'] = registros.where(registros != "", df.get('Num_Registro', vacia))
+    tabla['es_residente_la_paz'] = (
+        df.get('Residente_La_Paz', vacia).map(_normalizar_texto).str.strip().isin(["si", "s", "true", "1", "x"])
+    )
+    internacion = df.get('Fecha_Internacion', vacia).str.strip()
+    fechas = pd.to_datetime(internacion, format="%d/%m/%Y", errors='coerce')
+    tabla['fecha_internacion'] = [
+        f.date() if not pd.isna(f) else (date.today() if not texto else None)
+        for f, texto in zip(fechas, internacion)
+    ]
+    return tabla.to_dict('records')
+
+def _leer_archivo_lote(nombre, contenido):
+    """
+    Lee el CSV o Excel del lote (`contenido` en bytes). Devuelve (cantidad de filas, bloques),
+    donde los bloques son DataFrames de LOTE_FILAS_POR_BLOQUE filas.
+    """
+    if nombre.lower().endswith('.csv'):
+        # sep=None detecta ',' o ';' (Excel en español exporta CSV con ';')
+        opciones = dict(dtype=str, keep_default_na=False, sep=None, engine='python', encoding='utf-8-sig')
+        # Una primera pasada con una sola columna alcanza para contar las filas sin cargar el archivo
+        total = len(pd.read_csv(io.BytesIO(contenido), usecols=[0], **opciones))
+        return total, pd.read_csv(io.BytesIO(contenido), chunksize=LOTE_FILAS_POR_BLOQUE, **opciones)
+    df = pd.read_excel(io.BytesIO(contenido), dtype=str, keep_default_na=False)
+    return len(df), (df.iloc[inicio:inicio + LOTE_FILAS_POR_BLOQUE] for inicio in range(0, len(df), LOTE_FILAS_POR_BLOQUE))
+
+def _archivo_documentos(directorio_base):
+    """Archivo de documentos generados de la aplicación (carpeta ARCHIVO), compartido por el proceso."""
+    return motor.obtener_archivo(os.path.join(directorio_base, "ARCHIVO"))
+
+# --- Trabajos de generación en segundo plano ---
+
+def _cola_trabajos(directorio_base):
+    """Cola de trabajos de generación (resultados en la carpeta TRABAJOS), compartida por el proceso."""
+    return trabajos.obtener_cola(os.path.join(directorio_base, "TRABAJOS"))
+
+def _cliente_trabajos():
+    """
+    Identificador del navegador para sus trabajos. Va en la URL (?cliente=...), así que
+    recargar la página vuelve a mostrar los trabajos en curso y los resultados terminados.
+    """
+    cliente = st.query_params.get("cliente")
+    if not cliente:
+        cliente = st.query_params["cliente"] = uuid.uuid4().hex
+    return cliente
+
+def _enviar_trabajo(directorio_base, descripcion, total, funcion):
+    """Encola un trabajo de este navegador; informa si la cola o el navegador están al límite."""
     try:
-        if fecha_nacimiento_str and '/' in fecha_nacimiento_str:
-            d, m, y = fecha_nacimiento_str.split('/')
-            dia = d.zfill(2)
-            mes = m.zfill(2)
-            año = y[-2:] if len(y) >= 2 else y.zfill(2) # Obtener los últimos 2 dígitos
-            num_registro = f"{dia}{mes}{año}"
-            st.session_state.num_registro = num_registro
-            return
-        st.session_state.num_registro = ""
-    except:
-        st.session_state.num_registro = ""
+        _cola_trabajos(directorio_base).enviar(_cliente_trabajos(), descripcion, total, funcion)
+    except trabajos.LimiteTrabajos as e:
+        st.error(str(e))
 
-def _replace_placeholders(doc, data):
-    """
-    Reemplaza marcadores en .docx con los datos proporcionados.
-    Intenta preservar el formato original de los runs.
-    """
-    # Párrafos
-    for p in doc.paragraphs:
-        for key, val in data.items():
-            if key in p.text:
-                for run in p.runs:
-                    if key in run.text:
-                        run.text = run.text.replace(key, str(val))
-    # Tablas
-    for tbl in doc.tables:
-        for row in tbl.rows:
-            for cell in row.cells:
-                for p in cell.paragraphs:
-                    for key, val in data.items():
-                        if key in p.text:
-                            for run in p.runs:
-                                if key in run.text:
-                                    run.text = run.text.replace(key, str(val))
-    # Encabezados y pies de página
-    for sec in doc.sections:
-        for hf in (sec.header, sec.footer):
-            for p in hf.paragraphs:
-                for key, val in data.items():
-                    if key in p.text:
-                        for run in p.runs:
-                            if key in run.text:
-                                run.text = run.text.replace(key, str(val))
-
-def _guardar_en_excel(excel_file, ruta_carpeta_simulada):
-    """Guarda la entrada del paciente en el historial Excel."""
+def _guardar_historial_trabajo(trabajo, escritor, filas):
+    """
+    Agrega las filas al historial en una sola inserción, sin reescribir nada. Corre en el
+    hilo del trabajo: si falla, el error queda en el trabajo como advertencia.
+    """
     try:
-        df = pd.read_excel(excel_file) if os.path.exists(excel_file) else pd.DataFrame()
-        nombre_comp = f"{st.session_state.nombres.strip()} {st.session_state.apellido_paterno.strip()} {st.session_state.apellido_materno.strip()}".strip()
-        fila = {
-            'Fecha_Registro': datetime.now().strftime("%d/%m/%Y %H:%M"),
-            'Nombre_Completo': nombre_comp,
-            'Num_Historia': st.session_state.num_historia,
-            'Num_Registro': st.session_state.num_registro,
-            'Edad': st.session_state.edad,
-            'Servicio': st.session_state.servicio,
-            'Diagnostico': st.session_state.diagnosticos,
-            'Fecha_Internacion': st.session_state.fecha_internacion.strftime("%d/%m/%Y"),
-            'Ocupacion': st.session_state.ocupacion,
-            'Estado_Civil': st.session_state.estado_civil,
-            'Genero': st.session_state.genero,
-            'Residencia': st.session_state.residencia,
-            'Procedencia': st.session_state.procedencia,
-            'Domicilio': st.session_state.domicilio, # NUEVO
-            'Residente_La_Paz': "Sí" if st.session_state.es_residente_la_paz else "No",
-            'Nombre_Referencia1': st.session_state.n_referencia1, # NUEVO
-            'Relacion_Referencia1': st.session_state.referencia1,
-            'Telefono_Referencia1': st.session_state.telefono_referencia1, # NUEVO
-            'Nombre_Referencia2': st.session_state.n_referencia2, # NUEVO
-            'Relacion_Referencia2': st.session_state.referencia2,
-            'Telefono_Referencia2': st.session_state.telefono_referencia2, # NUEVO
-            'Ruta_Carpeta': ruta_carpeta_simulada
-        }
-        df = pd.concat([df, pd.DataFrame([fila])], ignore_index=True)
-        df.to_excel(excel_file, index=False)
-        return True
+        with metricas.medir("guardar_historial"):
+            escritor.agregar(filas).result(timeout=60)
     except Exception as e:
-        st.warning(f"Advertencia: Error guardando historial en Excel: {e}")
-        return False
+        trabajo.errores.append(f"Error guardando historial: {e}")
+
+def _generar_lote(trabajo, nombre, contenido, seleccionadas, plantillas_dir, archivo_docs, escritor, imprimir):
+    """
+    Trabajo de lote: genera las plantillas seleccionadas para cada paciente del archivo.
+    Produce un único ZIP con una carpeta por paciente (con `imprimir`, cada una incluye además
+    sus documentos unidos en uno solo) y registra el historial al final.
+    """
+    total_filas, bloques = _leer_archivo_lote(nombre, contenido)
+    trabajo.total = total_filas * len(seleccionadas)
+    filas_historial, errores_filas, carpetas = [], [], set()
+    total_docs = 0
+    _, zf = motor.nuevo_zip(trabajo.ruta_resultado)
+    with zf:
+        for bloque in bloques:
+            for n, paciente in zip(bloque.index, _pacientes_desde_tabla(bloque)):
+                if trabajo.cancelado():
+                    return
+                fila_n = n + 2 # La fila 1 es el encabezado
+                error = motor.validar_paciente(paciente)
+                if error:
+                    errores_filas.append(f"Fila {fila_n}: {error}")
+                    trabajo.avanzar(f"Fila {fila_n}", len(seleccionadas))
+                    continue
+                carpeta = base_carpeta = motor.nombre_carpeta(paciente)
+                repeticion = 1
+                while carpeta in carpetas:
+                    repeticion += 1
+                    carpeta = f"{base_carpeta} ({repeticion})"
+                carpetas.add(carpeta)
+
+                data = motor.datos_reemplazo(paciente)
+                contenidos = [] if imprimir else None
+                generados, errores = motor.escribir_documentos_zip(
+                    zf, carpeta, motor.nombre_completo(paciente), seleccionadas, plantillas_dir, data, archivo_docs,
+                    lambda plantilla: trabajo.avanzar(f"{carpeta}: {plantilla}"), trabajo.evento_cancelar, contenidos
+                )
+                if trabajo.cancelado():
+                    return # Paciente incompleto: no se une para imprimir ni se archiva
+                if contenidos:
+                    try:
+                        combinado = io.BytesIO()
+                        motor.combinar_documentos(contenidos, combinado)
+                        zf.writestr(f"{carpeta}/{carpeta} - para imprimir.docx", combinado.getvalue())
+                    except Exception as e:
+                        errores.append(f"Documento para imprimir: {e}")
+                errores_filas.extend(f"Fila {fila_n}: {e}" for e in errores)
+                if generados:
+                    manifiesto = motor.archivar_generacion(archivo_docs, carpeta, generados, data)
+                    filas_historial.append(_fila_historial(paciente, carpeta, manifiesto))
+                    total_docs += len(generados)
+        if errores_filas:
+            zf.writestr("errores.txt", "\n".join(errores_filas))
+
+    if trabajo.cancelado():
+        return
+    if not filas_historial:
+        raise ValueError("❌ No se generaron documentos.\n" + "\n".join(errores_filas))
+
+    _guardar_historial_trabajo(trabajo, escritor, filas_historial) # Una sola inserción para todo el lote
+    metricas.fin_de_solicitud()
+
+    msg = f"✅ Lote procesado: {total_docs} documentos para {len(filas_historial)} pacientes."
+    if errores_filas:
+        msg += f"\n\n⚠️ **{len(errores_filas)} errores** (también incluidos en errores.txt dentro del ZIP):\n" + "\n".join(errores_filas)
+    trabajo.mensaje = msg
+    trabajo.nombre_archivo = f"lote_{datetime.now().strftime('%Y%m%d_%H%M')}.zip"
+
+def _generar_lote_callback(directorio_base, plantillas_dir, historial_db):
+    """Encola la generación del archivo de lote como un trabajo en segundo plano."""
+    archivo = st.session_state.get("archivo_lote")
+    if archivo is None:
+        st.error("Suba un archivo CSV o Excel con los pacientes del lote.")
+        return
+    seleccionadas = _plantillas_seleccionadas()
+    if not seleccionadas:
+        st.error("Seleccione al menos una plantilla para generar documentos.")
+        return
+    # El archivo subido solo vive en esta sesión: el trabajo recibe una copia de su contenido
+    nombre, contenido = archivo.name, archivo.getvalue()
+    archivo_docs, escritor = _archivo_documentos(directorio_base), _obtener_escritor_historial(historial_db)
+    imprimir = st.session_state.get("documento_para_imprimir", False)
+    _enviar_trabajo(
+        directorio_base, f"Lote {nombre}", 0,
+        lambda trabajo: _generar_lote(trabajo, nombre, contenido, seleccionadas, plantillas_dir, archivo_docs,
+                                      escritor, imprimir)
+    )
 
 def _limpiar_campos():
     """Restablece todos los campos de entrada a su estado inicial."""
@@ -172,139 +902,408 @@ def _limpiar_campos():
     st.session_state.observaciones = ""
     st.session_state.indicaciones = ""
     st.session_state.fecha_internacion = date.today()
+    st.session_state.busqueda_paciente = ""
+    st.session_state.busqueda_cie10 = ""
 
     for key in list(st.session_state.plantillas_vars.keys()):
         st.session_state.plantillas_vars[key] = False
+        st.session_state[key] = False
     for key in list(st.session_state.keys()):
         if key.startswith("select_all_"):
             st.session_state[key] = False
 
-def _generar_documentos_callback(directorio_base, plantillas_dir, excel_file):
+def _cargar_paciente_del_historial(historial_db):
+    """Completa el formulario con el ingreso del historial elegido en la búsqueda."""
+    fila = st.session_state.get("resultados_busqueda", {}).get(st.session_state.get("paciente_encontrado"))
+    if not fila:
+        return
+    nombres, paterno, materno = fila['Nombres'], fila['Apellido_Paterno'], fila['Apellido_Materno']
+    if not (nombres or paterno):
+        # Registros anteriores solo guardaban el nombre completo
+        nombres, paterno, materno = motor.separar_nombre_completo(fila['Nombre_Completo'])
+
+    st.session_state.nombres = nombres
+    st.session_state.apellido_paterno = paterno
+    st.session_state.apellido_materno = materno
+    st.session_state.fecha_nacimiento_str = fila['Fecha_Nacimiento']
+    if fila['Fecha_Nacimiento']:
+        _actualizar_edad(fila['Fecha_Nacimiento'])
+        _actualizar_num_registro(fila['Fecha_Nacimiento'])
+    else:
+        st.session_state.edad = fila['Edad']
+        st.session_state.num_registro = fila['Num_Registro']
+    st.session_state.num_historia = fila['Num_Historia']
+    st.session_state.ocupacion = fila['Ocupacion']
+    st.session_state.estado_civil = fila['Estado_Civil']
+    st.session_state.residencia = fila['Residencia']
+    if fila['Genero'] in GENEROS:
+        st.session_state.genero = fila['Genero']
+    st.session_state.procedencia = fila['Procedencia']
+    st.session_state.domicilio = fila['Domicilio']
+    st.session_state.es_residente_la_paz = fila['Residente_La_Paz'] == "Sí"
+    st.session_state.n_referencia1 = fila['Nombre_Referencia1']
+    st.session_state.referencia1 = fila['Relacion_Referencia1']
+    st.session_state.telefono_referencia1 = fila['Telefono_Referencia1']
+    st.session_state.n_referencia2 = fila['Nombre_Referencia2']
+    st.session_state.referencia2 = fila['Relacion_Referencia2']
+    st.session_state.telefono_referencia2 = fila['Telefono_Referencia2']
+    st.session_state.diagnosticos = fila['Diagnostico']
+    st.session_state.diag_recetas_labs = fila['Diagnostico_Recetas_Labs']
+    st.session_state.cie10 = fila['CIE10']
+    if fila['Servicio'] in SERVICIOS:
+        st.session_state.servicio = fila['Servicio']
+
+def _usar_diagnostico_cie10(agregar):
     """
-    Función callback para generar los documentos seleccionados.
-    Prepara un archivo ZIP con los documentos y ofrece la descarga.
+    Pasa el diagnóstico elegido en la búsqueda CIE-10 a los campos CIE-10 y Diagnósticos
+    (que llenan {{CIE10}} y {{DIAGNOSTICOS}}). Con `agregar`, lo suma a los que ya había.
     """
-    # Validaciones básicas
-    if not st.session_state.nombres.strip():
-        st.error("Por favor, ingrese los Nombres del paciente.")
-        return
-    if not st.session_state.apellido_paterno.strip():
-        st.error("Por favor, ingrese el Apellido Paterno del paciente.")
-        return
-    if not st.session_state.diagnosticos.strip():
-        st.error("Por favor, ingrese el Diagnóstico del paciente.")
+    elegido = st.session_state.get("sugerencias_cie10", {}).get(st.session_state.get("diagnostico_cie10"))
+    if not elegido:
         return
+    codigo, descripcion = elegido
+    codigos, diagnosticos = st.session_state.cie10.strip(), st.session_state.diagnosticos.strip()
+    if agregar and codigos:
+        st.session_state.cie10 = f"{codigos}, {codigo}"
+        st.session_state.diagnosticos = f"{diagnosticos}; {descripcion}" if diagnosticos else descripcion
+    else:
+        st.session_state.cie10 = codigo
+        st.session_state.diagnosticos = descripcion
+    st.session_state.busqueda_cie10 = ""
 
-    # Obtener plantillas seleccionadas
+def _plantillas_seleccionadas():
+    """Plantillas marcadas en la sección de selección, como dicts {'carpeta', 'archivo'}."""
     seleccionadas = []
     for k, v in st.session_state.plantillas_vars.items():
         if v:
             folder, filename = k.split(':', 1)
             seleccionadas.append({'carpeta': folder, 'archivo': filename})
+    return seleccionadas
 
-    if not seleccionadas:
-        st.error("Seleccione al menos una plantilla para generar documentos.")
+def _generar_documentos(trabajo, paciente, seleccionadas, plantillas_dir, archivo_docs, escritor, imprimir):
+    """
+    Trabajo de generación para un paciente: arma el ZIP en el resultado del trabajo y lo registra.
+    Con `imprimir`, también deja los documentos unidos en un solo .docx para imprimir.
+    """
+    ruta_combinado = trabajo.ruta_adicional(".docx") if imprimir else None
+    resultado = motor.generar_zip(
+        paciente, seleccionadas, plantillas_dir, destino=trabajo.ruta_resultado, archivo_docs=archivo_docs,
+        al_avanzar=trabajo.avanzar, cancelar=trabajo.evento_cancelar, destino_combinado=ruta_combinado
+    )
+    nombre_carpeta_sanitized, generados, errores = resultado.carpeta, resultado.generados, resultado.errores
+    if trabajo.cancelado():
         return
+    if not generados:
+        msg = "❌ No se generaron documentos."
+        if errores:
+            msg += "\n" + "\n".join(errores)
+        raise ValueError(msg)
 
-    # Preparar datos para reemplazo en la plantilla
-    nombre_comp = f"{st.session_state.nombres.strip()} {st.session_state.apellido_paterno.strip()} {st.session_state.apellido_materno.strip()}".strip()
-    data = {
-        '{{NOMBRE_COMPLETO}}': nombre_comp,
-        '{{NOMBRES}}': st.session_state.nombres.strip(),
-        '{{APELLIDO_PATERNO}}': st.session_state.apellido_paterno.strip(),
-        '{{APELLIDO_MATERNO}}': st.session_state.apellido_materno.strip(),
-        '{{FECHA_NACIMIENTO}}': st.session_state.fecha_nacimiento_str,
-        '{{EDAD}}': st.session_state.edad,
-        '{{FECHA_INTERNACION}}': st.session_state.fecha_internacion.strftime("%d/%m/%Y"),
-        '{{NUM_HISTORIA}}': st.session_state.num_historia,
-        '{{NUM_REGISTRO}}': st.session_state.num_registro,
-        '{{OCUPACION}}': st.session_state.ocupacion,
-        '{{ESTADO_CIVIL}}': st.session_state.estado_civil,
-        '{{RESIDENCIA}}': st.session_state.residencia,
-        '{{GENERO}}': st.session_state.genero,
-        '{{PROCEDENCIA}}': st.session_state.procedencia,
-        '{{DOMICILIO}}': st.session_state.domicilio, # NUEVO MARCADO
-        '{{ES_RESIDENTE_LA_PAZ}}': "Sí" if st.session_state.es_residente_la_paz else "No",
-        '{{N_REFERENCIA1}}': st.session_state.n_referencia1,
-        '{{REFERENCIA1}}': st.session_state.referencia1,
-        '{{TELEFONO_REFERENCIA1}}': st.session_state.telefono_referencia1, # NUEVO MARCADO
-        '{{N_REFERENCIA2}}': st.session_state.n_referencia2,
-        '{{REFERENCIA2}}': st.session_state.referencia2,
-        '{{TELEFONO_REFERENCIA2}}': st.session_state.telefono_referencia2, # NUEVO MARCADO
-        '{{DIAGNOSTICOS}}': st.session_state.diagnosticos,
-        '{{DIAG_RECETAS_LABS}}': st.session_state.diag_recetas_labs,
-        '{{CIE10}}': st.session_state.cie10,
-        '{{SERVICIO}}': st.session_state.servicio,
-        '{{OBSERVACIONES}}': st.session_state.observaciones,
-        '{{INDICACIONES}}': st.session_state.indicaciones
-    }
+    _guardar_historial_trabajo(trabajo, escritor,
+                               [_fila_historial(paciente, nombre_carpeta_sanitized, resultado.manifiesto)])
+    metricas.fin_de_solicitud()
 
-    # Crear nombre de carpeta "virtual" para el ZIP y sanitizarlo
-    nombre_carpeta_raw = f"{nombre_comp} - {st.session_state.num_historia} - {st.session_state.diagnosticos.strip()}"
-    nombre_carpeta_sanitized = re.sub(r'[<>:"/\\|?*]', '_', nombre_carpeta_raw)
+    msg = f"✅ Se generaron {len(generados)} documentos. Haga clic en 'Descargar' para obtener el archivo ZIP.\n"
+    por_cat = {}
+    for d in generados:
+        por_cat.setdefault(d['cat'], []).append(d['file'])
+    for cat, files in por_cat.items():
+        msg += f"\n📁 **{cat}**\n"
+        for f in files:
+            msg += f" • {f}\n"
+    if errores:
+        msg += "\n\n⚠️ **Errores al generar algunos documentos:**\n" + "\n".join(errores)
+    trabajo.mensaje = msg
+    trabajo.nombre_archivo = f"{nombre_carpeta_sanitized}.zip"
+    if resultado.combinado:
+        trabajo.adicionales[ruta_combinado] = f"{nombre_carpeta_sanitized} - para imprimir.docx"
 
-    generados_buffer = io.BytesIO()
-    with zipfile.ZipFile(generados_buffer, 'w') as zf:
-        generados, errores = [], []
+def _generar_documentos_callback(directorio_base, plantillas_dir, historial_db):
+    """
+    Función callback para generar los documentos seleccionados.
+    Valida los datos y encola la generación; el ZIP se descarga desde la sección de trabajos.
+    """
+    paciente = motor.completar_paciente(_paciente_desde_sesion())
+    seleccionadas = _plantillas_seleccionadas()
+    error = motor.validar_paciente(paciente)
+    if not error and not seleccionadas:
+        error = "Seleccione al menos una plantilla para generar documentos."
+    if error: # Datos obligatorios faltantes o ninguna plantilla seleccionada
+        st.error(error)
+        return
+    archivo_docs, escritor = _archivo_documentos(directorio_base), _obtener_escritor_historial(historial_db)
+    imprimir = st.session_state.get("documento_para_imprimir", False)
+    _enviar_trabajo(
+        directorio_base, motor.nombre_completo(paciente), len(seleccionadas),
+        lambda trabajo: _generar_documentos(trabajo, paciente, seleccionadas, plantillas_dir, archivo_docs,
+                                            escritor, imprimir)
+    )
 
-        for v in seleccionadas:
-            ruta_plantilla = os.path.join(plantillas_dir, v['carpeta'], v['archivo'])
-            if os.path.exists(ruta_plantilla):
-                try:
-                    doc = Document(ruta_plantilla)
-                    _replace_placeholders(doc, data)
-                    base = v['archivo'].replace('.docx', '')
-                    fname = f"{base} - {nombre_comp}.docx"
-
-                    doc_buffer = io.BytesIO()
-                    doc.save(doc_buffer)
-                    doc_buffer.seek(0)
-                    zf.writestr(os.path.join(nombre_carpeta_sanitized, fname), doc_buffer.getvalue())
-                    generados.append({'cat': v['carpeta'], 'file': fname})
-                except Exception as e:
-                    errores.append(f"{v['archivo']}: {e}")
+def _preparar_descarga_trabajo(ruta):
+    """
+    Lee un resultado solo cuando se pide. Queda en la sesión (uno a la vez) para no volver
+    a leer el archivo en cada rerun mientras se refresca el progreso de otros trabajos.
+    """
+    try:
+        with open(ruta, "rb") as f:
+            st.session_state.descarga_trabajo = (ruta, f.read())
+    except FileNotFoundError:
+        st.session_state.pop("descarga_trabajo", None)
+        st.error("El resultado ya no está disponible.")
+
+def _boton_descarga_trabajo(columna, ruta, nombre, etiqueta, etiqueta_preparar, mime, key, **kwargs):
+    """Botón de descarga si el resultado ya se preparó; si no, el botón para prepararlo."""
+    preparada = st.session_state.get("descarga_trabajo")
+    if preparada and preparada[0] == ruta:
+        columna.download_button(etiqueta, data=preparada[1], file_name=nombre, mime=mime, key=key,
+                                use_container_width=True, **kwargs)
+    else:
+        columna.button(etiqueta_preparar, key=f"preparar_{key}", on_click=_preparar_descarga_trabajo,
+                       args=(ruta,), use_container_width=True, **kwargs)
+
+def _quitar_trabajo(cola, trabajo):
+    preparada = st.session_state.get("descarga_trabajo")
+    if preparada and preparada[0] in (trabajo.ruta_resultado, *trabajo.adicionales):
+        del st.session_state.descarga_trabajo
+    cola.descartar(trabajo.id)
+
+def _render_trabajos(directorio_base):
+    """Progreso, cancelación y descarga de los trabajos de este navegador. Devuelve si hay alguno activo."""
+    cola = _cola_trabajos(directorio_base)
+    lista = cola.trabajos_de(_cliente_trabajos())[:TRABAJOS_VISIBLES]
+    if not lista:
+        return False
+    st.subheader("Trabajos de generación")
+    for trabajo in lista:
+        with st.container(border=True):
+            col_info, col_acc = st.columns([4, 1])
+            if trabajo.activo:
+                if trabajo.estado == trabajos.EN_COLA:
+                    texto = "En espera..."
+                else:
+                    texto = f"{trabajo.hechos}/{trabajo.total or '?'} plantillas"
+                    if trabajo.actual:
+                        texto += f" · {trabajo.actual}"
+                avance = min(trabajo.hechos / trabajo.total, 1.0) if trabajo.total else 0.0
+                col_info.progress(avance, text=f"**{trabajo.descripcion}** — {texto}")
+                col_acc.button("Cancelar", key=f"cancelar_trabajo_{trabajo.id}", on_click=cola.cancelar,
+                               args=(trabajo.id,), use_container_width=True)
+                continue
+            if trabajo.estado == trabajos.TERMINADO:
+                col_info.success(trabajo.mensaje)
+                for error in trabajo.errores:
+                    col_info.warning(error)
+                _boton_descarga_trabajo(col_acc, trabajo.ruta_resultado, trabajo.nombre_archivo, "Descargar",
+                                        "Preparar descarga", "application/zip", f"descargar_trabajo_{trabajo.id}",
+                                        type="primary")
+                for i, (ruta, nombre) in enumerate(trabajo.adicionales.items()):
+                    if nombre:
+                        _boton_descarga_trabajo(
+                            col_acc, ruta, nombre, "🖨️ Para imprimir", "🖨️ Preparar para imprimir",
+                            "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                            f"descargar_trabajo_{trabajo.id}_{i}",
+                            help="Todos los documentos unidos en un solo archivo, cada uno desde una página nueva"
+                        )
+            elif trabajo.estado == trabajos.CANCELADO:
+                col_info.info(f"**{trabajo.descripcion}** — {trabajo.mensaje}")
             else:
-                errores.append(f"Plantilla no encontrada: {v['archivo']}")
+                col_info.error(f"**{trabajo.descripcion}** — {trabajo.mensaje}")
+            col_acc.button("Quitar", key=f"quitar_trabajo_{trabajo.id}", on_click=_quitar_trabajo,
+                           args=(cola, trabajo), use_container_width=True)
+    return any(trabajo.activo for trabajo in lista)
 
-    if generados:
-        _guardar_en_excel(excel_file, nombre_carpeta_sanitized)
-        
-        msg = f"✅ Se generaron {len(generados)} documentos. Haga clic en 'Descargar Documentos' para obtener el archivo ZIP.\n"
-        por_cat = {}
-        for d in generados:
-            por_cat.setdefault(d['cat'], []).append(d['file'])
-        for cat, files in por_cat.items():
-            msg += f"\n📁 **{cat}**\n"
-            for f in files:
-                msg += f" • {f}\n"
-        if errores:
-            msg += "\n\n⚠️ **Errores al generar algunos documentos:**\n" + "\n".join(errores)
-        
-        st.success(msg)
-
-        generados_buffer.seek(0)
-        st.download_button(
-            label=f"Descargar Documentos Generados ({len(generados)})",
-            data=generados_buffer.getvalue(),
-            file_name=f"{nombre_carpeta_sanitized}.zip",
-            mime="application/zip",
-            key="download_docs_button"
+def _redescargar_callback(directorio_base, plantillas_dir, opciones):
+    """Vuelve a armar el ZIP de un registro del historial desde el archivo, sin renderizar de nuevo."""
+    clave = opciones.get(st.session_state.registro_redescarga)
+    if not clave:
+        return
+    try:
+        resultado = motor.rearmar_zip(_archivo_documentos(directorio_base), clave, plantillas_dir)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    if not resultado.generados:
+        resultado.archivo.close()
+        st.error("❌ No se pudieron recuperar los documentos.\n" + "\n".join(resultado.errores))
+        return
+    if resultado.errores:
+        st.warning("⚠️ Algunos documentos no se pudieron recuperar:\n" + "\n".join(resultado.errores))
+    st.download_button(
+        label=f"Descargar de nuevo: {resultado.carpeta} ({len(resultado.generados)})",
+        data=_leer_zip_generado(resultado.archivo),
+        file_name=f"{resultado.carpeta}.zip",
+        mime="application/zip",
+        key="download_redescarga_button"
+    )
+
+def _render_redescarga_historial(directorio_base, plantillas_dir, pagina):
+    """Selector de un registro de la página visible para volver a descargar sus documentos."""
+    archivados = pagina[pagina['Archivo_Documentos'] != ""]
+    if len(archivados) < len(pagina):
+        st.caption("Los registros guardados antes de que existiera el archivo de documentos no tienen "
+                   "sus documentos archivados y no se pueden volver a descargar.")
+    if archivados.empty:
+        return
+    # Etiqueta visible -> clave del manifiesto (la misma etiqueta es la misma generación)
+    etiquetas = archivados['Fecha_Registro'] + " - " + archivados['Ruta_Carpeta']
+    unicos = ~etiquetas.duplicated()
+    opciones = dict(zip(etiquetas[unicos], archivados.loc[unicos, 'Archivo_Documentos']))
+    col_sel, col_btn = st.columns([3, 1])
+    col_sel.selectbox("Volver a descargar documentos de:", options=list(opciones), key="registro_redescarga")
+    col_btn.button("Descargar de nuevo", on_click=_redescargar_callback,
+                   args=(directorio_base, plantillas_dir, opciones), use_container_width=True)
+
+def _reiniciar_pagina_historial():
+    st.session_state.historial_pagina = 1
+
+def _render_historial(directorio_base, plantillas_dir, historial_db):
+    """Página visible del historial, ordenada y paginada sobre la vista compartida del proceso."""
+    col_orden, col_dir, col_tam, col_pag = st.columns(4)
+    columna = col_orden.selectbox(
+        "Ordenar por:", options=["Orden de registro", *COLUMNAS_VISTA_HISTORIAL[:-2]],
+        key="historial_orden", on_change=_reiniciar_pagina_historial
+    )
+    descendente = col_dir.selectbox(
+        "Dirección:", options=["Descendente", "Ascendente"], key="historial_direccion",
+        on_change=_reiniciar_pagina_historial
+    ) == "Descendente"
+    tamaño = col_tam.selectbox("Filas por página:", options=TAMAÑOS_PAGINA_HISTORIAL, key="historial_tamaño",
+                               on_change=_reiniciar_pagina_historial)
+    vista = _obtener_vista_historial(historial_db)
+    try:
+        total = vista.total()
+    except Exception as e:
+        st.error(f"Error cargando historial: {e}")
+        return
+    paginas = max(1, -(-total // tamaño))
+    numero = col_pag.number_input("Página:", min_value=1, max_value=paginas, step=1, key="historial_pagina")
+    if total == 0:
+        st.info("El historial está vacío. Genere documentos para empezar a registrar pacientes.")
+        return
+
+    pagina, total = vista.pagina(numero, tamaño, None if columna == "Orden de registro" else columna, descendente)
+    inicio = (numero - 1) * tamaño
+    st.dataframe(pagina.drop(columns='Archivo_Documentos'), use_container_width=True, hide_index=True)
+    st.caption(f"Registros {min(inicio + 1, total)}–{min(inicio + tamaño, total)} de {total} "
+               f"(página {numero} de {paginas}).")
+
+    _render_redescarga_historial(directorio_base, plantillas_dir, pagina)
+    _render_exportacion_historial(historial_db)
+
+def _render_exportacion_historial(historial_db):
+    """Filtros y descarga del historial. El archivo se arma al pedirlo, no en cada rerun."""
+    col1, col2, col3, col4 = st.columns(4)
+    col1.selectbox("Formato:", options=list(FORMATOS_EXPORTACION), key="formato_exportacion")
+    col2.date_input("Desde:", value=None, key="exportar_desde", format="DD/MM/YYYY")
+    col3.date_input("Hasta:", value=None, key="exportar_hasta", format="DD/MM/YYYY")
+    col4.multiselect("Servicios:", options=SERVICIOS, key="exportar_servicios", placeholder="Todos")
+
+    clave = _clave_exportacion(historial_db)
+    if st.session_state.get('exportacion_historial') != clave:
+        st.button("Preparar exportación", on_click=_preparar_exportacion_callback, args=(historial_db,))
+        return
+    datos, filas = _exportar_historial(*clave) # Ya está en caché
+    extension, mime = FORMATOS_EXPORTACION[clave[2]]
+    st.download_button(
+        label=f"Descargar Historial ({clave[2]}, {filas} registros)",
+        data=datos,
+        file_name=f"pacientes_historial.{extension}",
+        mime=mime,
+        key="download_historial_button"
+    )
+
+def _render_censo(historial_db):
+    """Tablero del censo, leído de los agregados por mes (no recorre el historial)."""
+    with _conectar_historial(historial_db) as conn:
+        meses = [fila[0] for fila in conn.execute(
+            "SELECT DISTINCT mes FROM censo WHERE dimension = 'servicio' AND mes != 'Sin fecha' ORDER BY mes"
+        )]
+    if not meses:
+        st.info("Todavía no hay ingresos registrados.")
+        return
+    desde, hasta = st.select_slider(
+        "Período (meses):", options=meses, value=(meses[max(0, len(meses) - 12)], meses[-1]), key="censo_periodo"
+    ) if len(meses) > 1 else (meses[0], meses[0])
+    censo = _leer_censo(historial_db, desde, hasta)
+
+    def _dimension(nombre):
+        return censo[censo['dimension'] == nombre]
+
+    servicios = _dimension('servicio')
+    residencia = _dimension('residencia').groupby('valor')['cantidad'].sum()
+    total = int(servicios['cantidad'].sum())
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Ingresos en el período", total)
+    for col, valor in ((col2, "La Paz"), (col3, "Otros")):
+        cantidad = int(residencia.get(valor, 0))
+        col.metric(f"Residentes {'de La Paz' if valor == 'La Paz' else 'de otros lugares'}", cantidad,
+                   f"{cantidad / total:.0%}" if total else None, delta_color="off")
+
+    col_serv, col_edad = st.columns(2)
+    with col_serv:
+        st.markdown("**Ingresos por servicio y mes**")
+        st.bar_chart(servicios.pivot_table(index='mes', columns='valor', values='cantidad', aggfunc='sum', fill_value=0))
+    with col_edad:
+        st.markdown("**Distribución por edad**")
+        rangos = [f"{d}+" if h is None else f"{d}-{h}" for d, h in RANGOS_EDAD_CENSO] + ["Sin dato"]
+        edades = _dimension('edad').groupby('valor')['cantidad'].sum().reindex(rangos, fill_value=0)
+        st.bar_chart(edades)
+
+    mes = st.selectbox("Diagnósticos más frecuentes del mes:", options=meses[meses.index(desde):meses.index(hasta) + 1][::-1],
+                       key="censo_mes")
+    col_diag, col_cie = st.columns(2)
+    for col, dimension, titulo in ((col_diag, 'diagnostico', "Diagnóstico"), (col_cie, 'cie10', "CIE-10")):
+        top = _dimension(dimension)
+        top = top[top['mes'] == mes].nlargest(CENSO_TOP_DIAGNOSTICOS, 'cantidad')
+        col.dataframe(top[['valor', 'cantidad']].rename(columns={'valor': titulo, 'cantidad': "Ingresos"}),
+                      hide_index=True, use_container_width=True)
+
+def _render_panel_metricas(tiempos_arranque):
+    """Panel de administración con los tiempos por etapa (solo con HCL_METRICAS=1)."""
+    with st.expander("⏱️ Métricas de rendimiento (administración)"):
+        st.markdown("**Arranque del proceso** (ms)")
+        st.dataframe(pd.DataFrame(
+            [{'etapa': etapa, 'ms': round(segundos * 1000, 1)} for etapa, segundos in tiempos_arranque.items()]
+        ), hide_index=True)
+
+        resumen = pd.DataFrame(metricas.resumen())
+        if resumen.empty:
+            st.info("Todavía no hay mediciones.")
+            return
+        reruns = resumen[resumen['etapa'] == "rerun"]
+        if not reruns.empty:
+            fila = reruns.iloc[0]
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Reruns medidos", int(fila['cantidad']))
+            col2.metric("Costo promedio del rerun", f"{fila['promedio_s'] * 1000:.1f} ms")
+            col3.metric("Rerun más lento", f"{fila['maximo_s'] * 1000:.1f} ms")
+
+        st.markdown("**Plantillas más lentas** (tiempo promedio por etapa)")
+        por_plantilla = resumen[(resumen['plantilla'] != "") & (resumen['etapa'] != "arranque")]
+        if not por_plantilla.empty:
+            lentas = (por_plantilla.pivot_table(index='plantilla', columns='etapa', values='promedio_s', aggfunc='sum')
+                      .fillna(0.0))
+            lentas['total_s'] = lentas.sum(axis=1)
+            st.dataframe(lentas.sort_values('total_s', ascending=False).head(10), use_container_width=True)
+
+        st.markdown("**Resumen por etapa**")
+        por_etapa = resumen.groupby('etapa').agg(
+            cantidad=('cantidad', 'sum'), maximo_s=('maximo_s', 'max')
         )
-        
-        if st.button("Limpiar campos para nuevo paciente", key="clear_after_gen"):
-            _limpiar_campos()
-            st.rerun()
-    else:
-        msg = "❌ No se generaron documentos."
-        if errores:
-            msg += "\n" + "\n".join(errores)
-        st.error(msg)
+        por_etapa['promedio_s'] = (resumen.assign(total=resumen['promedio_s'] * resumen['cantidad'])
+                                   .groupby('etapa')['total'].sum() / por_etapa['cantidad'])
+        st.dataframe(por_etapa.sort_values('promedio_s', ascending=False), use_container_width=True)
+
+        st.markdown("**Mediciones recientes**")
+        st.dataframe(pd.DataFrame(metricas.eventos_recientes(50)), use_container_width=True)
 
 # --- Lógica principal de la aplicación Streamlit ---
 def main():
+    inicio_rerun = time.perf_counter()
     directorio_base = os.getcwd()
     plantillas_dir = os.path.join(directorio_base, "PLANTILLAS")
-    excel_file = os.path.join(directorio_base, "pacientes.xlsx")
+    excel_file = os.path.join(directorio_base, "pacientes.xlsx") # Historial antiguo, solo para migrar
+    historial_db = os.path.join(directorio_base, "pacientes.db")
 
     # Inicializar variables de estado de sesión si no existen
     if 'initialized' not in st.session_state:
@@ -338,14 +1337,30 @@ def main():
         st.session_state.fecha_internacion = date.today()
         st.session_state.plantillas_vars = {}
 
-    if not _crear_estructura_directorios(directorio_base, plantillas_dir, excel_file):
+    if not _crear_estructura_directorios(directorio_base, plantillas_dir, excel_file, historial_db):
         st.stop()
+    tiempos_arranque = _precalentar(plantillas_dir, historial_db, directorio_base, _segundos_importaciones)
 
     st.title("Sistema de Gestión de Documentos Médicos")
 
     # --- Sección de DATOS DEL PACIENTE ---
     st.header("1. Datos del Paciente")
     with st.container(border=True):
+        col_busq, col_res = st.columns(2)
+        with col_busq:
+            st.text_input("🔎 Buscar paciente:", key="busqueda_paciente",
+                          placeholder="N° Historia, nombre o diagnóstico",
+                          help="Busca en ingresos anteriores para completar el formulario (reingresos).")
+        with col_res:
+            encontrados = _buscar_pacientes(historial_db, st.session_state.get("busqueda_paciente", ""))
+            st.session_state.resultados_busqueda = {f['id']: f for f in encontrados}
+            if encontrados:
+                st.selectbox("Resultados:", options=list(st.session_state.resultados_busqueda), key="paciente_encontrado",
+                             format_func=lambda i: "{Nombre_Completo} - HC {Num_Historia} - {Diagnostico}".format(**st.session_state.resultados_busqueda[i]))
+                st.button("Cargar datos del paciente", on_click=_cargar_paciente_del_historial, args=(historial_db,))
+            elif st.session_state.get("busqueda_paciente", "").strip():
+                st.caption("Sin resultados en el historial.")
+
         col1, col2 = st.columns(2)
         with col1:
             st.text_input("Nombres:", key="nombres")
@@ -368,7 +1383,7 @@ def main():
             st.text_input("Apellido Materno:", key="apellido_materno")
             st.text_input("Edad:", key="edad", disabled=True, help="Calculada automáticamente")
             st.text_input("N° Registro:", key="num_registro", disabled=True, help="Calculado automáticamente (DDMMAA)")
-            st.selectbox("Género:", options=["Masculino", "Femenino", "Otro"], key="genero", help="Género del paciente")
+            st.selectbox("Género:", options=GENEROS, key="genero", help="Género del paciente")
             st.text_input("Procedencia:", key="procedencia", help="Lugar de donde proviene el paciente (si es diferente a residencia)")
             st.checkbox("Residente en La Paz:", key="es_residente_la_paz", help="Marque si el paciente reside en La Paz")
             st.text_input("Nombre Referencia 2:", key="n_referencia2", help="Nombre completo de la segunda persona de referencia")
@@ -379,14 +1394,32 @@ def main():
     # --- Sección de DATOS CLÍNICOS ---
     st.header("2. Datos Clínicos")
     with st.container(border=True):
+        col_busq, col_res = st.columns(2)
+        with col_busq:
+            st.text_input("🔎 Buscar en CIE-10:", key="busqueda_cie10",
+                          placeholder="Código o palabras del diagnóstico",
+                          help="Busca en el catálogo CIE-10 por código (D50) o por palabras (anemia hierro), sin distinguir acentos.")
+        with col_res:
+            sugerencias = obtener_catalogo_cie10().buscar(st.session_state.get("busqueda_cie10", ""))
+            st.session_state.sugerencias_cie10 = {f"{c} - {d}": (c, d) for c, d in sugerencias}
+            if sugerencias:
+                st.selectbox("Sugerencias:", options=list(st.session_state.sugerencias_cie10), key="diagnostico_cie10")
+                col_usar, col_agregar = st.columns(2)
+                col_usar.button("Usar diagnóstico", on_click=_usar_diagnostico_cie10, args=(False,),
+                                help="Reemplaza el CIE-10 y los diagnósticos por el elegido")
+                col_agregar.button("Agregar diagnóstico", on_click=_usar_diagnostico_cie10, args=(True,),
+                                   help="Suma el elegido a los diagnósticos ya cargados")
+            elif st.session_state.get("busqueda_cie10", "").strip():
+                st.caption("Sin coincidencias en el catálogo CIE-10.")
+
         col1, col2 = st.columns(2)
         with col1:
-            servicios = ["Hematología", "Medicina Interna", "Oncología Clínica", "Oncología Quirúrgica"]
-            st.selectbox("Servicio:", options=servicios, key="servicio")
+            st.selectbox("Servicio:", options=SERVICIOS, key="servicio")
             st.text_input("Diagnósticos:", key="diagnosticos", help="Diagnósticos principales del paciente")
         with col2:
             st.text_input("Diagnósticos (para Recetas/Labs):", key="diag_recetas_labs", help="Diagnósticos específicos para recetas o laboratorios")
-            st.text_input("CIE-10:", key="cie10", help="Código de la Clasificación Internacional de Enfermedades (CIE-10)")
+            st.text_input("CIE-10:", key="cie10", help="Código de la Clasificación Internacional de Enfermedades (CIE-10)",
+                          on_change=lambda: setattr(st.session_state, "cie10", normalizar_codigos(st.session_state.cie10)))
 
     # --- Sección de NOTAS ADICIONALES ---
     st.header("3. Notas Adicionales")
@@ -398,76 +1431,57 @@ def main():
     st.header("4. Selección de Plantillas")
     
     def _render_plantillas_selection():
-        categorias = [
-            ("📋 Consulta", "Consulta"),
-            ("📨 Interconsulta", "Interconsulta"),
-            ("💊 Recetas", "Recetas"),
-            ("🧪 Laboratorios", "Laboratorios"),
-            ("🔬 Procedimientos", "Procedimientos"),
-            ("📊 Informes", "Informes")
-        ]
+        catalogo = motor.obtener_catalogo(plantillas_dir)
         
-        st.button("🔄 Actualizar Lista de Plantillas", key="refresh_templates", help="Vuelve a escanear la carpeta PLANTILLAS para nuevas plantillas.")
+        st.button("🔄 Actualizar Lista de Plantillas", key="refresh_templates", on_click=catalogo.refrescar, help="Vuelve a escanear la carpeta PLANTILLAS para nuevas plantillas.")
+
+        categorias = catalogo.obtener()
+        marcadas = {k for k, v in st.session_state.plantillas_vars.items() if v}
+
+        def toggle_category(category_folder):
+            _, claves = catalogo.obtener().get(category_folder, ((), frozenset()))
+            valor = st.session_state[f"select_all_{category_folder}"]
+            for key in claves:
+                st.session_state.plantillas_vars[key] = valor
+                st.session_state[key] = valor
+
+        def check_category_all_status(current_folder, key):
+            st.session_state.plantillas_vars[key] = st.session_state[key]
+            _, claves = catalogo.obtener().get(current_folder, ((), frozenset()))
+            marcadas_ahora = {k for k in claves if st.session_state.plantillas_vars.get(k, False)}
+            st.session_state[f"select_all_{current_folder}"] = marcadas_ahora == claves
 
         template_found = False
         with st.container(border=True):
-            for title, folder in categorias:
-                path = os.path.join(plantillas_dir, folder)
-                if os.path.isdir(path):
-                    docs = [f for f in os.listdir(path) if f.endswith('.docx') and not f.startswith('~')]
-                    if docs:
-                        template_found = True
-                        st.subheader(title)
-                        
-                        select_all_key = f"select_all_{folder}"
-                        
-                        all_selected_in_category = True
-                        for doc in docs:
-                            key = f"{folder}:{doc}"
-                            if key not in st.session_state.plantillas_vars or not st.session_state.plantillas_vars[key]:
-                                all_selected_in_category = False
-                                break
-                        
-                        if select_all_key not in st.session_state:
-                            st.session_state[select_all_key] = all_selected_in_category
-                        else:
-                            if st.session_state[select_all_key] != all_selected_in_category:
-                                st.session_state[select_all_key] = all_selected_in_category
-                        
-                        def toggle_category(category_folder):
-                            for doc_name in os.listdir(os.path.join(plantillas_dir, category_folder)):
-                                if doc_name.endswith('.docx') and not doc_name.startswith('~'):
-                                    key = f"{category_folder}:{doc_name}"
-                                    st.session_state.plantillas_vars[key] = st.session_state[f"select_all_{category_folder}"]
-                            st.rerun()
-
-                        st.checkbox("Seleccionar todos en esta categoría", key=select_all_key, on_change=toggle_category, args=(folder,), help="Marca/desmarca todas las plantillas de esta sección.")
-                        
-                        cols_per_row = 2
-                        current_cols = st.columns(cols_per_row)
-                        col_idx = 0
+            for title, folder in motor.CATEGORIAS_PLANTILLAS:
+                docs, claves = categorias.get(folder, ((), frozenset()))
+                if docs:
+                    template_found = True
+                    st.subheader(title)
+                    
+                    select_all_key = f"select_all_{folder}"
+                    all_selected_in_category = claves <= marcadas
+                    if st.session_state.get(select_all_key) != all_selected_in_category:
+                        st.session_state[select_all_key] = all_selected_in_category
+
+                    st.checkbox("Seleccionar todos en esta categoría", key=select_all_key, on_change=toggle_category, args=(folder,), help="Marca/desmarca todas las plantillas de esta sección.")
+                    
+                    cols_per_row = 2
+                    current_cols = st.columns(cols_per_row)
+                    col_idx = 0
+                    
+                    for doc in docs:
+                        key = f"{folder}:{doc}"
+                        if key not in st.session_state.plantillas_vars:
+                            st.session_state.plantillas_vars[key] = False
+                        if key not in st.session_state:
+                            st.session_state[key] = st.session_state.plantillas_vars[key]
                         
-                        for doc in docs:
-                            key = f"{folder}:{doc}"
-                            if key not in st.session_state.plantillas_vars:
-                                st.session_state.plantillas_vars[key] = False
-                            
-                            lbl = doc.replace('.docx', '')
-                            def check_category_all_status(current_folder):
-                                all_sub_selected = True
-                                for sub_doc in os.listdir(os.path.join(plantillas_dir, current_folder)):
-                                    if sub_doc.endswith('.docx') and not sub_doc.startswith('~'):
-                                        sub_key = f"{current_folder}:{sub_doc}"
-                                        if not st.session_state.plantillas_vars.get(sub_key, False):
-                                            all_sub_selected = False
-                                            break
-                                st.session_state[f"select_all_{current_folder}"] = all_sub_selected
-                                st.rerun()
-                            
-                            current_cols[col_idx].checkbox(lbl, key=key, on_change=check_category_all_status, args=(folder,))
-                            col_idx = (col_idx + 1) % cols_per_row
-                            if col_idx == 0:
-                                current_cols = st.columns(cols_per_row)
+                        lbl = doc.replace('.docx', '')
+                        current_cols[col_idx].checkbox(lbl, key=key, on_change=check_category_all_status, args=(folder, key))
+                        col_idx = (col_idx + 1) % cols_per_row
+                        if col_idx == 0:
+                            current_cols = st.columns(cols_per_row)
 
             if not template_found:
                 st.warning("⚠️ No se encontraron plantillas .docx. Asegúrate de colocar archivos en la carpeta `PLANTILLAS/` con subcarpetas para categorías (ej. `PLANTILLAS/Consulta/`).")
@@ -483,50 +1497,53 @@ def main():
         st.button(
             "GENERAR DOCUMENTOS",
             on_click=_generar_documentos_callback,
-            args=(directorio_base, plantillas_dir, excel_file),
+            args=(directorio_base, plantillas_dir, historial_db),
             type="primary",
             use_container_width=True
         )
+        st.checkbox("Incluir un documento único para imprimir", key="documento_para_imprimir",
+                    help="Además del ZIP, une los documentos de cada paciente en un solo .docx "
+                         "(cada uno desde una página nueva, con sus encabezados) para imprimirlos de una vez.")
     with col_clear:
         st.button("LIMPIAR CAMPOS", on_click=_limpiar_campos, use_container_width=True)
     with col_hist:
         def _toggle_historial_visibility():
-            if not st.session_state.get('show_historial', False):
-                try:
-                    if os.path.exists(excel_file):
-                        df_historial = pd.read_excel(excel_file)
-                        st.session_state.historial_data = df_historial
-                    else:
-                        st.session_state.historial_data = pd.DataFrame()
-                except Exception as e:
-                    st.error(f"Error cargando historial: {e}")
-                    st.session_state.historial_data = pd.DataFrame()
             st.session_state.show_historial = not st.session_state.get('show_historial', False)
 
         if 'show_historial' not in st.session_state:
             st.session_state.show_historial = False
-        if 'historial_data' not in st.session_state:
-            st.session_state.historial_data = pd.DataFrame()
 
         st.button("VER HISTORIAL", on_click=_toggle_historial_visibility, use_container_width=True)
 
+    # --- Sección de CENSO ---
+    with st.expander("📊 Censo de pacientes (ingresos por servicio, diagnósticos, edad y residencia)"):
+        if st.toggle("Mostrar censo", key="mostrar_censo"):
+            _render_censo(historial_db)
+
+    # --- Sección de GENERACIÓN POR LOTES ---
+    with st.expander("📦 Generación por lotes (varios pacientes desde CSV/Excel)"):
+        st.caption(
+            "El archivo debe tener las mismas columnas que el historial (Nombres, Apellido_Paterno, "
+            "Apellido_Materno o Nombre_Completo, Fecha_Nacimiento, Num_Historia, Diagnostico, ...). "
+            "Se generan las plantillas seleccionadas arriba para cada paciente."
+        )
+        st.file_uploader("Archivo de pacientes:", type=["csv", "xlsx"], key="archivo_lote")
+        st.button("GENERAR LOTE", on_click=_generar_lote_callback, args=(directorio_base, plantillas_dir, historial_db))
+
+    # --- Sección de TRABAJOS ---
+    hay_trabajos_activos = _render_trabajos(directorio_base)
+
     if st.session_state.get('show_historial'):
         st.subheader("Historial de Pacientes")
-        if not st.session_state.historial_data.empty:
-            st.dataframe(st.session_state.historial_data, use_container_width=True)
-            
-            excel_buffer = io.BytesIO()
-            st.session_state.historial_data.to_excel(excel_buffer, index=False)
-            excel_buffer.seek(0)
-            st.download_button(
-                label="Descargar Historial (Excel)",
-                data=excel_buffer.getvalue(),
-                file_name="pacientes_historial.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                key="download_historial_button"
-            )
-        else:
-            st.info("El historial está vacío. Genere documentos para empezar a registrar pacientes.")
+        _render_historial(directorio_base, plantillas_dir, historial_db)
+
+    if metricas.activas():
+        _render_panel_metricas(tiempos_arranque)
+    metricas.registrar("rerun", time.perf_counter() - inicio_rerun)
+
+    if hay_trabajos_activos: # Refresca el progreso hasta que terminen
+        time.sleep(TRABAJOS_SEGUNDOS_REFRESCO)
+        st.rerun()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,180 @@
+"""
+Archivo en disco de los documentos generados, direccionado por contenido.
+
+Cada documento se guarda bajo el SHA-256 del contenido de su plantilla más los datos
+reemplazados, así que una misma solicitud se responde desde el archivo sin volver a
+renderizar y dos solicitudes idénticas comparten un único objeto. Un "manifiesto"
+(también direccionado por contenido) describe una generación completa: la carpeta del
+ZIP, los documentos y los datos usados, y es lo que se anota en el historial para
+poder volver a descargarla.
+
+Estructura del directorio:
+    indice.db             objetos y manifiestos (SQLite)
+    objetos/ab/abcd...    un archivo por documento, comprimido si vale la pena
+
+Cuando el total supera `max_bytes` se descartan los objetos usados hace más tiempo.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+# Tamaño máximo del archivo de documentos (suma de los objetos en disco)
+ARCHIVO_MAX_BYTES = int(os.environ.get("HCL_ARCHIVO_MAX_BYTES", 1024 * 1024 * 1024))
+# Un objeto se guarda comprimido solo si así ocupa como mucho esta fracción del original
+# (los .docx ya son ZIP comprimidos y casi nunca ganan mucho)
+COMPRESION_UMBRAL = 0.9
+# Sumar uno cada vez que cambie el documento que produce el render (invalida todas las
+# claves anteriores): 2 = motor "xml" sobre el paquete de la plantilla
+VERSION_CLAVES = 2
+
+class ArchivoDocumentos:
+    """Archivo de documentos en `directorio`, seguro entre hilos y entre procesos."""
+
+    def __init__(self, directorio, max_bytes=ARCHIVO_MAX_BYTES):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self._firmas_plantillas = {}  # ruta -> ((mtime, tamaño), hash del contenido)
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directorio, "objetos"), exist_ok=True)
+        with self._conectar() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS objetos (clave TEXT PRIMARY KEY, tamaño INTEGER NOT NULL, "
+                "comprimido INTEGER NOT NULL, ultimo_uso REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_objetos_ultimo_uso ON objetos (ultimo_uso)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS manifiestos (clave TEXT PRIMARY KEY, contenido TEXT NOT NULL)"
+            )
+
+    @contextlib.contextmanager
+    def _conectar(self):
+        conn = sqlite3.connect(os.path.join(self.directorio, "indice.db"), timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _ruta_objeto(self, clave):
+        return os.path.join(self.directorio, "objetos", clave[:2], clave)
+
+    # --- Claves ---
+
+    def _hash_plantilla(self, ruta_plantilla):
+        """Hash del contenido de la plantilla; solo se vuelve a leer si cambió el archivo."""
+        info = os.stat(ruta_plantilla)
+        firma = (info.st_mtime_ns, info.st_size)
+        with self._lock:
+            guardada = self._firmas_plantillas.get(ruta_plantilla)
+        if guardada is not None and guardada[0] == firma:
+            return guardada[1]
+        h = hashlib.sha256()
+        with open(ruta_plantilla, "rb") as f:
+            for bloque in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(bloque)
+        with self._lock:
+            self._firmas_plantillas[ruta_plantilla] = (firma, h.hexdigest())
+        return h.hexdigest()
+
+    def clave(self, ruta_plantilla, data):
+        """Clave del documento que resulta de aplicar `data` a la plantilla."""
+        h = hashlib.sha256(f"v{VERSION_CLAVES}:{self._hash_plantilla(ruta_plantilla)}:".encode())
+        h.update(json.dumps(data, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+        return h.hexdigest()
+
+    # --- Objetos ---
+
+    def obtener(self, clave):
+        """Contenido del documento, o None si no está en el archivo."""
+        with self._conectar() as conn:
+            fila = conn.execute("SELECT comprimido FROM objetos WHERE clave = ?", (clave,)).fetchone()
+            if fila is None:
+                return None
+            try:
+                with open(self._ruta_objeto(clave), "rb") as f:
+                    contenido = f.read()
+            except FileNotFoundError: # Desalojado por otro proceso mientras tanto
+                conn.execute("DELETE FROM objetos WHERE clave = ?", (clave,))
+                return None
+            conn.execute("UPDATE objetos SET ultimo_uso = ? WHERE clave = ?", (time.time(), clave))
+        return zlib.decompress(contenido) if fila[0] else contenido
+
+    def guardar(self, clave, contenido):
+        """Guarda un documento (si ya estaba, solo actualiza su último uso) y desaloja lo más viejo."""
+        with self._conectar() as conn:
+            if conn.execute("UPDATE objetos SET ultimo_uso = ? WHERE clave = ?", (time.time(), clave)).rowcount:
+                return
+        comprimido = zlib.compress(contenido, 6)
+        es_comprimido = len(comprimido) <= len(contenido) * COMPRESION_UMBRAL
+        datos = comprimido if es_comprimido else contenido
+        ruta = self._ruta_objeto(clave)
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        fd, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(datos)
+            os.replace(temporal, ruta) # Los lectores nunca ven un objeto a medio escribir
+        except Exception:
+            with contextlib.suppress(OSError):
+                os.remove(temporal)
+            raise
+        with self._conectar() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO objetos (clave, tamaño, comprimido, ultimo_uso) VALUES (?, ?, ?, ?)",
+                (clave, len(datos), int(es_comprimido), time.time())
+            )
+            self._desalojar(conn)
+
+    def _desalojar(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(tamaño), 0) FROM objetos").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        descartados = []
+        for clave, tamaño in conn.execute("SELECT clave, tamaño FROM objetos ORDER BY ultimo_uso"):
+            if total <= self.max_bytes:
+                break
+            descartados.append(clave)
+            total -= tamaño
+        conn.executemany("DELETE FROM objetos WHERE clave = ?", ((c,) for c in descartados))
+        for clave in descartados:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._ruta_objeto(clave))
+
+    # --- Manifiestos ---
+
+    def guardar_manifiesto(self, carpeta, documentos, data):
+        """
+        Registra una generación: `documentos` es una lista de dicts con 'plantilla'
+        ("Carpeta/archivo.docx"), 'nombre' (dentro del ZIP) y 'clave'. Devuelve su clave.
+        """
+        contenido = json.dumps(
+            {'carpeta': carpeta, 'documentos': documentos, 'datos': data},
+            sort_keys=True, ensure_ascii=False, default=str
+        )
+        clave = hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+        with self._conectar() as conn:
+            conn.execute("INSERT OR IGNORE INTO manifiestos (clave, contenido) VALUES (?, ?)", (clave, contenido))
+        return clave
+
+    def obtener_manifiesto(self, clave):
+        """El manifiesto como dict, o None si no existe."""
+        with self._conectar() as conn:
+            fila = conn.execute("SELECT contenido FROM manifiestos WHERE clave = ?", (clave,)).fetchone()
+        return json.loads(fila[0]) if fila else None
+
+_archivos = {}
+_archivos_lock = threading.Lock()
+
+def obtener_archivo(directorio, max_bytes=ARCHIVO_MAX_BYTES):
+    """Archivo de documentos de `directorio`, compartido por todo el proceso."""
+    with _archivos_lock:
+        if directorio not in _archivos:
+            _archivos[directorio] = ArchivoDocumentos(directorio, max_bytes)
+        return _archivos[directorio]
@@ -0,0 +1,450 @@
+"""
+Benchmark reproducible del pipeline de generación y del historial.
+
+Genera plantillas sintéticas de tamaño creciente (muchos párrafos, tablas grandes,
+encabezados/pies, imágenes y marcadores partidos en varios runs) y mide:
+
+  - reemplazo de marcadores (motor_documentos.reemplazar_marcadores)
+  - render de una plantilla con cada motor ("xml" directo sobre el paquete y "docx")
+  - generación completa de un paciente (motor_documentos.generar_zip, lo que ejecuta
+    el botón GENERAR DOCUMENTOS)
+  - armado del ZIP a partir de documentos ya renderizados
+  - escritura y lectura del historial con 1k, 10k y 100k registros previos
+  - carga del catálogo CIE-10 y sugerencias por código, por palabras y con error de tipeo
+
+Con --estres-historial, en cambio, corre la prueba de carga del escritor del historial:
+cientos de guardados simultáneos (algunos inválidos) mientras otros hilos leen, y falla
+si se pierde, se duplica o se rechaza de más algún registro:
+
+    python benchmark.py --estres-historial --envios 500
+
+Con --verificar se corren solo las verificaciones de resultados, que fallan si la salida
+no es la esperada (fechas del pacientes.xlsx migradas con día y mes invertidos, fuentes
+perdidas al unir documentos para imprimir):
+
+    python benchmark.py --verificar
+
+El resultado es un JSON con p50/p95 de latencia (ms) y pico de memoria (KiB) por caso,
+para comparar versiones:
+
+    python benchmark.py --salida resultados.json
+    python benchmark.py --rapido            # tamaños reducidos, para una prueba rápida
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from docx import Document
+from docx.shared import Cm
+from lxml import etree
+
+import cie10
+import motor_documentos as motor
+
+# (nombre, párrafos, filas de tabla, columnas de tabla, imágenes, lado de imagen en px)
+TAMAÑOS_PLANTILLA = [
+    ("pequeña", 50, 5, 4, 1, 64),
+    ("mediana", 500, 50, 6, 2, 256),
+    ("grande", 3000, 300, 8, 4, 512),
+]
+TAMAÑOS_HISTORIAL = [1_000, 10_000, 100_000]
+
+PACIENTE = {
+    'nombres': "Juan Carlos", 'apellido_paterno': "Pérez", 'apellido_materno': "Quispe",
+    'fecha_nacimiento_str': "05/03/90", 'num_historia': "123456", 'ocupacion': "Comerciante",
+    'estado_civil': "Casado", 'residencia': "La Paz", 'genero': "Masculino", 'procedencia': "El Alto",
+    'domicilio': "Calle 1 #234, Zona Sur", 'es_residente_la_paz': True,
+    'n_referencia1': "María Pérez", 'referencia1': "Esposa", 'telefono_referencia1': "70000000",
+    'diagnosticos': "Anemia ferropénica", 'diag_recetas_labs': "Anemia", 'cie10': "D50.9",
+    'servicio': "Hematología", 'observaciones': "Paciente estable.\nControl en 7 días.",
+    'indicaciones': "Hierro oral", 'fecha_internacion': "17/10/2026",
+}
+
+def _png(lado, semilla):
+    """PNG RGB de `lado` x `lado` con ruido (para que no se comprima a casi nada)."""
+    rnd = random.Random(semilla)
+    filas = b"".join(b"\x00" + bytes(rnd.getrandbits(8) for _ in range(lado * 3)) for _ in range(lado))
+    def bloque(tipo, datos):
+        return struct.pack(">I", len(datos)) + tipo + datos + struct.pack(">I", zlib.crc32(tipo + datos))
+    return (b"\x89PNG\r\n\x1a\n" + bloque(b"IHDR", struct.pack(">IIBBBBB", lado, lado, 8, 2, 0, 0, 0))
+            + bloque(b"IDAT", zlib.compress(filas)) + bloque(b"IEND", b""))
+
+def _agregar_marcador_partido(parrafo, marcador):
+    """Escribe el marcador repartido en tres runs, como suele dejarlo Word."""
+    tercio = len(marcador) // 3
+    parrafo.add_run(marcador[:tercio]).bold = True
+    parrafo.add_run(marcador[tercio:2 * tercio])
+    parrafo.add_run(marcador[2 * tercio:])
+
+def crear_plantilla(ruta, parrafos, filas, columnas, imagenes, lado):
+    """Crea una plantilla sintética con marcadores en cuerpo, tablas, encabezados y pies."""
+    marcadores = list(motor.datos_reemplazo(motor.completar_paciente(PACIENTE)))
+    doc = Document()
+    seccion = doc.sections[0]
+    seccion.different_first_page_header_footer = True
+    seccion.header.paragraphs[0].text = "Hospital de Clínicas - {{SERVICIO}} - HC {{NUM_HISTORIA}}"
+    seccion.first_page_header.paragraphs[0].text = "{{NOMBRE_COMPLETO}} ({{EDAD}} años)"
+    seccion.footer.paragraphs[0].text = "Registro {{NUM_REGISTRO}} - {{FECHA_INTERNACION}}"
+
+    for i in range(imagenes):
+        doc.add_picture(io.BytesIO(_png(lado, i)), width=Cm(4))
+    for i in range(parrafos):
+        p = doc.add_paragraph(f"Párrafo {i} con texto de relleno para simular un formulario clínico. ")
+        marcador = marcadores[i % len(marcadores)]
+        if i % 3 == 0:
+            _agregar_marcador_partido(p, marcador)
+        else:
+            p.add_run(f"Dato: {marcador}.")
+    tabla = doc.add_table(rows=filas, cols=columnas)
+    for r, fila in enumerate(tabla.rows):
+        for c, celda in enumerate(fila.cells):
+            celda.text = marcadores[(r * columnas + c) % len(marcadores)] if (r + c) % 2 == 0 else f"Celda {r}.{c}"
+    doc.save(ruta)
+
+def medir(funcion, repeticiones, preparar=None):
+    """
+    Ejecuta `funcion` `repeticiones` veces y devuelve p50/p95 en ms, más el pico de memoria
+    de una ejecución adicional bajo tracemalloc (aparte, para no distorsionar los tiempos).
+    `preparar` (opcional) se llama antes de cada ejecución y su resultado se pasa a `funcion`.
+    """
+    tiempos = []
+    for _ in range(repeticiones):
+        argumento = preparar() if preparar else None
+        inicio = time.perf_counter()
+        funcion(argumento) if preparar else funcion()
+        tiempos.append((time.perf_counter() - inicio) * 1000)
+    argumento = preparar() if preparar else None
+    tracemalloc.start()
+    funcion(argumento) if preparar else funcion()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tiempos.sort()
+    return {
+        'repeticiones': repeticiones,
+        'p50_ms': round(statistics.median(tiempos), 3),
+        'p95_ms': round(tiempos[min(len(tiempos) - 1, int(len(tiempos) * 0.95))], 3),
+        'pico_memoria_kib': round(pico / 1024, 1),
+    }
+
+def bench_plantillas(directorio, tamaños, repeticiones):
+    plantillas_dir = os.path.join(directorio, "PLANTILLAS")
+    carpeta = os.path.join(plantillas_dir, "Consulta")
+    os.makedirs(carpeta, exist_ok=True)
+    paciente = motor.completar_paciente(PACIENTE)
+    data = motor.datos_reemplazo(paciente)
+    resultados, renderizados = [], []
+
+    for nombre, parrafos, filas, columnas, imagenes, lado in tamaños:
+        ruta = os.path.join(carpeta, f"bench_{nombre}.docx")
+        crear_plantilla(ruta, parrafos, filas, columnas, imagenes, lado)
+        parametros = {'plantilla': nombre, 'parrafos': parrafos, 'tabla': f"{filas}x{columnas}",
+                      'imagenes': imagenes, 'bytes_plantilla': os.path.getsize(ruta)}
+
+        resultados.append({'caso': "reemplazar_marcadores", 'parametros': parametros, **medir(
+            lambda doc: motor.reemplazar_marcadores(doc, data), repeticiones,
+            preparar=lambda: Document(ruta)
+        )})
+        for nombre_motor, renderizar in (("xml", motor._renderizar_xml), ("docx", motor._renderizar_docx)):
+            resultados.append({'caso': "renderizar_plantilla", 'parametros': {**parametros, 'motor': nombre_motor}, **medir(
+                lambda: renderizar(ruta, data).close(), repeticiones
+            )})
+        resultados.append({'caso': "generar_zip", 'parametros': parametros, **medir(
+            lambda: motor.generar_zip(paciente, [f"Consulta/bench_{nombre}.docx"], plantillas_dir, io.BytesIO()),
+            repeticiones
+        )})
+        with motor.renderizar_plantilla(ruta, data) as salida:
+            renderizados.append((nombre, salida.read()))
+
+    # Generación completa con todas las plantillas sintéticas a la vez (paquete de internación)
+    todas = [f"Consulta/bench_{nombre}.docx" for nombre, *_ in tamaños]
+    resultados.append({'caso': "generar_zip", 'parametros': {'plantilla': "todas", 'cantidad': len(todas)}, **medir(
+        lambda: motor.generar_zip(paciente, todas, plantillas_dir, io.BytesIO()), repeticiones
+    )})
+
+    def armar_zip():
+        with tempfile.SpooledTemporaryFile(max_size=motor.SPOOL_MAX_BYTES) as archivo:
+            with zipfile.ZipFile(archivo, 'w', compression=zipfile.ZIP_DEFLATED,
+                                 compresslevel=motor.ZIP_NIVEL_COMPRESION) as zf:
+                for nombre, contenido in renderizados:
+                    with zf.open(f"paciente/{nombre}.docx", 'w') as entrada:
+                        shutil.copyfileobj(io.BytesIO(contenido), entrada)
+    resultados.append({'caso': "armar_zip", 'parametros': {
+        'documentos': len(renderizados), 'bytes_documentos': sum(len(c) for _, c in renderizados),
+        'nivel_compresion': motor.ZIP_NIVEL_COMPRESION
+    }, **medir(armar_zip, repeticiones)})
+    resultados.append({'caso': "combinar_documentos", 'parametros': {'documentos': len(renderizados)}, **medir(
+        lambda: motor.combinar_documentos([contenido for _, contenido in renderizados], io.BytesIO()), repeticiones
+    )})
+    return resultados
+
+def _fila_sintetica(i, rnd):
+    return {
+        'Fecha_Registro': f"20{rnd.randint(20, 26)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d} 10:00",
+        'Nombre_Completo': f"Paciente{i} {rnd.choice(['Pérez', 'Mamani', 'Quispe', 'López'])} {rnd.choice(['Condori', 'Flores'])}",
+        'Num_Historia': str(100000 + i), 'Num_Registro': f"{rnd.randint(1, 28):02d}{rnd.randint(1, 12):02d}{rnd.randint(0, 99):02d}",
+        'Edad': str(rnd.randint(1, 95)), 'Servicio': rnd.choice(["Hematología", "Medicina Interna", "Oncología Clínica"]),
+        'Diagnostico': rnd.choice(["Anemia ferropénica", "Linfoma no Hodgkin", "Leucemia aguda", "Neumonía"]),
+        'Fecha_Internacion': "01/01/2026", 'Genero': rnd.choice(["Masculino", "Femenino"]),
+        'Residente_La_Paz': rnd.choice(["Sí", "No"]), 'CIE10': rnd.choice(["D50.9", "C85.9", "C95.0", "J18.9"]),
+    }
+
+def bench_historial(directorio, tamaños, repeticiones):
+    import app # Importa las funciones del historial (Streamlit solo avisa que no está en ejecución)
+    rnd = random.Random(0)
+    resultados = []
+    for n in tamaños:
+        historial_db = os.path.join(directorio, f"historial_{n}.db")
+        app._inicializar_historial(historial_db, os.path.join(directorio, "no_existe.xlsx"))
+        with app._conectar_historial(historial_db) as conn:
+            app._insertar_historial(conn, (_fila_sintetica(i, rnd) for i in range(n)))
+        escritor = app._EscritorHistorial(historial_db)
+        contador = iter(range(n, n + 10 * repeticiones + 10))
+        parametros = {'filas_previas': n}
+
+        resultados.append({'caso': "guardar_en_historial", 'parametros': parametros, **medir(
+            lambda: escritor.agregar([_fila_sintetica(next(contador), rnd)]).result(timeout=60), repeticiones
+        )})
+        resultados.append({'caso': "leer_historial", 'parametros': parametros, **medir(
+            lambda: app._leer_historial(historial_db), max(3, repeticiones // 5)
+        )})
+        resultados.append({'caso': "buscar_pacientes", 'parametros': parametros, **medir(
+            lambda: app._buscar_pacientes(historial_db, "perez anem"), repeticiones
+        )})
+    return resultados
+
+def estres_historial(directorio, envios, lectores):
+    """
+    Prueba de carga del escritor del historial: `envios` sesiones guardan a la vez, uno de
+    cada 25 con una fila que no se puede guardar, mientras `lectores` hilos buscan y cuentan.
+    Lanza AssertionError si se pierde o duplica un registro válido, si un envío inválido
+    arrastra a otros, si falla una lectura, o si un escritor detenido no falla enseguida.
+    """
+    import app
+    historial_db = os.path.join(directorio, "estres.db")
+    app._inicializar_historial(historial_db, os.path.join(directorio, "no_existe.xlsx"))
+    escritor = app._EscritorHistorial(historial_db)
+    invalidos = set(range(0, envios, 25))
+    barrera = threading.Barrier(envios + lectores) # Todos arrancan a la vez
+    terminado = threading.Event()
+    errores_lectura = []
+
+    def _enviar(i):
+        filas = [_fila_sintetica(i, random.Random(i))]
+        if i in invalidos:
+            filas.append(None)
+        barrera.wait()
+        try:
+            escritor.agregar(filas).result(timeout=120)
+            return True
+        except Exception:
+            return False
+
+    def _leer():
+        barrera.wait()
+        while not terminado.is_set():
+            try:
+                app._buscar_pacientes(historial_db, "paciente")
+                with app._conectar_historial(historial_db) as conn:
+                    conn.execute("SELECT COUNT(*) FROM historial").fetchone()
+            except Exception as e:
+                errores_lectura.append(e)
+                return
+
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=envios + lectores) as pool:
+        for _ in range(lectores):
+            pool.submit(_leer)
+        guardados = list(pool.map(_enviar, range(envios)))
+        terminado.set()
+    segundos = time.perf_counter() - inicio
+
+    with app._conectar_historial(historial_db) as conn:
+        total = conn.execute("SELECT COUNT(*) FROM historial").fetchone()[0]
+        historias = {fila[0] for fila in conn.execute("SELECT Num_Historia FROM historial")}
+    esperadas = {str(100000 + i) for i in range(envios) if i not in invalidos}
+    rechazados = {i for i, guardado in enumerate(guardados) if not guardado}
+    if rechazados != invalidos:
+        raise AssertionError(f"Envíos rechazados {sorted(rechazados)}, se esperaban {sorted(invalidos)}")
+    if total != len(esperadas) or historias != esperadas:
+        raise AssertionError(f"El historial tiene {total} registros, se esperaban {len(esperadas)}")
+    if errores_lectura:
+        raise AssertionError(f"Fallaron lecturas concurrentes: {errores_lectura[0]}")
+
+    # Un escritor que no puede abrir la base debe fallar enseguida, no al vencer el timeout
+    detenido = app._EscritorHistorial(directorio) # Un directorio no se abre como base SQLite
+    inicio_detenido = time.perf_counter()
+    try:
+        detenido.agregar([_fila_sintetica(0, random.Random(0))]).result(timeout=10)
+    except Exception as e:
+        if isinstance(e, TimeoutError):
+            raise AssertionError("El escritor detenido no informó el error") from e
+    else:
+        raise AssertionError("El escritor detenido aceptó filas")
+    segundos_detenido = time.perf_counter() - inicio_detenido
+
+    return {'caso': "estres_historial",
+            'parametros': {'envios': envios, 'lectores': lectores, 'invalidos': len(invalidos)},
+            'registros': total, 'segundos': round(segundos, 3),
+            'envios_por_segundo': round(envios / segundos, 1),
+            'ms_error_escritor_detenido': round(segundos_detenido * 1000, 1)}
+
+def verificar_migracion_historial(directorio):
+    """
+    Migra un pacientes.xlsx con las dos formas en que llegan las fechas (celdas de fecha de
+    Excel, que se leen como "2025-02-03 08:00:00", y texto D/M/A) y lanza AssertionError si
+    alguna se guarda con otra fecha, por ejemplo con el día y el mes invertidos.
+    """
+    import app
+    import openpyxl
+    casos = [ # (valor de la celda, fecha esperada en la base)
+        (datetime(2025, 2, 3, 8, 0), "2025-02-03 08:00"),
+        ("2025-02-03 08:00:00", "2025-02-03 08:00"),
+        ("2025-11-04", "2025-11-04 00:00"),
+        ("03/02/2025 08:00", "2025-02-03 08:00"),
+        ("3/2/2025", "2025-02-03 00:00"),
+        ("04/11/2025 09:30:00", "2025-11-04 09:30"),
+    ]
+    excel_file = os.path.join(directorio, "pacientes.xlsx")
+    libro = openpyxl.Workbook()
+    hoja = libro.active
+    hoja.append(["Fecha_Registro", "Nombre_Completo", "Num_Historia"])
+    for i, (valor, _) in enumerate(casos):
+        hoja.append([valor, f"Paciente{i}", str(200000 + i)])
+    libro.save(excel_file)
+
+    historial_db = os.path.join(directorio, "migracion.db")
+    app._inicializar_historial(historial_db, excel_file)
+    with app._conectar_historial(historial_db) as conn:
+        guardadas = dict(conn.execute("SELECT Num_Historia, Fecha_Registro FROM historial"))
+    for i, (valor, esperada) in enumerate(casos):
+        if guardadas.get(str(200000 + i)) != esperada:
+            raise AssertionError(f"{valor!r} se migró como {guardadas.get(str(200000 + i))!r}, se esperaba {esperada!r}")
+    return {'caso': "verificar_migracion_historial", 'parametros': {'fechas': len(casos)}, 'registros': len(guardadas)}
+
+def verificar_documento_combinado(directorio):
+    """
+    Une plantillas reales de PLANTILLAS/Consulta en un .docx para imprimir y lanza
+    AssertionError si falta alguna fuente de los documentos agregados en la tabla de fuentes
+    o si alguna fuente incrustada no llega con el mismo contenido.
+    """
+    w = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+    r = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+    carpeta = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PLANTILLAS", "Consulta")
+    nombres = ["Caratula.docx", "HISTORIA CLINICA.docx", "Nota de internacion.docx"]
+    documentos = []
+    for nombre in nombres:
+        with open(os.path.join(carpeta, nombre), "rb") as f:
+            documentos.append(f.read())
+    destino = os.path.join(directorio, "combinado.docx")
+    motor.combinar_documentos(documentos, destino)
+    Document(destino) # Se abre sin errores
+
+    def fuentes(zf):
+        """{nombre de la fuente: {tipo de incrustación: bytes de la fuente}} y la configuración."""
+        tabla = etree.fromstring(zf.read("word/fontTable.xml"))
+        rels = {}
+        if "word/_rels/fontTable.xml.rels" in zf.namelist():
+            rels = {rel.get("Id"): rel.get("Target")
+                    for rel in etree.fromstring(zf.read("word/_rels/fontTable.xml.rels"))}
+        return {fuente.get(f"{w}name"): {hijo.tag: zf.read(f"word/{rels[hijo.get(f'{r}id')]}")
+                                         for hijo in fuente if hijo.get(f"{r}id")}
+                for fuente in tabla.iter(f"{w}font")}, zf.read("word/settings.xml")
+
+    with zipfile.ZipFile(destino) as zf:
+        combinadas, configuracion = fuentes(zf)
+    incrustadas = 0
+    for nombre, contenido in zip(nombres, documentos):
+        with zipfile.ZipFile(io.BytesIO(contenido)) as zf:
+            propias, _ = fuentes(zf)
+        for fuente, partes in propias.items():
+            if fuente not in combinadas:
+                raise AssertionError(f"Falta la fuente {fuente!r} de {nombre} en el documento combinado")
+            for tipo, datos in partes.items():
+                if combinadas[fuente].get(tipo) != datos:
+                    raise AssertionError(f"La fuente incrustada {fuente!r} ({tipo}) de {nombre} no se copió")
+                incrustadas += 1
+    if incrustadas and b"embedTrueTypeFonts" not in configuracion:
+        raise AssertionError("El documento combinado no indica que usa fuentes incrustadas")
+    return {'caso': "verificar_documento_combinado", 'parametros': {'documentos': len(nombres)},
+            'fuentes': len(combinadas), 'incrustadas': incrustadas}
+
+def bench_cie10(repeticiones):
+    resultados = [{'caso': "cargar_catalogo_cie10", 'parametros': {}, **medir(
+        lambda: cie10.CatalogoCIE10.desde_archivo(cie10.ARCHIVO_CIE10), max(3, repeticiones // 5)
+    )}]
+    catalogo = cie10.CatalogoCIE10.desde_archivo(cie10.ARCHIVO_CIE10)
+    for tipo, consulta in (("codigo", "d50"), ("palabras", "anemia hierro"), ("tipeo", "leucmia mieloide")):
+        resultados.append({'caso': "buscar_cie10", 'parametros': {'consulta': tipo, 'entradas': len(catalogo)},
+                           **medir(lambda: catalogo.buscar(consulta), repeticiones)})
+    return resultados
+
+def _version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de generación de documentos e historial.")
+    parser.add_argument("--salida", help="Archivo JSON de resultados (por defecto, salida estándar)")
+    parser.add_argument("--repeticiones", type=int, default=20)
+    parser.add_argument("--rapido", action="store_true", help="Solo la plantilla pequeña y 1k/10k filas de historial")
+    parser.add_argument("--sin-historial", action="store_true", help="Omite las pruebas del historial")
+    parser.add_argument("--estres-historial", action="store_true",
+                        help="Solo la prueba de carga del escritor del historial (falla si se pierden registros)")
+    parser.add_argument("--verificar", action="store_true",
+                        help="Solo las verificaciones de resultados (falla si alguna no se cumple)")
+    parser.add_argument("--envios", type=int, default=300, help="Guardados simultáneos de --estres-historial")
+    parser.add_argument("--lectores", type=int, default=8, help="Hilos que leen durante --estres-historial")
+    args = parser.parse_args(argv)
+
+    tamaños = TAMAÑOS_PLANTILLA[:1] if args.rapido else TAMAÑOS_PLANTILLA
+    tamaños_historial = TAMAÑOS_HISTORIAL[:2] if args.rapido else TAMAÑOS_HISTORIAL
+    directorio = tempfile.mkdtemp(prefix="bench_hcl_")
+    try:
+        if args.estres_historial:
+            resultados = [estres_historial(directorio, args.envios, args.lectores)]
+        elif args.verificar:
+            resultados = [verificar_migracion_historial(directorio), verificar_documento_combinado(directorio)]
+        else:
+            resultados = bench_plantillas(directorio, tamaños, args.repeticiones) + bench_cie10(args.repeticiones)
+            if not args.sin_historial:
+                resultados += bench_historial(directorio, tamaños_historial, args.repeticiones)
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    informe = {
+        'version': _version(),
+        'fecha': datetime.now().isoformat(timespec="seconds"),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+        'pool_render': motor.POOL_RENDER,
+        'workers_render': motor.MAX_WORKERS_RENDER,
+        'resultados': resultados,
+    }
+    texto = json.dumps(informe, ensure_ascii=False, indent=2)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(texto + "\n")
+    else:
+        print(texto)
+
+if __name__ == "__main__":
+    main()
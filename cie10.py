@@ -0,0 +1,141 @@
+"""
+Catálogo CIE-10 local para sugerir diagnósticos mientras se escribe.
+
+El catálogo se lee una sola vez por proceso de cie10.tsv (junto a este módulo, o el archivo
+indicado en HCL_CIE10_ARCHIVO), con una línea "código<TAB>descripción" por entrada y una
+línea de encabezado. Se arman dos índices en memoria, ambos listas ordenadas que se
+recorren con bisect:
+  - los códigos sin punto ("D509"), para buscar por prefijo de código;
+  - las palabras de las descripciones en minúsculas y sin acentos, cada una con las
+    entradas que la contienen, para buscar por prefijos de palabras ("anem hierro").
+Si una palabra no coincide con ningún prefijo, se prueba con las más parecidas del
+índice, así un error de tipeo ("leucmia") igual encuentra resultados.
+"""
+import array
+import bisect
+import difflib
+import os
+import re
+import threading
+import unicodedata
+
+import metricas
+
+ARCHIVO_CIE10 = os.environ.get(
+    "HCL_CIE10_ARCHIVO", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cie10.tsv")
+)
+# Cantidad de sugerencias por búsqueda
+CIE10_SUGERENCIAS = 10
+# Similitud mínima (0 a 1) para aceptar una palabra parecida cuando ningún prefijo coincide
+CIE10_SIMILITUD_MINIMA = 0.75
+
+# Una letra, dos dígitos y opcionalmente uno o dos más, con o sin punto ("d509", "D50.9")
+_PATRON_CODIGO = re.compile(r"\b([A-Za-z])(\d{2})(?:\.?(\d{1,2}))?\b")
+# Lo que se busca como código (y no como palabra): letra seguida de al menos un dígito
+_PATRON_PREFIJO_CODIGO = re.compile(r"[a-z]\d[\d.]*")
+
+def _normalizar(texto):
+    """Minúsculas y sin acentos, para comparar 'Anemia' con 'anémia'."""
+    descompuesto = unicodedata.normalize("NFKD", str(texto))
+    return "".join(c for c in descompuesto if not unicodedata.combining(c)).lower()
+
+def _palabras(texto):
+    return re.findall(r"[\w.]+", _normalizar(texto))
+
+def _clave_codigo(codigo):
+    return codigo.replace(".", "").strip().upper()
+
+def normalizar_codigos(texto):
+    """
+    Escribe los códigos CIE-10 del texto en la forma habitual ("d509" -> "D50.9") y deja el
+    resto igual, así el mismo diagnóstico se agrupa igual en el historial y en el censo.
+    """
+    def _formatear(m):
+        letra, categoria, subcategoria = m.groups()
+        return f"{letra.upper()}{categoria}" + (f".{subcategoria}" if subcategoria else "")
+    return _PATRON_CODIGO.sub(_formatear, texto)
+
+def extraer_codigos(texto):
+    """Códigos CIE-10 del texto, en la forma habitual y sin repetir ("d509, C91.0" -> ["D50.9", "C91.0"])."""
+    return list(dict.fromkeys(normalizar_codigos(m.group(0)) for m in _PATRON_CODIGO.finditer(texto)))
+
+class CatalogoCIE10:
+    """Índices de búsqueda sobre una lista de (código, descripción)."""
+
+    def __init__(self, entradas):
+        entradas = sorted(entradas, key=lambda e: _clave_codigo(e[0]))
+        self.codigos = [codigo for codigo, _ in entradas]
+        self.descripciones = [descripcion for _, descripcion in entradas]
+        self._claves = [_clave_codigo(c) for c in self.codigos]
+        self._normalizadas = [_normalizar(d) for d in self.descripciones]
+        apariciones = {}
+        for i, descripcion in enumerate(self._normalizadas):
+            for palabra in dict.fromkeys(re.findall(r"\w+", descripcion)):
+                apariciones.setdefault(palabra, array.array("I")).append(i)
+        self._palabras = sorted(apariciones)
+        self._apariciones = [apariciones[p] for p in self._palabras] # Índices de entradas, crecientes
+
+    @classmethod
+    def desde_archivo(cls, ruta):
+        entradas = []
+        with open(ruta, encoding="utf-8") as f:
+            next(f, None) # Encabezado
+            for linea in f:
+                codigo, _, descripcion = linea.rstrip("\r\n").partition("\t")
+                if codigo.strip() and descripcion.strip():
+                    entradas.append((codigo.strip(), descripcion.strip()))
+        return cls(entradas)
+
+    def __len__(self):
+        return len(self.codigos)
+
+    def _por_codigo(self, prefijo):
+        clave = _clave_codigo(prefijo)
+        return set(range(bisect.bisect_left(self._claves, clave), bisect.bisect_right(self._claves, clave + "\U0010ffff")))
+
+    def _por_palabra(self, prefijo):
+        desde = bisect.bisect_left(self._palabras, prefijo)
+        hasta = bisect.bisect_right(self._palabras, prefijo + "\U0010ffff", desde)
+        if desde == hasta and len(prefijo) >= 4:
+            # Solo se comparan las palabras con la misma inicial (un rango del índice)
+            inicio = bisect.bisect_left(self._palabras, prefijo[0])
+            fin = bisect.bisect_right(self._palabras, prefijo[0] + "\U0010ffff", inicio)
+            parecidas = difflib.get_close_matches(prefijo, self._palabras[inicio:fin], n=3,
+                                                  cutoff=CIE10_SIMILITUD_MINIMA)
+            return {i for p in parecidas for i in self._apariciones[bisect.bisect_left(self._palabras, p)]}
+        return {i for j in range(desde, hasta) for i in self._apariciones[j]}
+
+    def buscar(self, consulta, limite=CIE10_SUGERENCIAS):
+        """
+        Entradas que coinciden con todas las palabras de la consulta, como lista de
+        (código, descripción). Cada palabra es un prefijo de código ("d50", "C91.0") o de
+        una palabra de la descripción. Primero van las descripciones que empiezan con la
+        primera palabra buscada y después el resto, en el orden del código.
+        """
+        palabras = _palabras(consulta)
+        if not palabras:
+            return []
+        with metricas.medir("buscar_cie10"):
+            coincidencias = None
+            for palabra in palabras:
+                palabra = palabra.strip(".")
+                if not palabra:
+                    continue
+                indices = (self._por_codigo(palabra) if _PATRON_PREFIJO_CODIGO.fullmatch(palabra)
+                           else self._por_palabra(palabra))
+                coincidencias = indices if coincidencias is None else coincidencias & indices
+                if not coincidencias:
+                    return []
+            primera = palabras[0]
+            orden = sorted(coincidencias or (), key=lambda i: (not self._normalizadas[i].startswith(primera), i))
+            return [(self.codigos[i], self.descripciones[i]) for i in orden[:limite]]
+
+_catalogos = {}
+_catalogos_lock = threading.Lock()
+
+def obtener_catalogo_cie10(ruta=ARCHIVO_CIE10):
+    """Catálogo CIE-10 de `ruta`, leído una vez y compartido por todo el proceso."""
+    with _catalogos_lock:
+        if ruta not in _catalogos:
+            _catalogos[ruta] = CatalogoCIE10.desde_archivo(ruta)
+        return _catalogos[ruta]
@@ -0,0 +1,128 @@
+"""
+Medición de tiempos por etapa del pipeline de generación.
+
+Se activa con la variable de entorno HCL_METRICAS=1 (o con `habilitar()`). Desactivada,
+`medir()` devuelve un contexto vacío compartido y el costo es prácticamente nulo.
+
+Cada medición queda en:
+  - una lista de eventos recientes y agregados por (etapa, plantilla), en memoria;
+  - el log "hcl.metricas" como una línea JSON (HCL_METRICAS_LOG=ruta para escribirlo a archivo);
+  - formato de texto de Prometheus con `exportar_prometheus()`, que también se escribe en
+    HCL_METRICAS_ARCHIVO (si está definido) al terminar cada solicitud.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+# Límites de los buckets del histograma de Prometheus, en segundos
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Cantidad de eventos recientes que se conservan para el panel de administración
+EVENTOS_RECIENTES_MAX = 500
+
+ARCHIVO_PROMETHEUS = os.environ.get("HCL_METRICAS_ARCHIVO")
+
+logger = logging.getLogger("hcl.metricas")
+if os.environ.get("HCL_METRICAS_LOG"):
+    _manejador = logging.FileHandler(os.environ["HCL_METRICAS_LOG"], encoding="utf-8")
+    _manejador.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_manejador)
+    logger.setLevel(logging.INFO)
+
+_activas = os.environ.get("HCL_METRICAS", "0") == "1"
+_lock = threading.Lock()
+_recientes = deque(maxlen=EVENTOS_RECIENTES_MAX)
+_agregados = {}  # (etapa, plantilla) -> [cantidad, suma, maximo, conteos por bucket]
+_NULO = contextlib.nullcontext()
+
+def habilitar(activas=True):
+    global _activas
+    _activas = activas
+
+def activas():
+    return _activas
+
+class _Medicion:
+    __slots__ = ("etapa", "plantilla", "inicio")
+
+    def __init__(self, etapa, plantilla):
+        self.etapa = etapa
+        self.plantilla = plantilla
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        registrar(self.etapa, time.perf_counter() - self.inicio, self.plantilla)
+        return False
+
+def medir(etapa, plantilla=""):
+    """Contexto que mide la duración de una etapa (opcionalmente de una plantilla)."""
+    return _Medicion(etapa, plantilla) if _activas else _NULO
+
+def registrar(etapa, segundos, plantilla=""):
+    """Registra una duración ya medida (no hace nada si las métricas están desactivadas)."""
+    if not _activas:
+        return
+    evento = {'ts': time.time(), 'etapa': etapa, 'plantilla': plantilla, 'segundos': round(segundos, 6)}
+    with _lock:
+        _recientes.append(evento)
+        agregado = _agregados.get((etapa, plantilla))
+        if agregado is None:
+            agregado = _agregados[(etapa, plantilla)] = [0, 0.0, 0.0, [0] * len(BUCKETS_SEGUNDOS)]
+        agregado[0] += 1
+        agregado[1] += segundos
+        agregado[2] = max(agregado[2], segundos)
+        for i, limite in enumerate(BUCKETS_SEGUNDOS):
+            if segundos <= limite:
+                agregado[3][i] += 1
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps(evento, ensure_ascii=False))
+
+def fin_de_solicitud():
+    """Punto de cierre de una solicitud: actualiza el archivo de Prometheus si está configurado."""
+    if _activas and ARCHIVO_PROMETHEUS:
+        temporal = f"{ARCHIVO_PROMETHEUS}.tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            f.write(exportar_prometheus())
+        os.replace(temporal, ARCHIVO_PROMETHEUS) # Reemplazo atómico para el recolector
+
+def eventos_recientes(limite=None):
+    """Últimos eventos, del más reciente al más antiguo."""
+    with _lock:
+        eventos = list(_recientes)
+    eventos.reverse()
+    return eventos[:limite] if limite else eventos
+
+def resumen():
+    """Agregados por (etapa, plantilla): cantidad, promedio y máximo en segundos."""
+    with _lock:
+        return [
+            {'etapa': etapa, 'plantilla': plantilla, 'cantidad': a[0],
+             'promedio_s': a[1] / a[0], 'maximo_s': a[2]}
+            for (etapa, plantilla), a in _agregados.items()
+        ]
+
+def _etiqueta(valor):
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def exportar_prometheus():
+    """Histograma hcl_etapa_segundos en formato de texto de Prometheus."""
+    lineas = [
+        "# HELP hcl_etapa_segundos Duración de cada etapa de la generación de documentos.",
+        "# TYPE hcl_etapa_segundos histogram",
+    ]
+    with _lock:
+        agregados = sorted(_agregados.items())
+    for (etapa, plantilla), (cantidad, suma, _, buckets) in agregados:
+        etiquetas = f'etapa="{_etiqueta(etapa)}",plantilla="{_etiqueta(plantilla)}"'
+        for limite, conteo in zip(BUCKETS_SEGUNDOS, buckets):
+            lineas.append(f'hcl_etapa_segundos_bucket{{{etiquetas},le="{limite}"}} {conteo}')
+        lineas.append(f'hcl_etapa_segundos_bucket{{{etiquetas},le="+Inf"}} {cantidad}')
+        lineas.append(f"hcl_etapa_segundos_sum{{{etiquetas}}} {suma:.6f}")
+        lineas.append(f"hcl_etapa_segundos_count{{{etiquetas}}} {cantidad}")
+    return "\n".join(lineas) + "\n"
@@ -0,0 +1,1607 @@
+"""
+Motor de generación de documentos médicos, independiente de la interfaz.
+
+Recibe los datos del paciente como un dict simple (mismas claves que el formulario
+de app.py) y una lista de plantillas, y produce el ZIP con los documentos. Lo usan
+la página de Streamlit, la línea de comandos y el servidor HTTP local:
+
+    python motor_documentos.py generar --datos paciente.json -p Consulta/Caratula.docx -o salida.zip
+    python motor_documentos.py servir --puerto 8765
+"""
+import argparse
+import bisect
+import copy
+import functools
+import io
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+import zlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime
+
+from docx import Document
+from docx.opc.constants import CONTENT_TYPE as CT, RELATIONSHIP_TYPE as RT
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn
+from lxml import etree
+
+import metricas
+from archivo_documentos import obtener_archivo
+from cie10 import CIE10_SUGERENCIAS, normalizar_codigos, obtener_catalogo_cie10
+
+# Campos que describen a un paciente (mismas claves que st.session_state en app.py)
+CAMPOS_PACIENTE = [
+    'nombres', 'apellido_paterno', 'apellido_materno', 'fecha_nacimiento_str', 'edad',
+    'num_historia', 'num_registro', 'ocupacion', 'estado_civil', 'residencia', 'genero',
+    'procedencia', 'domicilio', 'es_residente_la_paz',
+    'n_referencia1', 'referencia1', 'telefono_referencia1',
+    'n_referencia2', 'referencia2', 'telefono_referencia2',
+    'diagnosticos', 'diag_recetas_labs', 'cie10', 'servicio',
+    'observaciones', 'indicaciones', 'fecha_internacion'
+]
+
+# Categorías de plantillas: (título en pantalla, subcarpeta de PLANTILLAS)
+CATEGORIAS_PLANTILLAS = [
+    ("📋 Consulta", "Consulta"),
+    ("📨 Interconsulta", "Interconsulta"),
+    ("💊 Recetas", "Recetas"),
+    ("🧪 Laboratorios", "Laboratorios"),
+    ("🔬 Procedimientos", "Procedimientos"),
+    ("📊 Informes", "Informes")
+]
+# Cada cuántos segundos como máximo se revisa si cambió alguna carpeta de plantillas
+CATALOGO_INTERVALO_REVISION = 5.0
+
+# Límite de memoria de cada caché de plantillas (parseadas con python-docx y paquetes del
+# motor xml), según el peso estimado de sus entradas
+CACHE_PLANTILLAS_MAX_BYTES = 256 * 1024 * 1024
+# Un XML parseado con lxml ocupa unas 8-11 veces lo que el XML sin comprimir (medido con
+# las plantillas de PLANTILLAS/); el tamaño del .docx comprimido lo subestima hasta 90 veces
+FACTOR_MEMORIA_XML = 10
+
+# Motor de render por defecto: "xml" reescribe solo el XML de las partes con marcadores y copia
+# el resto del .docx tal cual; "docx" hace el recorrido completo con python-docx. Si "xml" no
+# puede con una plantilla se usa "docx".
+MOTOR_RENDER = os.environ.get("HCL_MOTOR_RENDER", "xml")
+# Motor para plantillas puntuales: "Carpeta/archivo.docx=docx,Otra/plantilla.docx=xml"
+MOTOR_RENDER_POR_PLANTILLA = {
+    clave.strip(): valor.strip()
+    for clave, valor in (par.split("=", 1) for par in os.environ.get("HCL_MOTOR_RENDER_PLANTILLAS", "").split(",") if "=" in par)
+}
+
+# Pool de renderizado compartido: "hilos" o "procesos", y cuántas plantillas a la vez
+POOL_RENDER = os.environ.get("HCL_POOL_RENDER", "hilos")
+MAX_WORKERS_RENDER = int(os.environ.get("HCL_WORKERS_RENDER", min(8, os.cpu_count() or 1)))
+
+# Compresión del ZIP de descarga (0 = sin compresión, 9 = máxima)
+ZIP_NIVEL_COMPRESION = 6
+# A partir de este tamaño los documentos y el ZIP pasan de memoria a un archivo temporal
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
+
+_W_P = qn("w:p")
+_W_T = qn("w:t")
+_XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+_SEPARADORES_TEXTO = re.compile(r"(\r\n|\n|\r|\t)")
+_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}Relationship"
+# Mismo criterio que el parser de python-docx: sin resolver entidades ni tocar los espacios
+_PARSER_XML = etree.XMLParser(remove_blank_text=False, resolve_entities=False)
+# Cabeceras del formato ZIP: registro local, registro del directorio central y fin del directorio
+_ZIP_LOCAL = struct.Struct("<4s5H3L2H")
+_ZIP_CENTRAL = struct.Struct("<4s6H3L5H2L")
+_ZIP_FIN = struct.Struct("<4s4H2LH")
+
+logger = logging.getLogger("hcl.motor")
+
+# --- Plantillas ---
+
+class _CachePorRuta:
+    """
+    Caché LRU por ruta de archivo, acotado por la suma del peso de sus entradas.
+    Cada entrada se valida contra el mtime y el tamaño del archivo: la versión nueva
+    de una plantilla reemplaza a la anterior en vez de sumarse a ella.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entradas = OrderedDict()  # ruta -> (firma, valor, peso)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _vigente(self, ruta, firma):
+        """El valor en caché si corresponde a `firma` (y lo marca como recién usado), o None."""
+        with self._lock:
+            entrada = self._entradas.get(ruta)
+            if entrada is not None and entrada[0] == firma:
+                self._entradas.move_to_end(ruta)
+                return entrada[1]
+        return None
+
+    def _guardar(self, ruta, firma, valor, peso):
+        """Guarda con el lock tomado. Devuelve False si no entra en el caché."""
+        if ruta in self._entradas:
+            self._bytes -= self._entradas.pop(ruta)[2]
+        if peso > self.max_bytes:
+            return False  # Demasiado grande para el caché; se vuelve a leer en cada uso
+        self._entradas[ruta] = (firma, valor, peso)
+        self._bytes += peso
+        while self._bytes > self.max_bytes:
+            _, (_, _, peso_viejo) = self._entradas.popitem(last=False)
+            self._bytes -= peso_viejo
+        return True
+
+def _peso_documento(ruta):
+    """Memoria estimada de la plantilla parseada: sus XML según FACTOR_MEMORIA_XML y el resto tal cual."""
+    with zipfile.ZipFile(ruta) as zf:
+        return sum(info.file_size * (FACTOR_MEMORIA_XML if info.filename.endswith((".xml", ".rels")) else 1)
+                   for info in zf.infolist())
+
+class _CachePlantillas(_CachePorRuta):
+    """
+    Caché LRU de plantillas .docx ya parseadas, compartido por todo el proceso.
+    Una plantilla modificada en PLANTILLAS/ se vuelve a leer automáticamente.
+    La plantilla maestra nunca se modifica: se entrega siempre una copia.
+    """
+
+    def obtener(self, ruta):
+        """Devuelve una copia editable de la plantilla, parseándola solo si cambió."""
+        info = os.stat(ruta)
+        firma = (info.st_mtime_ns, info.st_size)
+        maestro = self._vigente(ruta, firma)
+        if maestro is None:
+            maestro = Document(ruta)
+            peso = _peso_documento(ruta)
+            with self._lock:
+                if not self._guardar(ruta, firma, maestro, peso):
+                    return maestro  # No quedó en caché: no hace falta copiarla
+        return copy.deepcopy(maestro)
+
+    def precargar(self, ruta):
+        """Parsea la plantilla y la deja en caché (si no estaba ya vigente), sin copiarla."""
+        info = os.stat(ruta)
+        firma = (info.st_mtime_ns, info.st_size)
+        if self._vigente(ruta, firma) is not None:
+            return
+        maestro = Document(ruta)
+        peso = _peso_documento(ruta)
+        with self._lock:
+            self._guardar(ruta, firma, maestro, peso)
+
+class _CachePaquetes(_CachePorRuta):
+    """
+    Caché de los paquetes que usa el motor xml (ver _leer_paquete), compartido por todo el
+    proceso. Los paquetes no se modifican al renderizar, así que se entregan sin copiar.
+    """
+
+    def obtener(self, ruta):
+        info = os.stat(ruta)
+        firma = (info.st_mtime_ns, info.st_size)
+        paquete = self._vigente(ruta, firma)
+        if paquete is None:
+            paquete = _leer_paquete(ruta)
+            miembros, con_texto = paquete
+            peso = sum(len(crudo) for _, _, crudo in miembros) + sum(len(xml) for xml in con_texto.values())
+            with self._lock:
+                self._guardar(ruta, firma, paquete, peso)
+        return paquete
+
+class _CatalogoPlantillas:
+    """
+    Lista de plantillas por categoría, compartida por todas las sesiones. Una carpeta
+    solo se vuelve a listar cuando cambia su mtime (revisado como máximo cada
+    CATALOGO_INTERVALO_REVISION segundos) o cuando se fuerza con `refrescar`.
+    """
+
+    def __init__(self, plantillas_dir, carpetas):
+        self.plantillas_dir = plantillas_dir
+        self.carpetas = list(carpetas)
+        self._categorias = {}  # carpeta -> (mtime, documentos, claves)
+        self._revisado = 0.0
+        self._lock = threading.Lock()
+
+    def obtener(self):
+        """Devuelve {carpeta: (documentos, claves)}; las claves son "carpeta:archivo" en un frozenset."""
+        with self._lock:
+            if time.monotonic() - self._revisado >= CATALOGO_INTERVALO_REVISION:
+                self._revisar()
+            return {c: (docs, claves) for c, (_, docs, claves) in self._categorias.items()}
+
+    def refrescar(self):
+        """Vuelve a listar todas las carpetas en la próxima consulta."""
+        with self._lock:
+            self._categorias.clear()
+            self._revisado = 0.0
+
+    def _revisar(self):
+        for carpeta in self.carpetas:
+            path = os.path.join(self.plantillas_dir, carpeta)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                self._categorias.pop(carpeta, None)
+                continue
+            actual = self._categorias.get(carpeta)
+            if actual is None or actual[0] != mtime:
+                docs = tuple(sorted(f for f in os.listdir(path) if f.endswith('.docx') and not f.startswith('~')))
+                self._categorias[carpeta] = (mtime, docs, frozenset(f"{carpeta}:{d}" for d in docs))
+        self._revisado = time.monotonic()
+
+_cache_plantillas = _CachePlantillas(CACHE_PLANTILLAS_MAX_BYTES) # Uno por proceso
+_cache_paquetes = _CachePaquetes(CACHE_PLANTILLAS_MAX_BYTES)
+_catalogos = {}
+_catalogos_lock = threading.Lock()
+
+def obtener_catalogo(plantillas_dir):
+    """Catálogo de plantillas de `plantillas_dir`, compartido por todo el proceso."""
+    with _catalogos_lock:
+        if plantillas_dir not in _catalogos:
+            _catalogos[plantillas_dir] = _CatalogoPlantillas(
+                plantillas_dir, [carpeta for _, carpeta in CATEGORIAS_PLANTILLAS]
+            )
+        return _catalogos[plantillas_dir]
+
+# --- Reemplazo de marcadores ---
+
+@functools.lru_cache(maxsize=32)
+def _patron_marcadores(claves):
+    """Expresión regular única que reconoce cualquiera de los marcadores dados."""
+    return re.compile("|".join(re.escape(k) for k in sorted(claves, key=len, reverse=True)))
+
+def _raices_con_texto(doc):
+    """Cuerpo del documento y todas las partes de encabezado/pie (incluye primera página y pares)."""
+    yield doc.element.body
+    vistas = set()
+    for rel in doc.part.rels.values():
+        if rel.reltype in (RT.HEADER, RT.FOOTER) and not rel.is_external:
+            parte = rel.target_part
+            if id(parte) not in vistas:
+                vistas.add(id(parte))
+                yield parte.element
+
+def _escribir_texto(t, texto):
+    """Asigna texto a un <w:t>, convirtiendo saltos de línea y tabulaciones como lo hace python-docx."""
+    t.set(_XML_SPACE, "preserve")
+    trozos = _SEPARADORES_TEXTO.split(texto)
+    t.text = trozos[0]
+    anterior = t
+    for i in range(1, len(trozos), 2):
+        separador = OxmlElement("w:tab" if trozos[i] == "\t" else "w:br")
+        anterior.addnext(separador)
+        anterior = separador
+        if trozos[i + 1]:
+            nuevo_t = OxmlElement("w:t")
+            nuevo_t.set(_XML_SPACE, "preserve")
+            nuevo_t.text = trozos[i + 1]
+            anterior.addnext(nuevo_t)
+            anterior = nuevo_t
+
+def _reemplazar_en_parrafo(p, patron, valores):
+    """
+    Reemplaza los marcadores de un párrafo en una sola pasada sobre su texto.
+    Un marcador partido en varios runs se reconstruye y queda con el formato del primero.
+    Devuelve True si hubo algún reemplazo.
+    """
+    textos = [
+        t for t in p.iter(_W_T)
+        if t.getparent().getparent() is p or next(t.iterancestors(_W_P)) is p
+    ]
+    if not textos:
+        return False
+    actuales = [t.text or "" for t in textos]
+    coincidencias = list(patron.finditer("".join(actuales)))
+    if not coincidencias:
+        return False
+
+    inicios, pos = [], 0
+    for texto in actuales:
+        inicios.append(pos)
+        pos += len(texto)
+
+    nuevos = list(actuales)
+    for m in reversed(coincidencias): # De derecha a izquierda para no desplazar los índices
+        i = bisect.bisect_right(inicios, m.start()) - 1
+        j = bisect.bisect_right(inicios, m.end() - 1) - 1
+        ini, fin = m.start() - inicios[i], m.end() - inicios[j]
+        valor = valores[m.group(0)]
+        if i == j:
+            nuevos[i] = nuevos[i][:ini] + valor + nuevos[i][fin:]
+        else:
+            nuevos[i] = nuevos[i][:ini] + valor
+            for k in range(i + 1, j):
+                nuevos[k] = ""
+            nuevos[j] = nuevos[j][fin:]
+
+    for t, actual, nuevo in zip(textos, actuales, nuevos):
+        if nuevo != actual:
+            _escribir_texto(t, nuevo)
+    return True
+
+def reemplazar_marcadores(doc, data):
+    """
+    Reemplaza marcadores en .docx con los datos proporcionados.
+    Recorre una sola vez cada párrafo del cuerpo, tablas (incluso anidadas), cuadros de
+    texto y todos los encabezados/pies, resolviendo todos los marcadores con un único patrón.
+    """
+    if not data:
+        return
+    patron = _patron_marcadores(tuple(data))
+    valores = {k: str(v) for k, v in data.items()}
+    for raiz in _raices_con_texto(doc):
+        for p in raiz.iter(_W_P):
+            _reemplazar_en_parrafo(p, patron, valores)
+
+# --- Render ---
+
+def motor_de_plantilla(ruta_plantilla):
+    """Motor de render ("xml" o "docx") configurado para la plantilla."""
+    return MOTOR_RENDER_POR_PLANTILLA.get(_etiqueta_plantilla(ruta_plantilla), MOTOR_RENDER)
+
+def renderizar_plantilla(ruta_plantilla, data):
+    """
+    Genera un documento a partir de una plantilla, con el motor que le corresponda.
+    Devuelve un archivo temporal (en memoria o en disco si es grande) posicionado al inicio.
+    """
+    if motor_de_plantilla(ruta_plantilla) == "xml":
+        try:
+            return _renderizar_xml(ruta_plantilla, data)
+        except (OSError, KeyError, StopIteration, ValueError, zipfile.BadZipFile, etree.XMLSyntaxError) as e:
+            if isinstance(e, FileNotFoundError):
+                raise
+            logger.warning("Motor xml no aplicable a %s (%s); se usa python-docx", ruta_plantilla, e)
+    return _renderizar_docx(ruta_plantilla, data)
+
+def _renderizar_docx(ruta_plantilla, data):
+    """Render con python-docx: carga el paquete completo, reemplaza y lo vuelve a guardar entero."""
+    etiqueta = _etiqueta_plantilla(ruta_plantilla)
+    with metricas.medir("cargar_plantilla", etiqueta):
+        doc = _cache_plantillas.obtener(ruta_plantilla)
+    with metricas.medir("reemplazar_marcadores", etiqueta):
+        reemplazar_marcadores(doc, data)
+    salida = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        with metricas.medir("guardar_docx", etiqueta):
+            doc.save(salida)
+        salida.seek(0)
+    except Exception:
+        salida.close()
+        raise
+    return salida
+
+def _partes_con_texto(zf):
+    """Nombres, dentro del ZIP, del documento principal y de sus encabezados y pies."""
+    rels = etree.fromstring(zf.read("_rels/.rels"), _PARSER_XML)
+    principal = next(r.get("Target") for r in rels.iter(_REL) if r.get("Type") == RT.OFFICE_DOCUMENT).lstrip("/")
+    carpeta, nombre = posixpath.split(principal)
+    partes = [principal]
+    ruta_rels = posixpath.join(carpeta, "_rels", f"{nombre}.rels")
+    if ruta_rels in zf.NameToInfo:
+        for r in etree.fromstring(zf.read(ruta_rels), _PARSER_XML).iter(_REL):
+            if r.get("Type") in (RT.HEADER, RT.FOOTER) and r.get("TargetMode") != "External":
+                destino = r.get("Target")
+                parte = destino.lstrip("/") if destino.startswith("/") else posixpath.normpath(posixpath.join(carpeta, destino))
+                if parte not in partes:
+                    partes.append(parte)
+    return partes
+
+def _leer_paquete(ruta_plantilla):
+    """
+    Lee los miembros del ZIP de la plantilla, cada uno con su nombre y sus datos comprimidos
+    tal como están en el archivo, y el XML de las partes con texto que pueden tener marcadores.
+    Se guarda en _cache_paquetes, una vez por versión de la plantilla.
+    """
+    with open(ruta_plantilla, "rb") as f:
+        contenido = f.read()
+    zf = zipfile.ZipFile(io.BytesIO(contenido))
+    if len(zf.infolist()) >= 0xFFFF:
+        raise ValueError("ZIP64 no soportado")
+    miembros = []
+    for info in zf.infolist():
+        if info.flag_bits & 0x1:
+            raise ValueError("miembro cifrado")
+        if max(info.file_size, info.compress_size, info.header_offset) >= 0xFFFFFFFF:
+            raise ValueError("ZIP64 no soportado")
+        cabecera = contenido[info.header_offset:info.header_offset + _ZIP_LOCAL.size]
+        firma_local, *_, largo_nombre, largo_extra = _ZIP_LOCAL.unpack(cabecera)
+        if firma_local != b"PK\x03\x04":
+            raise ValueError("cabecera local inválida")
+        inicio = info.header_offset + _ZIP_LOCAL.size
+        nombre = contenido[inicio:inicio + largo_nombre]
+        inicio += largo_nombre + largo_extra
+        miembros.append((info, nombre, contenido[inicio:inicio + info.compress_size]))
+    con_texto = {}
+    for parte in _partes_con_texto(zf):
+        xml = zf.read(parte)
+        if b"{" in xml: # Sin llaves no puede haber marcadores, ni partidos en varios runs
+            con_texto[parte] = xml
+    return miembros, con_texto
+
+def _hora_fecha_dos(date_time):
+    año, mes, dia, hora, minuto, segundo = date_time
+    return hora << 11 | minuto << 5 | segundo // 2, (año - 1980) << 9 | mes << 5 | dia
+
+def _escribir_paquete(salida, miembros, reemplazadas):
+    """
+    Escribe el .docx: los miembros sin cambios se copian con sus datos comprimidos tal cual,
+    sin descomprimir ni recomprimir; solo las partes de `reemplazadas` se comprimen de nuevo.
+    """
+    centrales = []
+    for info, nombre, crudo in miembros:
+        flags = info.flag_bits & ~0x8 # Los tamaños van en la cabecera local: sin descriptor de datos
+        metodo, crc, tamaño = info.compress_type, info.CRC, info.file_size
+        if info.filename in reemplazadas:
+            datos = reemplazadas[info.filename]
+            compresor = zlib.compressobj(ZIP_NIVEL_COMPRESION, zlib.DEFLATED, -15)
+            crudo = compresor.compress(datos) + compresor.flush()
+            flags, metodo, crc, tamaño = info.flag_bits & 0x800, zipfile.ZIP_DEFLATED, zlib.crc32(datos), len(datos)
+        hora, fecha = _hora_fecha_dos(info.date_time)
+        desplazamiento = salida.tell()
+        salida.write(_ZIP_LOCAL.pack(b"PK\x03\x04", 20, flags, metodo, hora, fecha, crc, len(crudo), tamaño,
+                                     len(nombre), 0))
+        salida.write(nombre)
+        salida.write(crudo)
+        centrales.append(_ZIP_CENTRAL.pack(b"PK\x01\x02", 20, 20, flags, metodo, hora, fecha, crc, len(crudo),
+                                           tamaño, len(nombre), 0, 0, 0, 0, info.external_attr, desplazamiento) + nombre)
+    inicio_central = salida.tell()
+    for central in centrales:
+        salida.write(central)
+    salida.write(_ZIP_FIN.pack(b"PK\x05\x06", 0, 0, len(centrales), len(centrales),
+                               salida.tell() - inicio_central, inicio_central, 0))
+
+def _renderizar_xml(ruta_plantilla, data):
+    """
+    Render directo sobre el paquete: aplica los marcadores al XML del documento y de los
+    encabezados/pies que los tienen, con la misma lógica que python-docx, y copia las demás
+    partes (imágenes, estilos, fuentes...) byte a byte.
+    """
+    etiqueta = _etiqueta_plantilla(ruta_plantilla)
+    with metricas.medir("cargar_plantilla", etiqueta):
+        miembros, con_texto = _cache_paquetes.obtener(ruta_plantilla)
+    reemplazadas = {}
+    with metricas.medir("reemplazar_marcadores", etiqueta):
+        if data:
+            patron = _patron_marcadores(tuple(data))
+            valores = {k: str(v) for k, v in data.items()}
+            for parte, xml in con_texto.items():
+                raiz = etree.fromstring(xml, _PARSER_XML)
+                cambios = [_reemplazar_en_parrafo(p, patron, valores) for p in raiz.iter(_W_P)]
+                if any(cambios):
+                    # Igual que python-docx al guardar una parte XML
+                    reemplazadas[parte] = etree.tostring(raiz, encoding="UTF-8", standalone=True)
+    salida = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        with metricas.medir("guardar_docx", etiqueta):
+            _escribir_paquete(salida, miembros, reemplazadas)
+        salida.seek(0)
+    except Exception:
+        salida.close()
+        raise
+    return salida
+
+def _etiqueta_plantilla(ruta_plantilla):
+    """'Carpeta/archivo.docx' a partir de la ruta completa, para las métricas."""
+    return "/".join(ruta_plantilla.replace("\\", "/").split("/")[-2:])
+
+def _renderizar_plantilla_bytes(ruta_plantilla, data):
+    """
+    Variante para el pool de procesos: el resultado tiene que poder serializarse.
+    Las métricas de render quedan en cada proceso trabajador y no llegan al principal.
+    """
+    with renderizar_plantilla(ruta_plantilla, data) as salida:
+        return salida.read()
+
+_pool_render = None
+_pool_lock = threading.Lock()
+
+def _obtener_pool_render():
+    """Pool único por proceso (hilos o procesos según POOL_RENDER), creado al primer uso."""
+    global _pool_render
+    with _pool_lock:
+        if _pool_render is None:
+            if POOL_RENDER == "procesos":
+                from concurrent.futures import ProcessPoolExecutor # Solo se importa si se usa
+                _pool_render = ProcessPoolExecutor(max_workers=MAX_WORKERS_RENDER)
+            else:
+                _pool_render = ThreadPoolExecutor(max_workers=MAX_WORKERS_RENDER, thread_name_prefix="render")
+        return _pool_render
+
+def precalentar(plantillas_dir):
+    """
+    Deja listo el proceso para la primera solicitud: parsea todas las plantillas del catálogo,
+    crea el pool de renderizado (con sus procesos, si corresponde) y arma los índices del
+    catálogo CIE-10. Pensado para correr en segundo plano al arrancar. Devuelve los segundos
+    de cada etapa y los registra en las métricas.
+    """
+    tiempos = {}
+    inicio = time.perf_counter()
+    for carpeta, (docs, _) in obtener_catalogo(plantillas_dir).obtener().items():
+        for doc in docs:
+            ruta = os.path.join(plantillas_dir, carpeta, doc)
+            try:
+                if motor_de_plantilla(ruta) == "xml":
+                    _cache_paquetes.obtener(ruta)
+                else:
+                    _cache_plantillas.precargar(ruta)
+            except Exception:
+                pass # Una plantilla dañada se informa al intentar generarla
+    tiempos['plantillas'] = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    pool = _obtener_pool_render()
+    if POOL_RENDER == "procesos":
+        for tarea in [pool.submit(os.getpid) for _ in range(MAX_WORKERS_RENDER)]:
+            tarea.result() # Fuerza el arranque de los procesos trabajadores
+    tiempos['pool_render'] = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    obtener_catalogo_cie10()
+    tiempos['cie10'] = time.perf_counter() - inicio
+
+    for etapa, segundos in tiempos.items():
+        metricas.registrar("arranque", segundos, etapa)
+    return tiempos
+
+def precalentar_en_segundo_plano(plantillas_dir):
+    """Lanza `precalentar` en un hilo e informa los tiempos por stderr al terminar."""
+    def _ejecutar():
+        try:
+            tiempos = precalentar(plantillas_dir)
+        except Exception as e:
+            logger.warning("Precalentamiento interrumpido: %s", e, exc_info=True)
+            return
+        detalle = ", ".join(f"{etapa} {segundos * 1000:.0f} ms" for etapa, segundos in tiempos.items())
+        print(f"Precalentamiento terminado: {detalle}", file=sys.stderr)
+    hilo = threading.Thread(target=_ejecutar, name="precalentamiento", daemon=True)
+    hilo.start()
+    return hilo
+
+# --- ZIP ---
+
+def escribir_documentos_zip(zf, carpeta, nombre_comp, seleccionadas, plantillas_dir, data, archivo=None,
+                            al_avanzar=None, cancelar=None, contenidos=None):
+    """
+    Renderiza las plantillas seleccionadas en paralelo y las escribe, en el orden de selección,
+    dentro de `carpeta` en el ZIP. Cada plantilla falla por separado.
+    Con un ArchivoDocumentos, los documentos ya archivados se toman de ahí sin renderizar
+    y los nuevos se archivan. `al_avanzar(nombre)` se llama después de cada plantilla y, si
+    `cancelar` (un threading.Event) se activa, las plantillas que faltan no se renderizan.
+    Si se pasa la lista `contenidos`, se le agregan los bytes de cada documento escrito
+    (para combinar_documentos). Devuelve (generados, errores).
+    """
+    pool = _obtener_pool_render()
+    renderizar = _renderizar_plantilla_bytes if POOL_RENDER == "procesos" else renderizar_plantilla
+    tareas = []
+    for v in seleccionadas:
+        ruta_plantilla = os.path.join(plantillas_dir, v['carpeta'], v['archivo'])
+        if not os.path.exists(ruta_plantilla):
+            tareas.append((v, None, None, False))
+            continue
+        clave = archivo.clave(ruta_plantilla, data) if archivo is not None else None
+        archivado = archivo.obtener(clave) if clave else None
+        if archivado is not None:
+            tarea = Future()
+            tarea.set_result(archivado)
+        else:
+            tarea = pool.submit(renderizar, ruta_plantilla, data)
+        tareas.append((v, tarea, clave, archivado is None))
+
+    generados, errores = [], []
+    for v, tarea, clave, archivar in tareas:
+        if cancelar is not None and cancelar.is_set():
+            # Las que todavía no empezaron ya no se renderizan; las que están en curso se
+            # descartan al terminar, para no dejar abiertos sus archivos temporales
+            if tarea is not None and not tarea.cancel():
+                tarea.add_done_callback(_descartar_documento)
+            continue
+        if tarea is None:
+            errores.append(f"Plantilla no encontrada: {v['archivo']}")
+        else:
+            _escribir_documento(zf, carpeta, nombre_comp, v, tarea, clave, archivar, archivo, generados, errores,
+                                contenidos)
+        if al_avanzar is not None:
+            al_avanzar(v['archivo'])
+    return generados, errores
+
+def _descartar_documento(tarea):
+    """Cierra el documento renderizado de una tarea que ya no se va a escribir."""
+    if tarea.cancelled() or tarea.exception() is not None:
+        return
+    contenido = tarea.result()
+    if not isinstance(contenido, bytes):
+        contenido.close()
+
+def _escribir_documento(zf, carpeta, nombre_comp, v, tarea, clave, archivar, archivo, generados, errores, contenidos):
+    """Escribe en el ZIP (y archiva si corresponde) el documento de una plantilla ya encargada."""
+    try:
+        base = v['archivo'].replace('.docx', '')
+        fname = f"{base} - {nombre_comp}.docx"
+        # Cada documento se copia en bloques a su entrada comprimida, sin copias intermedias
+        contenido = tarea.result()
+        if (clave and archivar or contenidos is not None) and not isinstance(contenido, bytes):
+            with contenido:
+                contenido = contenido.read()
+        if clave and archivar:
+            archivo.guardar(clave, contenido)
+        if isinstance(contenido, bytes):
+            if contenidos is not None:
+                contenidos.append(contenido)
+            contenido = io.BytesIO(contenido)
+        with metricas.medir("escribir_zip", f"{v['carpeta']}/{v['archivo']}"):
+            # Con ZipInfo la entrada lleva la hora actual (con un nombre solo, zipfile pone 1980-01-01)
+            info = zipfile.ZipInfo(os.path.join(carpeta, fname), date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info._compresslevel = zf.compresslevel # zipfile no lo copia del ZipFile cuando recibe un ZipInfo
+            with contenido, zf.open(info, 'w') as entrada:
+                shutil.copyfileobj(contenido, entrada)
+        generados.append({'cat': v['carpeta'], 'file': fname,
+                          'plantilla': f"{v['carpeta']}/{v['archivo']}", 'clave': clave})
+    except Exception as e:
+        errores.append(f"{v['archivo']}: {e}")
+
+def archivar_generacion(archivo, carpeta, generados, data):
+    """Registra en el archivo lo generado para un paciente; devuelve la clave del manifiesto."""
+    documentos = [{'plantilla': d['plantilla'], 'nombre': d['file'], 'clave': d['clave']} for d in generados]
+    return archivo.guardar_manifiesto(carpeta, documentos, data)
+
+def nuevo_zip(destino=None):
+    """
+    ZIP comprimido sobre `destino` (ruta o archivo binario) o, si es None, sobre un archivo
+    temporal que pasa a disco si crece demasiado. Devuelve (archivo, ZipFile).
+    """
+    archivo = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) if destino is None else destino
+    return archivo, zipfile.ZipFile(archivo, 'w', compression=zipfile.ZIP_DEFLATED,
+                                    compresslevel=ZIP_NIVEL_COMPRESION)
+
+# --- Documento combinado para imprimir ---
+
+_NS_W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_NS_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_NS_TIPOS = "{http://schemas.openxmlformats.org/package/2006/content-types}"
+_NS_RELACIONES = "http://schemas.openxmlformats.org/package/2006/relationships"
+_W_VAL = qn("w:val")
+_W_ID = qn("w:id")
+_W_TIPO = qn("w:type")
+_W_ID_ESTILO = qn("w:styleId")
+_W_ID_NUMERACION_ABSTRACTA = qn("w:abstractNumId")
+_W_NUM_ID = qn("w:numId")
+_W_PPR = qn("w:pPr")
+_W_PSTYLE = qn("w:pStyle")
+_W_TBL_PR = qn("w:tblPr")
+_W_TBL_STYLE = qn("w:tblStyle")
+_W_MARCADORES = (qn("w:bookmarkStart"), qn("w:bookmarkEnd"))
+_WP_DOC_PR = qn("wp:docPr")
+# Elementos cuyo w:val es el id de un estilo
+_REFERENCIAS_ESTILO = frozenset(qn(f"w:{t}") for t in (
+    "pStyle", "rStyle", "tblStyle", "basedOn", "next", "link", "numStyleLink", "styleLink"
+))
+# Orden de los hijos de w:pPr y w:rPr según el esquema (al completar propiedades no se puede
+# agregar al final: Word rechaza el documento si el orden no es el del esquema)
+_ORDEN_PPR = [qn(f"w:{t}") for t in (
+    "pStyle", "keepNext", "keepLines", "pageBreakBefore", "framePr", "widowControl", "numPr",
+    "suppressLineNumbers", "pBdr", "shd", "tabs", "suppressAutoHyphens", "kinsoku", "wordWrap",
+    "overflowPunct", "topLinePunct", "autoSpaceDE", "autoSpaceDN", "bidi", "adjustRightInd", "snapToGrid",
+    "spacing", "ind", "contextualSpacing", "mirrorIndents", "suppressOverlap", "jc", "textDirection",
+    "textAlignment", "textboxTightWrap", "outlineLvl", "divId", "cnfStyle", "rPr", "sectPr", "pPrChange"
+)]
+_ORDEN_RPR = [qn(f"w:{t}") for t in (
+    "rStyle", "rFonts", "b", "bCs", "i", "iCs", "caps", "smallCaps", "strike", "dstrike", "outline",
+    "shadow", "emboss", "imprint", "noProof", "snapToGrid", "vanish", "webHidden", "color", "spacing", "w",
+    "kern", "position", "sz", "szCs", "highlight", "u", "effect", "bdr", "shd", "fitText", "vertAlign",
+    "rtl", "cs", "em", "lang", "eastAsianLayout", "specVanish", "oMath"
+)]
+# Orden de los hijos de w:font, y de los primeros de w:settings (hasta embedTrueTypeFonts)
+_ORDEN_FUENTE = [qn(f"w:{t}") for t in (
+    "altName", "panose1", "charset", "family", "notTrueType", "pitch", "sig",
+    "embedRegular", "embedBold", "embedItalic", "embedBoldItalic"
+)]
+_W_FUENTES_INCRUSTADAS = frozenset(_ORDEN_FUENTE[-4:])
+_ORDEN_CONFIGURACION = [qn(f"w:{t}") for t in (
+    "writeProtection", "view", "zoom", "removePersonalInformation", "removeDateAndTime",
+    "doNotDisplayPageBoundaries", "displayBackgroundShape", "printPostScriptOverText",
+    "printFractionalCharacterWidth", "printFormsData", "embedTrueTypeFonts"
+)]
+_SIGUEN_A_PPR = [qn(f"w:{t}") for t in ("rPr", "tblPr", "trPr", "tcPr", "tblStylePr")]
+_SIGUEN_A_RPR = [qn(f"w:{t}") for t in ("tblPr", "trPr", "tcPr", "tblStylePr")]
+
+# Valores de los atributos r:id, r:embed, etc. (cada uno sabe a qué elemento y atributo pertenece)
+_ATRIBUTOS_RELACION = etree.XPath(
+    "descendant-or-self::*/@*[namespace-uri() = "
+    "'http://schemas.openxmlformats.org/officeDocument/2006/relationships']"
+)
+
+def _renombrar_estilos(raiz, renombrados):
+    for nodo in raiz.iter(*_REFERENCIAS_ESTILO):
+        nuevo = renombrados.get(nodo.get(_W_VAL))
+        if nuevo is not None:
+            nodo.set(_W_VAL, nuevo)
+
+def _c14n(elemento):
+    return b"" if elemento is None else etree.tostring(elemento, method="c14n", exclusive=True)
+
+def _insertar_antes_de(padre, hijo, siguientes):
+    """Inserta `hijo` antes del primero de `siguientes` que tenga `padre` (o al final)."""
+    for elemento in padre:
+        if elemento.tag in siguientes:
+            elemento.addprevious(hijo)
+            return hijo
+    padre.append(hijo)
+    return hijo
+
+def _completar_propiedades(propiedades, por_defecto, orden):
+    """Agrega a `propiedades` (pPr o rPr) las de `por_defecto` que no define, respetando el orden del esquema."""
+    presentes = {hijo.tag for hijo in propiedades}
+    posicion = {tag: i for i, tag in enumerate(orden)}
+    for hijo in por_defecto:
+        if hijo.tag in presentes or not isinstance(hijo.tag, str):
+            continue
+        nuevo = copy.deepcopy(hijo)
+        indice = posicion.get(hijo.tag, len(orden))
+        for existente in propiedades:
+            if posicion.get(existente.tag, len(orden)) > indice:
+                existente.addprevious(nuevo)
+                break
+        else:
+            propiedades.append(nuevo)
+
+class _DocumentoCombinado:
+    """
+    Une varios .docx en uno: el primero es la base (tema, configuración) y cada documento
+    queda en su propia sección, con su tamaño de página, márgenes, encabezados y pies. Las
+    partes que referencia el cuerpo (imágenes, encabezados, vínculos) se copian con nombres
+    nuevos; los estilos y numeraciones que chocan con los de la base se renombran, y las
+    fuentes que la base no declara se agregan a su tabla de fuentes, con las incrustadas.
+    Cada parte XML de cada documento se analiza una sola vez.
+    """
+
+    def __init__(self, contenido):
+        self._base = zipfile.ZipFile(io.BytesIO(contenido))
+        self._nombres = set(self._base.namelist())
+        self._partes = {}  # nombre -> bytes o árbol XML de las partes nuevas o modificadas
+        self._tipos = self._leer("[Content_Types].xml")
+        self._rels = self._leer("word/_rels/document.xml.rels")
+        self._documento = self._leer("word/document.xml")
+        self._cuerpo = self._documento.find(qn("w:body"))
+        self._seccion = self._extraer_seccion(self._cuerpo)
+        self._ids_rel = {r.get("Id") for r in self._rels.iter(_REL)}
+        ruta = self._ruta_por_tipo(self._rels.iter(_REL), RT.STYLES)
+        self._estilos = self._leer(ruta) if ruta else None
+        ruta = self._ruta_por_tipo(self._rels.iter(_REL), RT.NUMBERING)
+        self._numeracion = self._leer(ruta) if ruta else None
+        self._ruta_fuentes = self._ruta_por_tipo(self._rels.iter(_REL), RT.FONT_TABLE)
+        self._fuentes = self._leer(self._ruta_fuentes) if self._ruta_fuentes else None
+        self._rels_fuentes = None # Se lee o se crea al incrustar la primera fuente
+        self._vacios = {}  # "header"/"footer" -> id de la relación a una parte vacía
+        self._id_dibujo = max((int(e.get("id", 0)) for e in self._documento.iter(_WP_DOC_PR)), default=0)
+        self._cantidad = 1
+
+    def _leer(self, nombre):
+        arbol = etree.fromstring(self._base.read(nombre), _PARSER_XML)
+        self._partes[nombre] = arbol
+        return arbol
+
+    @staticmethod
+    def _ruta_por_tipo(relaciones, tipo, carpeta="word"):
+        for rel in relaciones:
+            if rel.get("Type") == tipo and rel.get("TargetMode") != "External":
+                return _ruta_destino(carpeta, rel.get("Target"))
+        return None
+
+    @staticmethod
+    def _extraer_seccion(cuerpo):
+        """Quita y devuelve el w:sectPr final del cuerpo (la configuración de la última sección)."""
+        seccion = cuerpo[-1] if len(cuerpo) and cuerpo[-1].tag == qn("w:sectPr") else None
+        if seccion is None:
+            return etree.Element(qn("w:sectPr"))
+        cuerpo.remove(seccion)
+        return seccion
+
+    def _nombre_libre(self, nombre):
+        base, extension = posixpath.splitext(nombre)
+        candidato, n = f"{base}_{self._cantidad}{extension}", 1
+        while candidato in self._nombres:
+            n += 1
+            candidato = f"{base}_{self._cantidad}_{n}{extension}"
+        self._nombres.add(candidato)
+        return candidato
+
+    def _agregar_relacion(self, tipo, destino, externa=False):
+        n = len(self._ids_rel) + 1
+        while f"rId{n}" in self._ids_rel:
+            n += 1
+        rid = f"rId{n}"
+        self._ids_rel.add(rid)
+        rel = etree.SubElement(self._rels, _REL, Id=rid, Type=tipo, Target=destino)
+        if externa:
+            rel.set("TargetMode", "External")
+        return rid
+
+    def _agregar_tipo(self, nombre, tipo):
+        etree.SubElement(self._tipos, f"{_NS_TIPOS}Override", PartName=f"/{nombre}", ContentType=tipo)
+
+    def agregar(self, contenido):
+        """Agrega un documento (bytes de un .docx) en una sección nueva, al final."""
+        self._cantidad += 1
+        with zipfile.ZipFile(io.BytesIO(contenido)) as zf:
+            documento = etree.fromstring(zf.read("word/document.xml"), _PARSER_XML)
+            cuerpo = documento.find(qn("w:body"))
+            seccion = self._extraer_seccion(cuerpo)
+            rels = {r.get("Id"): r for r in etree.fromstring(zf.read("word/_rels/document.xml.rels"), _PARSER_XML).iter(_REL)}
+            tipos = etree.fromstring(zf.read("[Content_Types].xml"), _PARSER_XML)
+            renombrados, estilo_parrafo, estilo_tabla = self._combinar_estilos(zf, rels.values())
+            numeros = self._combinar_numeracion(zf, rels.values(), renombrados)
+
+            def ajustar(raiz):
+                self._ajustar(raiz, renombrados, numeros, estilo_parrafo, estilo_tabla)
+
+            relaciones, partes = {}, {}
+            for raiz in (cuerpo, seccion):
+                ajustar(raiz)
+                for valor in _ATRIBUTOS_RELACION(raiz):
+                    if valor in rels:
+                        if valor not in relaciones:
+                            relaciones[valor] = self._copiar_relacion(zf, tipos, rels[valor], ajustar, partes)
+                        valor.getparent().set(valor.attrname, relaciones[valor])
+            self._combinar_fuentes(zf, tipos, rels.values(), partes)
+            elementos = list(cuerpo)
+
+        # La sección anterior se cierra en un párrafo propio, con su configuración intacta
+        parrafo = etree.SubElement(self._cuerpo, _W_P)
+        etree.SubElement(parrafo, qn("w:pPr")).append(self._seccion)
+        # La primera sección del documento agregado es la que sigue a la del anterior
+        primera = next(cuerpo.iter(qn("w:sectPr")), seccion)
+        self._completar_encabezados(primera)
+        tipo = primera.find(_W_TIPO)
+        if tipo is not None and tipo.get(_W_VAL) not in ("nextPage", "evenPage", "oddPage"):
+            tipo.set(_W_VAL, "nextPage") # Cada documento empieza en una página nueva
+        self._cuerpo.extend(elementos)
+        self._seccion = seccion
+
+    def _ajustar(self, raiz, renombrados, numeros, estilo_parrafo, estilo_tabla):
+        """Lleva el XML de un documento agregado a los estilos, numeraciones e ids del combinado."""
+        # Un recorrido por tipo de elemento: el filtrado por etiqueta de lxml es mucho más rápido
+        # que revisar cada nodo en Python
+        if renombrados:
+            _renombrar_estilos(raiz, renombrados)
+        if numeros:
+            for nodo in raiz.iter(_W_NUM_ID):
+                nodo.set(_W_VAL, numeros.get(nodo.get(_W_VAL), nodo.get(_W_VAL)))
+        if estilo_parrafo:
+            # Sin estilo explícito, el párrafo tomaría el estilo predeterminado de la base
+            for nodo in raiz.iter(_W_P):
+                propiedades = nodo.find(_W_PPR)
+                if propiedades is None:
+                    propiedades = etree.Element(_W_PPR)
+                    nodo.insert(0, propiedades)
+                if propiedades.find(_W_PSTYLE) is None:
+                    propiedades.insert(0, etree.Element(_W_PSTYLE, {_W_VAL: estilo_parrafo}))
+        if estilo_tabla:
+            for nodo in raiz.iter(_W_TBL_PR):
+                if nodo.find(_W_TBL_STYLE) is None:
+                    nodo.insert(0, etree.Element(_W_TBL_STYLE, {_W_VAL: estilo_tabla}))
+        for nodo in raiz.iter(_WP_DOC_PR):
+            self._id_dibujo += 1 # Los ids de los dibujos deben ser únicos en el documento
+            nodo.set("id", str(self._id_dibujo))
+        for nodo in raiz.iter(*_W_MARCADORES):
+            if nodo.get(_W_ID, "").isdigit():
+                nodo.set(_W_ID, str(int(nodo.get(_W_ID)) + self._cantidad * 100000))
+
+    def _combinar_estilos(self, zf, rels):
+        """
+        Agrega los estilos del documento que la base no tiene y renombra los que chocan.
+        Si sus valores predeterminados (docDefaults) difieren, todos sus estilos se renombran
+        y esos valores se copian a los estilos raíz. Devuelve (renombrados, estilo de párrafo
+        predeterminado renombrado o None, estilo de tabla predeterminado renombrado o None).
+        """
+        ruta = self._ruta_por_tipo(rels, RT.STYLES)
+        if ruta is None or self._estilos is None:
+            return {}, None, None
+        estilos = etree.fromstring(zf.read(ruta), _PARSER_XML)
+        base = {e.get(_W_ID_ESTILO): e for e in self._estilos.iter(qn("w:style"))}
+        propios = {e.get(_W_ID_ESTILO): e for e in estilos.iter(qn("w:style"))}
+        predeterminados = estilos.find(qn("w:docDefaults"))
+        todos = _c14n(predeterminados) != _c14n(self._estilos.find(qn("w:docDefaults")))
+
+        renombrados, ocupados, cambio = {}, set(base) | set(propios), True
+        while cambio: # Un estilo basado en uno renombrado también cambia
+            cambio = False
+            for id_estilo, estilo in propios.items():
+                if id_estilo in renombrados:
+                    continue
+                padre = estilo.find(qn("w:basedOn"))
+                if (todos or padre is not None and padre.get(_W_VAL) in renombrados
+                        or id_estilo in base and _c14n(estilo) != _c14n(base[id_estilo])):
+                    nuevo, n = f"{id_estilo}-{self._cantidad}", 1
+                    while nuevo in ocupados:
+                        n += 1
+                        nuevo = f"{id_estilo}-{self._cantidad}-{n}"
+                    ocupados.add(nuevo)
+                    renombrados[id_estilo] = nuevo
+                    cambio = True
+
+        estilo_parrafo = estilo_tabla = None
+        for id_estilo, estilo in propios.items():
+            if id_estilo not in renombrados:
+                if id_estilo not in base:
+                    self._estilos.append(estilo)
+                continue
+            estilo.set(_W_ID_ESTILO, renombrados[id_estilo])
+            nombre = estilo.find(qn("w:name"))
+            if nombre is not None:
+                nombre.set(_W_VAL, f"{nombre.get(_W_VAL)} ({self._cantidad})")
+            if estilo.get(qn("w:default")) in ("1", "true", "on"):
+                del estilo.attrib[qn("w:default")]
+                if estilo.get(_W_TIPO) == "paragraph":
+                    estilo_parrafo = renombrados[id_estilo]
+                elif estilo.get(_W_TIPO) == "table":
+                    estilo_tabla = renombrados[id_estilo]
+            if todos and predeterminados is not None and estilo.find(qn("w:basedOn")) is None:
+                self._aplicar_predeterminados(estilo, predeterminados)
+            self._estilos.append(estilo)
+        if renombrados:
+            for estilo in propios.values():
+                _renombrar_estilos(estilo, renombrados)
+        return renombrados, estilo_parrafo, estilo_tabla
+
+    @staticmethod
+    def _aplicar_predeterminados(estilo, predeterminados):
+        """Copia en un estilo raíz los valores predeterminados de su documento que no define."""
+        if estilo.get(_W_TIPO) not in ("paragraph", "table"):
+            return
+        for contenedor, tag, orden, siguientes in (
+            ("w:pPrDefault", "w:pPr", _ORDEN_PPR, _SIGUEN_A_PPR),
+            ("w:rPrDefault", "w:rPr", _ORDEN_RPR, _SIGUEN_A_RPR),
+        ):
+            por_defecto = predeterminados.find(f"{qn(contenedor)}/{qn(tag)}")
+            if por_defecto is None:
+                continue
+            propiedades = estilo.find(qn(tag))
+            if propiedades is None:
+                propiedades = _insertar_antes_de(estilo, etree.Element(qn(tag)), siguientes)
+            _completar_propiedades(propiedades, por_defecto, orden)
+
+    def _combinar_numeracion(self, zf, rels, renombrados):
+        """Agrega las numeraciones del documento con ids nuevos. Devuelve {numId anterior: nuevo}."""
+        ruta = self._ruta_por_tipo(rels, RT.NUMBERING)
+        if ruta is None:
+            return {}
+        numeracion = etree.fromstring(zf.read(ruta), _PARSER_XML)
+        if self._numeracion is None:
+            nombre = self._nombre_libre("word/numbering.xml")
+            self._numeracion = self._partes[nombre] = etree.Element(qn("w:numbering"), nsmap={"w": _NS_W})
+            self._agregar_relacion(RT.NUMBERING, posixpath.relpath(nombre, "word"))
+            self._agregar_tipo(nombre, CT.WML_NUMBERING)
+        abstractas = [int(a.get(_W_ID_NUMERACION_ABSTRACTA)) for a in self._numeracion.iter(qn("w:abstractNum"))]
+        concretas = [int(n.get(_W_NUM_ID)) for n in self._numeracion.iter(qn("w:num"))]
+        siguiente_abstracta, siguiente_concreta = max(abstractas, default=-1) + 1, max(concretas, default=0) + 1
+        mapa_abstractas, numeros = {}, {}
+        for abstracta in list(numeracion.iter(qn("w:abstractNum"))):
+            mapa_abstractas[abstracta.get(_W_ID_NUMERACION_ABSTRACTA)] = str(siguiente_abstracta)
+            abstracta.set(_W_ID_NUMERACION_ABSTRACTA, str(siguiente_abstracta))
+            siguiente_abstracta += 1
+            nsid = abstracta.find(qn("w:nsid"))
+            if nsid is not None: # Con el mismo nsid, Word continuaría la numeración de la base
+                nsid.set(_W_VAL, f"{(int(nsid.get(_W_VAL), 16) + self._cantidad) & 0xFFFFFFFF:08X}")
+            _renombrar_estilos(abstracta, renombrados)
+            # Las abstractas van todas antes que las concretas
+            _insertar_antes_de(self._numeracion, abstracta, {qn("w:num"), qn("w:numIdMacAtCleanup")})
+        for concreta in list(numeracion.iter(qn("w:num"))):
+            numeros[concreta.get(_W_NUM_ID)] = str(siguiente_concreta)
+            concreta.set(_W_NUM_ID, str(siguiente_concreta))
+            siguiente_concreta += 1
+            referencia = concreta.find(qn("w:abstractNumId"))
+            if referencia is not None:
+                referencia.set(_W_VAL, mapa_abstractas.get(referencia.get(_W_VAL), referencia.get(_W_VAL)))
+            _insertar_antes_de(self._numeracion, concreta, {qn("w:numIdMacAtCleanup")})
+        return numeros
+
+    def _combinar_fuentes(self, zf, tipos, rels, partes):
+        """
+        Agrega a la tabla de fuentes de la base las fuentes del documento que no declara y
+        copia las fuentes incrustadas que la base no tiene (sin ellas, el documento se
+        imprimiría con fuentes sustitutas).
+        """
+        ruta = self._ruta_por_tipo(rels, RT.FONT_TABLE)
+        if ruta is None:
+            return
+        fuentes = etree.fromstring(zf.read(ruta), _PARSER_XML)
+        carpeta, archivo = posixpath.split(ruta)
+        ruta_rels = posixpath.join(carpeta, "_rels", f"{archivo}.rels")
+        rels_fuentes = {}
+        if ruta_rels in zf.namelist():
+            rels_fuentes = {r.get("Id"): r for r in etree.fromstring(zf.read(ruta_rels), _PARSER_XML).iter(_REL)}
+        if self._fuentes is None:
+            self._ruta_fuentes = self._nombre_libre("word/fontTable.xml")
+            self._fuentes = self._partes[self._ruta_fuentes] = etree.Element(
+                qn("w:fonts"), nsmap={"w": _NS_W, "r": _NS_R.strip("{}")}
+            )
+            self._agregar_relacion(RT.FONT_TABLE, posixpath.relpath(self._ruta_fuentes, "word"))
+            self._agregar_tipo(self._ruta_fuentes, CT.WML_FONT_TABLE)
+
+        base = {f.get(qn("w:name")): f for f in self._fuentes.iter(qn("w:font"))}
+        for fuente in list(fuentes.iter(qn("w:font"))):
+            existente = base.get(fuente.get(qn("w:name")))
+            for incrustada in list(fuente):
+                if incrustada.tag not in _W_FUENTES_INCRUSTADAS:
+                    continue
+                if existente is not None and existente.find(incrustada.tag) is not None:
+                    continue # La base ya la incrusta
+                rel = rels_fuentes.get(incrustada.get(f"{_NS_R}id"))
+                if rel is None or rel.get("TargetMode") == "External":
+                    fuente.remove(incrustada)
+                    continue
+                copia = self._copiar_parte(zf, tipos, _ruta_destino(carpeta, rel.get("Target")), None, partes)
+                incrustada.set(f"{_NS_R}id", self._agregar_relacion_fuente(
+                    rel.get("Type"), posixpath.relpath(copia, posixpath.dirname(self._ruta_fuentes))
+                ))
+            if existente is None:
+                self._fuentes.append(fuente)
+                base[fuente.get(qn("w:name"))] = fuente
+            else:
+                _completar_propiedades(existente, fuente, _ORDEN_FUENTE)
+
+    def _agregar_relacion_fuente(self, tipo, destino):
+        """Agrega una relación a la tabla de fuentes de la base; devuelve su id."""
+        if self._rels_fuentes is None:
+            carpeta, archivo = posixpath.split(self._ruta_fuentes)
+            ruta_rels = posixpath.join(carpeta, "_rels", f"{archivo}.rels")
+            if ruta_rels in self._base.NameToInfo:
+                self._rels_fuentes = self._leer(ruta_rels)
+            else:
+                self._rels_fuentes = self._partes[ruta_rels] = etree.Element(
+                    f"{{{_NS_RELACIONES}}}Relationships", nsmap={None: _NS_RELACIONES}
+                )
+            # Word solo usa las fuentes incrustadas si la configuración lo indica
+            ruta = self._ruta_por_tipo(self._rels.iter(_REL), RT.SETTINGS)
+            if ruta is not None:
+                configuracion = self._partes.get(ruta)
+                if configuracion is None:
+                    configuracion = self._leer(ruta)
+                _completar_propiedades(configuracion, [etree.Element(qn("w:embedTrueTypeFonts"))],
+                                       _ORDEN_CONFIGURACION)
+        ids = {r.get("Id") for r in self._rels_fuentes.iter(_REL)}
+        n = len(ids) + 1
+        while f"rId{n}" in ids:
+            n += 1
+        etree.SubElement(self._rels_fuentes, _REL, Id=f"rId{n}", Type=tipo, Target=destino)
+        return f"rId{n}"
+
+    def _copiar_relacion(self, zf, tipos, rel, ajustar, partes):
+        """
+        Copia la relación del documento agregado (y la parte a la que apunta, si no estaba
+        ya en `partes`: {nombre original: nombre nuevo}). Devuelve el id de la relación nueva.
+        """
+        if rel.get("TargetMode") == "External":
+            return self._agregar_relacion(rel.get("Type"), rel.get("Target"), externa=True)
+        nombre = self._copiar_parte(zf, tipos, _ruta_destino("word", rel.get("Target")), ajustar, partes)
+        return self._agregar_relacion(rel.get("Type"), posixpath.relpath(nombre, "word"))
+
+    def _copiar_parte(self, zf, tipos, origen, ajustar, copiadas):
+        """Copia una parte y, recursivamente, las que ella referencia. Devuelve su nombre nuevo."""
+        if origen in copiadas:
+            return copiadas[origen]
+        nombre = copiadas[origen] = self._nombre_libre(origen)
+        tipo = next((o.get("ContentType") for o in tipos.iter(f"{_NS_TIPOS}Override")
+                     if o.get("PartName") == f"/{origen}"), None)
+        if tipo is not None:
+            self._agregar_tipo(nombre, tipo)
+        else:
+            extension = posixpath.splitext(origen)[1][1:].lower()
+            if not any(d.get("Extension", "").lower() == extension for d in self._tipos.iter(f"{_NS_TIPOS}Default")):
+                original = next((d for d in tipos.iter(f"{_NS_TIPOS}Default")
+                                 if d.get("Extension", "").lower() == extension), None)
+                if original is not None:
+                    self._tipos.insert(0, copy.deepcopy(original))
+        contenido = zf.read(origen)
+        if tipo in (CT.WML_HEADER, CT.WML_FOOTER):
+            # Encabezados y pies usan los mismos estilos y numeraciones que el cuerpo
+            raiz = etree.fromstring(contenido, _PARSER_XML)
+            ajustar(raiz)
+            contenido = raiz
+        self._partes[nombre] = contenido
+
+        carpeta, archivo = posixpath.split(origen)
+        ruta_rels = posixpath.join(carpeta, "_rels", f"{archivo}.rels")
+        if ruta_rels in zf.namelist():
+            rels = etree.fromstring(zf.read(ruta_rels), _PARSER_XML)
+            for rel in rels.iter(_REL):
+                if rel.get("TargetMode") != "External":
+                    copia = self._copiar_parte(zf, tipos, _ruta_destino(carpeta, rel.get("Target")), ajustar, copiadas)
+                    rel.set("Target", posixpath.relpath(copia, posixpath.dirname(nombre)))
+            carpeta_nueva, archivo_nuevo = posixpath.split(nombre)
+            self._partes[posixpath.join(carpeta_nueva, "_rels", f"{archivo_nuevo}.rels")] = rels
+        return nombre
+
+    def _completar_encabezados(self, seccion):
+        """
+        Una sección sin encabezado (o pie) propio hereda el de la anterior: se le asigna uno
+        vacío para que cada documento se imprima solo con los suyos.
+        """
+        primera = seccion.find(qn("w:titlePg"))
+        tipos_pagina = ["default"]
+        if primera is not None and primera.get(_W_VAL, "1") not in ("0", "false", "off"):
+            tipos_pagina.append("first")
+        for clase, raiz, tipo_rel, tipo_contenido in (
+            ("header", "w:hdr", RT.HEADER, CT.WML_HEADER),
+            ("footer", "w:ftr", RT.FOOTER, CT.WML_FOOTER),
+        ):
+            presentes = {r.get(_W_TIPO) for r in seccion.iter(qn(f"w:{clase}Reference"))}
+            for tipo_pagina in tipos_pagina:
+                if tipo_pagina in presentes:
+                    continue
+                if clase not in self._vacios:
+                    nombre = self._nombre_libre(f"word/{clase}_vacio.xml")
+                    parte = etree.Element(qn(raiz), nsmap={"w": _NS_W})
+                    etree.SubElement(parte, _W_P)
+                    self._partes[nombre] = parte
+                    self._agregar_tipo(nombre, tipo_contenido)
+                    self._vacios[clase] = self._agregar_relacion(tipo_rel, posixpath.relpath(nombre, "word"))
+                seccion.insert(0, etree.Element(qn(f"w:{clase}Reference"),
+                                                {_W_TIPO: tipo_pagina, f"{_NS_R}id": self._vacios[clase]}))
+
+    def escribir(self, destino):
+        self._cuerpo.append(self._seccion)
+        # Las partes de la base van en su orden original ([Content_Types].xml primero) y las nuevas al final
+        nombres = [info.filename for info in self._base.infolist()]
+        nombres += [nombre for nombre in self._partes if nombre not in self._base.NameToInfo]
+        with zipfile.ZipFile(destino, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=ZIP_NIVEL_COMPRESION) as zf:
+            for nombre in nombres:
+                contenido = self._partes.get(nombre)
+                if contenido is None:
+                    contenido = self._base.read(nombre)
+                elif not isinstance(contenido, bytes):
+                    contenido = etree.tostring(contenido, encoding="UTF-8", standalone=True)
+                zf.writestr(nombre, contenido)
+
+def _ruta_destino(carpeta, destino):
+    """Nombre de la parte a la que apunta una relación (relativa a `carpeta` o absoluta)."""
+    if destino.startswith("/"):
+        return destino[1:]
+    return posixpath.normpath(posixpath.join(carpeta, urllib.parse.unquote(destino)))
+
+def combinar_documentos(documentos, destino):
+    """
+    Une los .docx de `documentos` (bytes, en orden) en uno solo, para imprimir todo de una vez.
+    Cada documento empieza en página nueva y conserva su sección (tamaño de página, márgenes,
+    encabezados y pies). `destino` es una ruta o un archivo binario abierto.
+    """
+    with metricas.medir("combinar_documentos"):
+        combinado = _DocumentoCombinado(documentos[0])
+        for contenido in documentos[1:]:
+            combinado.agregar(contenido)
+        combinado.escribir(destino)
+
+# --- Datos del paciente ---
+
+def nombre_completo(paciente):
+    return f"{paciente['nombres'].strip()} {paciente['apellido_paterno'].strip()} {paciente['apellido_materno'].strip()}".strip()
+
+def separar_nombre_completo(texto):
+    """Divide 'Nombres Paterno Materno' en sus partes (para registros sin los campos separados)."""
+    partes = texto.split()
+    if len(partes) >= 3:
+        return " ".join(partes[:-2]), partes[-2], partes[-1]
+    return (partes + ["", ""])[0], (partes + ["", ""])[1], ""
+
+def validar_paciente(paciente):
+    """Devuelve el mensaje del primer dato obligatorio que falte, o None si está completo."""
+    if not paciente['nombres'].strip():
+        return "Por favor, ingrese los Nombres del paciente."
+    if not paciente['apellido_paterno'].strip():
+        return "Por favor, ingrese el Apellido Paterno del paciente."
+    if not paciente['diagnosticos'].strip():
+        return "Por favor, ingrese el Diagnóstico del paciente."
+    if not isinstance(paciente['fecha_internacion'], date):
+        return "Fecha de internación inválida (use DD/MM/AAAA)."
+    return None
+
+def datos_reemplazo(paciente):
+    """Marcadores de las plantillas y su valor para este paciente."""
+    return {
+        '{{NOMBRE_COMPLETO}}': nombre_completo(paciente),
+        '{{NOMBRES}}': paciente['nombres'].strip(),
+        '{{APELLIDO_PATERNO}}': paciente['apellido_paterno'].strip(),
+        '{{APELLIDO_MATERNO}}': paciente['apellido_materno'].strip(),
+        '{{FECHA_NACIMIENTO}}': paciente['fecha_nacimiento_str'],
+        '{{EDAD}}': paciente['edad'],
+        '{{FECHA_INTERNACION}}': paciente['fecha_internacion'].strftime("%d/%m/%Y"),
+        '{{NUM_HISTORIA}}': paciente['num_historia'],
+        '{{NUM_REGISTRO}}': paciente['num_registro'],
+        '{{OCUPACION}}': paciente['ocupacion'],
+        '{{ESTADO_CIVIL}}': paciente['estado_civil'],
+        '{{RESIDENCIA}}': paciente['residencia'],
+        '{{GENERO}}': paciente['genero'],
+        '{{PROCEDENCIA}}': paciente['procedencia'],
+        '{{DOMICILIO}}': paciente['domicilio'], # NUEVO MARCADO
+        '{{ES_RESIDENTE_LA_PAZ}}': "Sí" if paciente['es_residente_la_paz'] else "No",
+        '{{N_REFERENCIA1}}': paciente['n_referencia1'],
+        '{{REFERENCIA1}}': paciente['referencia1'],
+        '{{TELEFONO_REFERENCIA1}}': paciente['telefono_referencia1'], # NUEVO MARCADO
+        '{{N_REFERENCIA2}}': paciente['n_referencia2'],
+        '{{REFERENCIA2}}': paciente['referencia2'],
+        '{{TELEFONO_REFERENCIA2}}': paciente['telefono_referencia2'], # NUEVO MARCADO
+        '{{DIAGNOSTICOS}}': paciente['diagnosticos'],
+        '{{DIAG_RECETAS_LABS}}': paciente['diag_recetas_labs'],
+        '{{CIE10}}': paciente['cie10'],
+        '{{SERVICIO}}': paciente['servicio'],
+        '{{OBSERVACIONES}}': paciente['observaciones'],
+        '{{INDICACIONES}}': paciente['indicaciones']
+    }
+
+def nombre_carpeta(paciente):
+    """Nombre de carpeta "virtual" del paciente dentro del ZIP, sin caracteres inválidos."""
+    nombre_carpeta_raw = f"{nombre_completo(paciente)} - {paciente['num_historia']} - {paciente['diagnosticos'].strip()}"
+    return re.sub(r'[<>:"/\\|?*]', '_', nombre_carpeta_raw)
+
+def calcular_edad(fecha_nacimiento_str):
+    """Edad en años a partir de una fecha DD/MM/AA o DD/MM/AAAA ("" si no es válida)."""
+    try:
+        if fecha_nacimiento_str and '/' in fecha_nacimiento_str:
+            d, m, y = fecha_nacimiento_str.split('/')
+            dia, mes = int(d), int(m)
+            año = int(y)
+            if año < 100: # Asume años de 2 dígitos (ej. 98 -> 1998, 05 -> 2005)
+                año_actual_2_dig = date.today().year % 100
+                año += 1900 if año > año_actual_2_dig else 2000
+            nac = date(año, mes, dia)
+            hoy = date.today()
+            return str(hoy.year - nac.year - ((hoy.month, hoy.day) < (nac.month, nac.day)))
+        return ""
+    except (ValueError, TypeError):
+        return ""
+
+def calcular_num_registro(fecha_nacimiento_str):
+    """Número de registro DDMMAA a partir de la fecha de nacimiento ("" si no tiene formato)."""
+    try:
+        if fecha_nacimiento_str and '/' in fecha_nacimiento_str:
+            d, m, y = fecha_nacimiento_str.split('/')
+            año = y[-2:] if len(y) >= 2 else y.zfill(2) # Obtener los últimos 2 dígitos
+            return f"{d.zfill(2)}{m.zfill(2)}{año}"
+        return ""
+    except ValueError:
+        return ""
+
+def completar_paciente(datos):
+    """
+    Normaliza un dict con datos del paciente (claves de CAMPOS_PACIENTE): completa los
+    campos que falten, calcula edad y N° de registro desde la fecha de nacimiento si no
+    vienen, escribe los códigos CIE-10 en la forma habitual ("d509" -> "D50.9") y acepta
+    fecha_internacion como date o texto DD/MM/AAAA (por defecto, hoy).
+    """
+    paciente = {}
+    for campo in CAMPOS_PACIENTE:
+        valor = datos.get(campo)
+        paciente[campo] = "" if valor is None else valor if campo == 'fecha_internacion' else str(valor)
+
+    residente = datos.get('es_residente_la_paz', False)
+    if isinstance(residente, str):
+        residente = residente.strip().lower() in ("sí", "si", "true", "1", "x")
+    paciente['es_residente_la_paz'] = bool(residente)
+
+    paciente['cie10'] = normalizar_codigos(paciente['cie10'])
+    if not paciente['edad']:
+        paciente['edad'] = calcular_edad(paciente['fecha_nacimiento_str'])
+    if not paciente['num_registro']:
+        paciente['num_registro'] = calcular_num_registro(paciente['fecha_nacimiento_str'])
+
+    fecha = paciente['fecha_internacion'] or date.today()
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+    elif isinstance(fecha, str):
+        try:
+            fecha = datetime.strptime(fecha.strip(), "%d/%m/%Y").date()
+        except ValueError:
+            pass # validar_paciente informa la fecha inválida
+    paciente['fecha_internacion'] = fecha
+    return paciente
+
+def normalizar_plantillas(plantillas):
+    """
+    Convierte una lista de plantillas ("Carpeta/archivo.docx", "Carpeta:archivo.docx" o
+    dicts {'carpeta', 'archivo'}) al formato interno. Solo acepta carpetas de
+    CATEGORIAS_PLANTILLAS y nombres de archivo sin rutas.
+    """
+    if not isinstance(plantillas, (list, tuple)):
+        raise ValueError("Las plantillas deben ser una lista")
+    carpetas = {carpeta for _, carpeta in CATEGORIAS_PLANTILLAS}
+    seleccionadas = []
+    for p in plantillas:
+        if isinstance(p, dict):
+            carpeta, archivo = p.get('carpeta', ''), p.get('archivo', '')
+        else:
+            carpeta, archivo = (re.split(r"[/:\\]", str(p), maxsplit=1) + [""])[:2]
+        if not isinstance(carpeta, str) or not isinstance(archivo, str): # Por ejemplo, desde el JSON de la API
+            raise ValueError(f"Plantilla inválida: {p}")
+        if carpeta not in carpetas or not archivo or os.path.basename(archivo) != archivo or archivo.startswith('.'):
+            raise ValueError(f"Plantilla inválida: {p}")
+        seleccionadas.append({'carpeta': carpeta, 'archivo': archivo})
+    return seleccionadas
+
+# `combinado`: si se escribió el documento único para imprimir (ver generar_zip)
+ResultadoGeneracion = namedtuple('ResultadoGeneracion', ['archivo', 'carpeta', 'generados', 'errores', 'manifiesto',
+                                                         'combinado'], defaults=(False,))
+
+def generar_zip(datos_paciente, plantillas, plantillas_dir, destino=None, archivo_docs=None,
+                al_avanzar=None, cancelar=None, destino_combinado=None):
+    """
+    Genera las plantillas indicadas para un paciente y arma el ZIP (una carpeta con los .docx).
+
+    `destino` puede ser una ruta o un archivo binario abierto; si es None el ZIP queda en un
+    archivo temporal devuelto en `archivo`, posicionado al inicio (el llamador debe cerrarlo).
+    Con `archivo_docs` (un ArchivoDocumentos) se reutilizan los documentos ya archivados y
+    `manifiesto` trae la clave para volver a descargar esta generación. `al_avanzar` y
+    `cancelar` se pasan a escribir_documentos_zip. Con `destino_combinado` (ruta o archivo
+    binario) también se escriben todos los documentos unidos en un solo .docx para imprimir.
+    Devuelve un ResultadoGeneracion. Lanza ValueError si faltan datos obligatorios o
+    alguna plantilla no es válida.
+    """
+    with metricas.medir("generar_total"):
+        return _generar_zip(datos_paciente, plantillas, plantillas_dir, destino, archivo_docs, al_avanzar, cancelar,
+                            destino_combinado)
+
+def _generar_zip(datos_paciente, plantillas, plantillas_dir, destino, archivo_docs, al_avanzar, cancelar,
+                 destino_combinado):
+    paciente = completar_paciente(datos_paciente)
+    error = validar_paciente(paciente)
+    if error:
+        raise ValueError(error)
+    seleccionadas = normalizar_plantillas(plantillas)
+    if not seleccionadas:
+        raise ValueError("Seleccione al menos una plantilla para generar documentos.")
+
+    carpeta = nombre_carpeta(paciente)
+    data = datos_reemplazo(paciente)
+    archivo = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) if destino is None else destino
+    contenidos = [] if destino_combinado is not None else None
+    try:
+        with zipfile.ZipFile(archivo, 'w', compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=ZIP_NIVEL_COMPRESION) as zf:
+            generados, errores = escribir_documentos_zip(
+                zf, carpeta, nombre_completo(paciente), seleccionadas, plantillas_dir, data, archivo_docs,
+                al_avanzar, cancelar, contenidos
+            )
+    except Exception:
+        if destino is None:
+            archivo.close()
+        raise
+    if destino is None:
+        archivo.seek(0)
+    if cancelar is not None and cancelar.is_set():
+        # Generación parcial: no se une para imprimir ni se registra su manifiesto
+        return ResultadoGeneracion(archivo if destino is None else destino, carpeta, generados, errores, None)
+    combinado = False
+    if contenidos:
+        try:
+            combinar_documentos(contenidos, destino_combinado)
+            combinado = True
+        except Exception as e: # El ZIP ya está completo: solo falta el documento para imprimir
+            errores.append(f"Documento para imprimir: {e}")
+    manifiesto = archivar_generacion(archivo_docs, carpeta, generados, data) if archivo_docs and generados else None
+    return ResultadoGeneracion(archivo if destino is None else destino, carpeta, generados, errores, manifiesto,
+                               combinado)
+
+def rearmar_zip(archivo_docs, clave_manifiesto, plantillas_dir, destino=None):
+    """
+    Vuelve a armar el ZIP de una generación anterior a partir de su manifiesto. Los documentos
+    se toman del archivo; solo los que ya fueron desalojados se renderizan de nuevo con los
+    mismos datos (y la versión actual de la plantilla). Devuelve un ResultadoGeneracion.
+    Lanza ValueError si el manifiesto no existe.
+    """
+    manifiesto = archivo_docs.obtener_manifiesto(clave_manifiesto)
+    if manifiesto is None:
+        raise ValueError("La generación ya no está en el archivo de documentos.")
+    carpeta, data = manifiesto['carpeta'], manifiesto['datos']
+    archivo = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) if destino is None else destino
+    generados, errores = [], []
+    try:
+        with zipfile.ZipFile(archivo, 'w', compression=zipfile.ZIP_DEFLATED,
+                             compresslevel=ZIP_NIVEL_COMPRESION) as zf:
+            for doc in manifiesto['documentos']:
+                try:
+                    contenido = archivo_docs.obtener(doc['clave']) if doc['clave'] else None
+                    if contenido is None:
+                        carpeta_plantilla, nombre_plantilla = doc['plantilla'].split("/", 1)
+                        with renderizar_plantilla(os.path.join(plantillas_dir, carpeta_plantilla, nombre_plantilla),
+                                                  data) as salida:
+                            contenido = salida.read()
+                    zf.writestr(os.path.join(carpeta, doc['nombre']), contenido)
+                    generados.append({'cat': doc['plantilla'].split("/", 1)[0], 'file': doc['nombre'],
+                                      'plantilla': doc['plantilla'], 'clave': doc['clave']})
+                except Exception as e:
+                    errores.append(f"{doc['nombre']}: {e}")
+    except Exception:
+        if destino is None:
+            archivo.close()
+        raise
+    if destino is None:
+        archivo.seek(0)
+    return ResultadoGeneracion(archivo if destino is None else destino, carpeta, generados, errores, clave_manifiesto)
+
+# --- Servidor HTTP local ---
+
+# Tamaño máximo aceptado para el JSON de una solicitud
+HTTP_MAX_CUERPO = 1024 * 1024
+
+class _ManejadorHTTP:
+    """
+    API mínima para que otros sistemas pidan documentos:
+      GET  /salud       -> {"estado": "ok"}
+      GET  /plantillas  -> {"Carpeta": ["archivo.docx", ...], ...}
+      GET  /metricas    -> tiempos por etapa en formato de Prometheus (con HCL_METRICAS=1)
+      GET  /cie10?q=... -> [{"codigo": "D50.9", "descripcion": "..."}, ...] (parámetro opcional limite)
+      POST /generar     -> cuerpo {"paciente": {...}, "plantillas": ["Carpeta/archivo.docx", ...]}
+                           responde el ZIP (application/zip)
+    Se combina con BaseHTTPRequestHandler en `servir`, así la app no importa http.server.
+    """
+    plantillas_dir = None
+    archivo_docs = None
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == "/salud":
+            self._responder_json(200, {"estado": "ok"})
+        elif url.path == "/cie10":
+            parametros = urllib.parse.parse_qs(url.query)
+            try:
+                limite = max(1, min(int(parametros.get("limite", [CIE10_SUGERENCIAS])[0]), 100))
+            except ValueError:
+                self._responder_json(400, {"error": "limite debe ser un número"})
+                return
+            encontrados = obtener_catalogo_cie10().buscar(parametros.get("q", [""])[0], limite)
+            self._responder_json(200, [{"codigo": c, "descripcion": d} for c, d in encontrados])
+        elif url.path == "/plantillas":
+            categorias = obtener_catalogo(self.plantillas_dir).obtener()
+            self._responder_json(200, {c: list(docs) for c, (docs, _) in categorias.items()})
+        elif url.path == "/metricas":
+            datos = metricas.exportar_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+        else:
+            self._responder_json(404, {"error": "Ruta no encontrada"})
+
+    def do_POST(self):
+        if self.path != "/generar":
+            self._responder_json(404, {"error": "Ruta no encontrada"})
+            return
+        valor_largo = self.headers.get("Content-Length")
+        if valor_largo is None:
+            self._responder_json(411, {"error": "Falta el encabezado Content-Length"})
+            return
+        valor_largo = valor_largo.strip()
+        if not (valor_largo.isascii() and valor_largo.isdigit()):
+            self._responder_json(400, {"error": "Content-Length debe ser un entero no negativo"})
+            return
+        largo = int(valor_largo)
+        if largo > HTTP_MAX_CUERPO:
+            self._responder_json(413, {"error": "Solicitud demasiado grande"})
+            return
+        try:
+            cuerpo = json.loads(self.rfile.read(largo) or b"{}")
+            resultado = generar_zip(cuerpo.get("paciente", {}), cuerpo.get("plantillas", []), self.plantillas_dir,
+                                    archivo_docs=self.archivo_docs)
+        except (ValueError, AttributeError) as e:
+            self._responder_json(400, {"error": str(e)})
+            return
+
+        with resultado.archivo as archivo:
+            if not resultado.generados:
+                self._responder_json(422, {"error": "No se generaron documentos.", "errores": resultado.errores})
+                return
+            tamaño = archivo.seek(0, os.SEEK_END)
+            archivo.seek(0)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Length", str(tamaño))
+            self.send_header("Content-Disposition",
+                             f"attachment; filename*=UTF-8''{urllib.parse.quote(resultado.carpeta + '.zip')}")
+            self.send_header("X-Documentos-Generados", str(len(resultado.generados)))
+            self.send_header("X-Documentos-Con-Error", str(len(resultado.errores)))
+            self.end_headers()
+            shutil.copyfileobj(archivo, self.wfile)
+
+    def _responder_json(self, codigo, cuerpo):
+        datos = json.dumps(cuerpo, ensure_ascii=False).encode("utf-8")
+        self.send_response(codigo)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(datos)))
+        self.end_headers()
+        self.wfile.write(datos)
+
+def servir(plantillas_dir, host="127.0.0.1", puerto=8765, archivo_dir=None):
+    """Atiende la API HTTP local (varias solicitudes a la vez) hasta que se interrumpa."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    precalentar_en_segundo_plano(plantillas_dir)
+    manejador = type("ManejadorHTTP", (_ManejadorHTTP, BaseHTTPRequestHandler), {
+        "plantillas_dir": plantillas_dir,
+        "archivo_docs": obtener_archivo(archivo_dir) if archivo_dir else None,
+    })
+    with ThreadingHTTPServer((host, puerto), manejador) as servidor:
+        print(f"Sirviendo documentos en http://{host}:{puerto} (plantillas: {plantillas_dir})", file=sys.stderr)
+        try:
+            servidor.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+# --- Línea de comandos ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generación de documentos médicos sin la interfaz de Streamlit.")
+    parser.add_argument("--plantillas-dir", default=os.path.join(os.getcwd(), "PLANTILLAS"),
+                        help="Carpeta de plantillas (por defecto ./PLANTILLAS)")
+    parser.add_argument("--archivo-dir", default=os.environ.get("HCL_ARCHIVO_DIR"),
+                        help="Archivo de documentos generados para reutilizarlos (por defecto HCL_ARCHIVO_DIR; "
+                             "sin él no se archiva)")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p_generar = sub.add_parser("generar", help="Genera el ZIP de un paciente")
+    p_generar.add_argument("--datos", required=True, help="JSON con los datos del paciente ('-' para leer de stdin)")
+    p_generar.add_argument("-p", "--plantilla", action="append", required=True,
+                           help="Plantilla como Carpeta/archivo.docx (se puede repetir)")
+    p_generar.add_argument("-o", "--salida", help="Ruta del ZIP (por defecto, el nombre de la carpeta del paciente)")
+    p_generar.add_argument("--imprimir", help="Ruta de un .docx con todos los documentos unidos, para imprimir de una vez")
+
+    sub.add_parser("listar", help="Lista las plantillas disponibles")
+
+    p_servir = sub.add_parser("servir", help="Inicia la API HTTP local")
+    p_servir.add_argument("--host", default="127.0.0.1")
+    p_servir.add_argument("--puerto", type=int, default=8765)
+
+    args = parser.parse_args(argv)
+
+    if args.comando == "listar":
+        for carpeta, (docs, _) in obtener_catalogo(args.plantillas_dir).obtener().items():
+            for doc in docs:
+                print(f"{carpeta}/{doc}")
+        return 0
+
+    if args.comando == "servir":
+        servir(args.plantillas_dir, args.host, args.puerto, args.archivo_dir)
+        return 0
+
+    if args.datos == "-":
+        datos = json.load(sys.stdin)
+    else:
+        with open(args.datos, encoding="utf-8") as f:
+            datos = json.load(f)
+    try:
+        paciente = completar_paciente(datos)
+        error = validar_paciente(paciente)
+        if error: # Antes de crear el archivo de salida
+            raise ValueError(error)
+        salida = args.salida or f"{nombre_carpeta(paciente)}.zip"
+        try:
+            with open(salida, "wb") as destino:
+                resultado = generar_zip(datos, args.plantilla, args.plantillas_dir, destino,
+                                        obtener_archivo(args.archivo_dir) if args.archivo_dir else None,
+                                        destino_combinado=args.imprimir)
+        except ValueError:
+            os.remove(salida) # Sin documentos: no dejar un ZIP vacío
+            raise
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+    for error in resultado.errores:
+        print(f"⚠️ {error}", file=sys.stderr)
+    if not resultado.generados:
+        os.remove(salida)
+        print("❌ No se generaron documentos.", file=sys.stderr)
+        return 1
+    print(f"✅ {len(resultado.generados)} documentos en {salida}")
+    if resultado.combinado:
+        print(f"🖨️ Documento para imprimir: {args.imprimir}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,199 @@
+"""
+Cola local de trabajos de generación en segundo plano.
+
+Cada trabajo pertenece a un cliente (un navegador) y avanza plantilla por plantilla,
+informando su progreso y revisando entre una y otra si se pidió cancelarlo. El resultado
+se escribe en disco, así que sigue disponible después de un rerun o de recargar la página
+y no ocupa memoria de la sesión.
+
+La cola está acotada: como máximo MAX_TRABAJOS_EN_COLA esperando, MAX_TRABAJOS_POR_CLIENTE
+por cliente entre en cola y en curso, y MAX_TRABAJOS_SIMULTANEOS corriendo a la vez. Los
+trabajos se toman por turno entre clientes, así uno con muchos trabajos no demora a los demás.
+"""
+import contextlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+MAX_TRABAJOS_SIMULTANEOS = int(os.environ.get("HCL_TRABAJOS_SIMULTANEOS", 2))
+MAX_TRABAJOS_POR_CLIENTE = int(os.environ.get("HCL_TRABAJOS_POR_CLIENTE", 3))
+MAX_TRABAJOS_EN_COLA = 50
+# Horas que se conservan los resultados terminados
+TRABAJOS_HORAS_RETENCION = 24
+
+EN_COLA, EN_CURSO, TERMINADO, CANCELADO, FALLIDO = "en_cola", "en_curso", "terminado", "cancelado", "fallido"
+
+class LimiteTrabajos(ValueError):
+    """La cola o el cliente llegaron a su límite de trabajos."""
+
+class Trabajo:
+    """Estado de un trabajo. Lo actualiza el hilo que lo ejecuta y lo leen las sesiones."""
+
+    def __init__(self, cliente, descripcion, total, funcion, ruta_resultado):
+        self.id = uuid.uuid4().hex
+        self.cliente = cliente
+        self.descripcion = descripcion
+        self.total = total
+        self.hechos = 0
+        self.actual = ""
+        self.estado = EN_COLA
+        self.mensaje = ""
+        self.errores = []
+        self.nombre_archivo = None
+        self.ruta_resultado = ruta_resultado
+        self.adicionales = {}  # ruta -> nombre de archivo de otros resultados (None mientras no estén listos)
+        self.creado = time.time()
+        self.terminado = None
+        self._funcion = funcion
+        self._cancelar = threading.Event()
+
+    @property
+    def activo(self):
+        return self.estado in (EN_COLA, EN_CURSO)
+
+    @property
+    def evento_cancelar(self):
+        """Evento que el código de generación revisa entre plantillas."""
+        return self._cancelar
+
+    def ruta_adicional(self, extension):
+        """Ruta para otro resultado del trabajo, junto al principal; se borra con él."""
+        ruta = f"{os.path.splitext(self.ruta_resultado)[0]}{extension}"
+        self.adicionales.setdefault(ruta, None)
+        return ruta
+
+    def avanzar(self, actual="", cantidad=1):
+        """Marca `cantidad` plantillas más como procesadas."""
+        self.hechos += cantidad
+        self.actual = actual
+
+    def cancelado(self):
+        return self._cancelar.is_set()
+
+class ColaTrabajos:
+    """Cola de trabajos del proceso, con sus hilos trabajadores y los resultados en `directorio`."""
+
+    def __init__(self, directorio, simultaneos=MAX_TRABAJOS_SIMULTANEOS, por_cliente=MAX_TRABAJOS_POR_CLIENTE,
+                 max_en_cola=MAX_TRABAJOS_EN_COLA):
+        self.directorio = directorio
+        self.por_cliente = por_cliente
+        self.max_en_cola = max_en_cola
+        self._trabajos = {}  # id -> Trabajo
+        self._pendientes = OrderedDict()  # cliente -> deque de trabajos en cola, en orden de turno
+        self._condicion = threading.Condition()
+        os.makedirs(directorio, exist_ok=True)
+        self._limpiar_resultados_viejos()
+        for i in range(simultaneos):
+            threading.Thread(target=self._ejecutar, name=f"trabajos-{i}", daemon=True).start()
+
+    def enviar(self, cliente, descripcion, total, funcion, extension=".zip"):
+        """
+        Encola `funcion(trabajo)`, que debe escribir su resultado en `trabajo.ruta_resultado` y
+        dejar en `trabajo.mensaje` el resumen; si lanza una excepción, el trabajo queda fallido
+        con ese mensaje. `total` es la cantidad de plantillas a procesar (la función puede
+        corregirlo cuando lo conozca). Lanza LimiteTrabajos si la cola o el cliente están al máximo.
+        """
+        with self._condicion:
+            self._descartar_vencidos()
+            if sum(len(cola) for cola in self._pendientes.values()) >= self.max_en_cola:
+                raise LimiteTrabajos("Hay demasiados trabajos en espera. Intente de nuevo en unos minutos.")
+            if sum(1 for t in self._trabajos.values() if t.cliente == cliente and t.activo) >= self.por_cliente:
+                raise LimiteTrabajos(
+                    f"Ya tiene {self.por_cliente} trabajos en curso o en espera. Espere a que terminen o cancele alguno."
+                )
+            ruta = os.path.join(self.directorio, f"{uuid.uuid4().hex}{extension}")
+            trabajo = Trabajo(cliente, descripcion, total, funcion, ruta)
+            self._trabajos[trabajo.id] = trabajo
+            self._pendientes.setdefault(cliente, deque()).append(trabajo)
+            self._condicion.notify()
+        return trabajo
+
+    def trabajos_de(self, cliente):
+        """Trabajos del cliente, del más reciente al más antiguo."""
+        with self._condicion:
+            return sorted((t for t in self._trabajos.values() if t.cliente == cliente),
+                          key=lambda t: t.creado, reverse=True)
+
+    def cancelar(self, trabajo_id):
+        """Pide cancelar el trabajo; si todavía estaba en cola, no llega a ejecutarse."""
+        with self._condicion:
+            trabajo = self._trabajos.get(trabajo_id)
+            if trabajo is None or not trabajo.activo:
+                return
+            trabajo.evento_cancelar.set()
+            cola = self._pendientes.get(trabajo.cliente)
+            if trabajo.estado == EN_COLA and cola is not None and trabajo in cola:
+                cola.remove(trabajo)
+                self._terminar(trabajo, CANCELADO, "Cancelado antes de empezar.")
+
+    def descartar(self, trabajo_id):
+        """Olvida un trabajo terminado y borra su resultado."""
+        with self._condicion:
+            trabajo = self._trabajos.get(trabajo_id)
+            if trabajo is None or trabajo.activo:
+                return
+            del self._trabajos[trabajo_id]
+        _borrar_resultados(trabajo)
+
+    def _siguiente(self):
+        """Primer trabajo del próximo cliente en turno (el cliente pasa al final de la ronda)."""
+        for cliente in list(self._pendientes):
+            cola = self._pendientes[cliente]
+            self._pendientes.move_to_end(cliente)
+            if cola:
+                return cola.popleft()
+            del self._pendientes[cliente]
+        return None
+
+    def _ejecutar(self):
+        while True:
+            with self._condicion:
+                trabajo = self._siguiente()
+                while trabajo is None:
+                    self._condicion.wait()
+                    trabajo = self._siguiente()
+                trabajo.estado = EN_CURSO
+            try:
+                trabajo._funcion(trabajo)
+            except Exception as e:
+                estado, mensaje = FALLIDO, str(e)
+            else:
+                estado, mensaje = (CANCELADO, "Cancelado.") if trabajo.cancelado() else (TERMINADO, trabajo.mensaje)
+            with self._condicion:
+                self._terminar(trabajo, estado, mensaje)
+
+    def _terminar(self, trabajo, estado, mensaje):
+        trabajo.estado, trabajo.mensaje, trabajo.terminado = estado, mensaje, time.time()
+        if estado != TERMINADO:
+            _borrar_resultados(trabajo)
+
+    def _descartar_vencidos(self):
+        limite = time.time() - TRABAJOS_HORAS_RETENCION * 3600
+        for trabajo_id in [i for i, t in self._trabajos.items() if not t.activo and t.terminado < limite]:
+            _borrar_resultados(self._trabajos.pop(trabajo_id))
+
+    def _limpiar_resultados_viejos(self):
+        """Al arrancar, borra los resultados de procesos anteriores que ya vencieron."""
+        limite = time.time() - TRABAJOS_HORAS_RETENCION * 3600
+        for nombre in os.listdir(self.directorio):
+            ruta = os.path.join(self.directorio, nombre)
+            with contextlib.suppress(OSError):
+                if os.path.getmtime(ruta) < limite:
+                    os.remove(ruta)
+
+def _borrar_resultados(trabajo):
+    for ruta in (trabajo.ruta_resultado, *trabajo.adicionales):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(ruta)
+
+_colas = {}
+_colas_lock = threading.Lock()
+
+def obtener_cola(directorio):
+    """Cola de trabajos con resultados en `directorio`, compartida por todo el proceso."""
+    with _colas_lock:
+        if directorio not in _colas:
+            _colas[directorio] = ColaTrabajos(directorio)
+        return _colas[directorio]